@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Compares building a new Environment for every feed update with reusing
+pooled structures through an UpdateBuilder.
+
+For each approach the script reports the time per update and the number
+of data structure objects created per update.
+
+$ builder_benchmark.py --updates=20000 --datastreams=4
+"""
+
+import sys
+import time
+from optparse import OptionParser
+try:
+    import txpachube
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+import txpachube.builder
+import txpachube.profiling
+
+
+
+parser = OptionParser("")
+parser.add_option("-u", "--updates", dest="updates", type="int", default=20000, help="The number of updates to encode")
+parser.add_option("-d", "--datastreams", dest="datastreams", type="int", default=4, help="The number of datastreams in each update")
+
+
+
+def newStructures(updates, datastream_ids):
+    for i in xrange(updates):
+        environment = txpachube.Environment()
+        for datastream_id in datastream_ids:
+            environment.setCurrentValue(datastream_id, str(i))
+            environment.addDatapoint(datastream_id, "2012-01-01T00:00:00Z", str(i))
+        environment.encode()
+
+
+def pooledStructures(updates, datastream_ids):
+    builder = txpachube.builder.UpdateBuilder()
+    for i in xrange(updates):
+        for datastream_id in datastream_ids:
+            builder.setCurrentValue(datastream_id, str(i))
+            builder.addDatapoint(datastream_id, "2012-01-01T00:00:00Z", str(i))
+        builder.encode()
+        builder.reset()
+
+
+def measure(name, function, updates, datastream_ids):
+    started = time.time()
+    function(updates, datastream_ids)
+    elapsed = time.time() - started
+
+    # count objects in a separate, smaller run as profiling slows each call
+    profiled = min(updates, 1000)
+    profiler = txpachube.profiling.StructureProfiler()
+    profiler.enable()
+    try:
+        function(profiled, datastream_ids)
+    finally:
+        profiler.disable()
+    objects = sum(profiler.objects.values())
+
+    print "%-8s %12.2f %16.2f" % (name, elapsed * 1000000.0 / updates, float(objects) / profiled)
+
+
+if __name__ == "__main__":
+
+    (options, args) = parser.parse_args()
+    datastream_ids = [str(i) for i in range(options.datastreams)]
+
+    print "%-8s %12s %16s" % ("", "us/update", "objects/update")
+    measure("new", newStructures, options.updates, datastream_ids)
+    measure("pooled", pooledStructures, options.updates, datastream_ids)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Measures the memory held by the strings of a large decoded list_feeds
+response, with and without interning of repeated values.
+
+A response is generated with the requested number of feeds, each with a
+few datastreams whose ids, tags and units repeat across feeds. It is
+decoded into an EnvironmentList and the distinct string objects reachable
+from it are counted and sized.
+
+$ intern_benchmark.py --feeds=5000
+"""
+
+import json
+import sys
+from optparse import OptionParser
+try:
+    import txpachube
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+import txpachube.interning
+
+
+
+parser = OptionParser("")
+parser.add_option("-f", "--feeds", dest="feeds", type="int", default=5000, help="The number of feeds in the response")
+
+
+
+def makeResponse(feeds):
+    datastreams = [('0', ['temperature'], {'label' : 'Celsius', 'symbol' : 'C', 'type' : 'derivedSI'}),
+                   ('1', ['humidity'], {'label' : 'percent', 'symbol' : '%', 'type' : 'derivedUnits'}),
+                   ('temperature', ['temperature', 'outdoor'], {'label' : 'Celsius', 'symbol' : 'C', 'type' : 'derivedSI'})]
+    results = []
+    for i in xrange(feeds):
+        results.append({'id' : i,
+                        'title' : 'feed %d' % i,
+                        'feed' : 'http://api.pachube.com/v2/feeds/%d.json' % i,
+                        'status' : ['live', 'frozen'][i % 2],
+                        'private' : 'false',
+                        'version' : '1.0.0',
+                        'tags' : ['arduino', 'weather'],
+                        'location' : {'domain' : 'physical', 'exposure' : 'outdoor', 'disposition' : 'fixed'},
+                        'datastreams' : [{'id' : datastream_id,
+                                          'tags' : tags,
+                                          'unit' : unit,
+                                          'current_value' : str(i)} for datastream_id, tags, unit in datastreams]})
+    return json.dumps({'totalResults' : feeds, 'results' : results})
+
+
+def stringMemory(obj):
+    """
+    Return the number of distinct string objects reachable from an object
+    and their total size in bytes.
+    """
+    seen = set()
+    count, size = 0, 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, basestring):
+            count += 1
+            size += sys.getsizeof(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, txpachube.DataStructure):
+            stack.append(obj.__dict__)
+    return count, size
+
+
+if __name__ == "__main__":
+
+    (options, args) = parser.parse_args()
+    response = makeResponse(options.feeds)
+
+    print "%-10s %12s %12s" % ("", "strings", "bytes")
+
+    environment_list = txpachube.EnvironmentList()
+    environment_list.decode(response)
+    print "%-10s %12d %12d" % (("plain",) + stringMemory(environment_list))
+
+    table = txpachube.interning.InternTable()
+    environment_list = txpachube.EnvironmentList()
+    environment_list.decode(response)
+    table.internStructure(environment_list)
+    print "%-10s %12d %12d" % (("interned",) + stringMemory(environment_list))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+"""
+Measures the rate at which writes can be recorded in a Spool on local
+disk, and acknowledged, with and without an fsync of every record.
+
+Each record is a JSON encoded update_feed call of about the size written
+by a SpooledWriter. The spool is created in a temporary directory that
+is removed afterwards.
+
+$ spool_benchmark.py --records=100000 --synced=1000
+"""
+
+import json
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+try:
+    import txpachube
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+import txpachube.spool
+
+
+
+parser = OptionParser("")
+parser.add_option("-r", "--records", dest="records", type="int", default=100000, help="The number of records to append")
+parser.add_option("-s", "--synced", dest="synced", type="int", default=1000, help="The number of records to append with sync")
+
+
+
+def makePayload():
+    data = json.dumps({'version' : '1.0.0',
+                       'datastreams' : [{'id' : '0', 'current_value' : '23.5'},
+                                        {'id' : '1', 'current_value' : '61'}]})
+    return json.dumps({'method' : 'update_feed', 'kwargs' : {'feed_id' : '1234', 'data' : data}})
+
+
+def measure(name, records, sync):
+    directory = tempfile.mkdtemp()
+    try:
+        spool = txpachube.spool.Spool(directory, sync=sync)
+        payload = makePayload()
+
+        started = time.time()
+        for i in xrange(records):
+            spool.append(payload)
+        appended = time.time() - started
+
+        started = time.time()
+        for sequence, payload in spool.pending():
+            spool.acknowledge(sequence)
+        acknowledged = time.time() - started
+        spool.close()
+    finally:
+        shutil.rmtree(directory)
+
+    print "%-8s %10d %14.0f %14.0f" % (name, records, records / appended, records / acknowledged)
+
+
+if __name__ == "__main__":
+
+    (options, args) = parser.parse_args()
+
+    print "%-8s %10s %14s %14s" % ("", "records", "appends/s", "acks/s")
+    measure("flushed", options.records, False)
+    measure("synced", options.synced, True)
@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+
+#
+# This script provides test cases for the PAWS client that can be run
+# without a connection to the Pachube service. The connection to the
+# service is replaced by a fake protocol that records sent messages.
+#
+import json
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+try:
+    import txpachube
+    import txpachube.client
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+    import txpachube.client
+import txpachube.dispatch
+import txpachube.ratelimit
+import txpachube.store
+import txpachube.stream
+
+
+
+class FakeTransport(object):
+    """ Stands in for a transport, recording whether it is paused """
+
+    def __init__(self):
+        self.paused = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+
+
+class FakePAWSProtocol(object):
+    """ Stands in for a PAWSProtocol, recording the messages sent """
+
+    def __init__(self):
+        self.sent = []
+        self.transport = FakeTransport()
+
+    def send(self, data):
+        self.sent.append(json.loads(data))
+
+    def disconnect(self):
+        pass
+
+
+
+class FakeConnector(object):
+    """ Stands in for the connector passed to the factory callbacks """
+
+    def connect(self):
+        pass
+
+
+
+class FakeThreadPool(object):
+    """
+    Stands in for a ThreadPool. Work is held until the test runs it so
+    the order and concurrency of processing can be inspected.
+    """
+
+    def __init__(self):
+        self.work = []
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        self.work.append((onResult, func, args, kw))
+
+    def runOne(self, index=0):
+        onResult, func, args, kw = self.work.pop(index)
+        try:
+            result = func(*args, **kw)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+
+class FakeReactor(object):
+    """ Stands in for the reactor, returning thread results immediately """
+
+    def callFromThread(self, func, *args, **kw):
+        func(*args, **kw)
+
+
+
+class PAWSClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = self.makeClient()
+        self.client.clock = self.clock
+        self.client.factory.clock = self.clock
+        self.connect()
+
+
+    def makeClient(self):
+        return txpachube.client.PAWSClient(api_key="key")
+
+
+    def connect(self):
+        """ Simulate the factory establishing a connection """
+        self.protocol = FakePAWSProtocol()
+        self.client.factory.registerConnection(self.protocol)
+
+
+    def loseConnection(self):
+        """ Simulate the connection being dropped by the network """
+        reason = failure.Failure(error.ConnectionLost())
+        self.client.factory.clientConnectionLost(FakeConnector(), reason)
+
+
+    def respond(self, token, status=200, body=None):
+        """ Simulate a message arriving from the PAWS service """
+        msg = {'token' : token, 'status' : status, 'resource' : '/feeds/1'}
+        if body is not None:
+            msg['body'] = body
+        self.client._messageHandler(json.dumps(msg))
+
+
+    def subscribe(self, resource, handler, **kwargs):
+        d = self.client.subscribe(resource, handler, **kwargs)
+        self.respond(self.protocol.sent[-1]['token'])
+        return self.successResultOf(d)
+
+
+    def test_SubscriptionUpdate(self):
+        updates = []
+        token, subscribed = self.subscribe('/feeds/1', updates.append)
+        self.assertTrue(subscribed)
+        self.respond(token, body={'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : '21'}]})
+        self.assertEqual(len(updates), 1)
+        self.assertTrue(isinstance(updates[0], txpachube.Environment))
+        self.assertEqual(updates[0].datastreams['temp'].current_value, '21')
+
+
+    def test_ResubscribeAfterReconnect(self):
+        self.client.resubscribe_batch_size = 2
+        reports = []
+        self.client.recoveryHandler = reports.append
+        tokens = [self.subscribe('/feeds/%s' % i, lambda x: None)[0] for i in range(3)]
+
+        self.loseConnection()
+        self.clock.advance(5)
+        self.connect()
+
+        # first batch is sent immediately, the remainder after the interval
+        self.assertEqual(len(self.protocol.sent), 2)
+        self.clock.advance(self.client.resubscribe_interval)
+        self.assertEqual(len(self.protocol.sent), 3)
+        self.assertEqual(sorted(m['token'] for m in self.protocol.sent), sorted(tokens))
+        self.assertTrue(all(m['method'] == 'subscribe' for m in self.protocol.sent))
+
+        for m in self.protocol.sent:
+            self.respond(m['token'])
+        self.assertEqual(len(reports), 1)
+        report = reports[0]
+        self.assertEqual(report.resubscribed, 3)
+        self.assertEqual(report.failed, [])
+        self.assertEqual(report.outage, 5)
+        self.assertEqual(report.duration, self.client.resubscribe_interval)
+        self.assertIdentical(self.client.lastRecovery, report)
+
+
+    def test_ConnectionLostDuringRecovery(self):
+        self.client.resubscribe_batch_size = 2
+        reports = []
+        self.client.recoveryHandler = reports.append
+        tokens = [self.subscribe('/feeds/%s' % i, lambda x: None)[0] for i in range(3)]
+
+        self.loseConnection()
+        self.connect()
+        first = self.client.recovery
+        self.assertEqual(len(self.protocol.sent), 2)
+        self.loseConnection()
+        self.clock.advance(self.client.resubscribe_interval)
+        # the recovery stops rather than send to the lost connection
+        self.assertEqual(len(self.protocol.sent), 2)
+        self.assertIdentical(self.successResultOf(first), None)
+
+        self.loseConnection()
+        self.connect()
+        second = self.client.recovery
+        self.loseConnection()
+        self.connect()
+        self.clock.advance(self.client.resubscribe_interval)
+        # only the newest recovery sends its second batch
+        self.assertIdentical(self.successResultOf(second), None)
+        self.assertEqual(sorted(m['token'] for m in self.protocol.sent), sorted(tokens))
+        for m in self.protocol.sent:
+            self.respond(m['token'])
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].resubscribed, 3)
+
+
+    def test_RecoveryHandlerFailure(self):
+        def brokenHandler(report):
+            raise Exception("handler failed")
+        self.client.recoveryHandler = brokenHandler
+        token, subscribed = self.subscribe('/feeds/1', lambda x: None)
+
+        self.loseConnection()
+        self.connect()
+        self.respond(self.protocol.sent[-1]['token'])
+        # the failure is logged and handled rather than left in the deferred
+        self.assertIdentical(self.successResultOf(self.client.recovery), None)
+        self.assertEqual(self.client.lastRecovery.resubscribed, 1)
+
+
+    def test_FailPendingOnConnectionLost(self):
+        d = self.client.read_feed(1)
+        self.loseConnection()
+        self.failureResultOf(d, error.ConnectionLost)
+        self.assertEqual(self.client.pendingResponses, {})
+
+
+    def test_ReplayPendingAfterReconnect(self):
+        self.client.pending_policy = txpachube.client.PAWSClient.ReplayPending
+        d = self.client.delete_feed(1)
+        token = self.protocol.sent[0]['token']
+        self.loseConnection()
+        self.assertNoResult(d)
+
+        # requests made while disconnected are held until reconnection
+        d2 = self.client.delete_feed(2)
+        self.connect()
+        self.assertEqual([m['resource'] for m in self.protocol.sent], ['/feeds/1', '/feeds/2'])
+        self.assertEqual(self.protocol.sent[0]['token'], token)
+
+        self.respond(token)
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(list(self.client._pendingMessages.keys()), [self.protocol.sent[1]['token']])
+
+
+    def test_RateLimitedRequests(self):
+        limits = {txpachube.ratelimit.Write : (1.0, 1)}
+        self.client.rate_limiter = txpachube.ratelimit.RateLimiter(limits=limits, clock=self.clock)
+        first = self.client.delete_feed(1)
+        second = self.client.delete_feed(2)
+        self.client.read_feed(3)
+        self.assertEqual([m['resource'] for m in self.protocol.sent], ['/feeds/1', '/feeds/3'])
+        self.clock.advance(1.0)
+        self.assertEqual(self.protocol.sent[-1]['resource'], '/feeds/2')
+        self.respond(self.protocol.sent[-1]['token'])
+        self.assertTrue(self.successResultOf(second))
+
+
+    def test_StoreUpdates(self):
+        store = self.client.store = txpachube.store.TimeSeriesStore()
+        token, subscribed = self.subscribe('/feeds/1', lambda x: None)
+        for at, value in [('2012-01-01T00:00:00Z', '1'), ('2012-01-01T00:01:00Z', '2')]:
+            self.respond(token, body={'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : value, 'at' : at}]})
+        start = txpachube.store.parseTimestamp('2012-01-01T00:00:00Z')
+        self.assertEqual(store.gaps('1', 'temp', start, start + 60), [])
+        self.assertEqual([dp.value for dp in store.query('1', 'temp', start, start + 60)], ['1', '2'])
+
+        # updates may be missed while disconnected
+        self.loseConnection()
+        self.connect()
+        self.respond(token, body={'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : '3',
+                                                             'at' : '2012-01-01T00:05:00Z'}]})
+        self.assertEqual(store.gaps('1', 'temp', start, start + 300), [(start + 60, start + 300)])
+
+
+    def test_RepeatedStoreUpdates(self):
+        store = self.client.store = txpachube.store.TimeSeriesStore()
+        token, subscribed = self.subscribe('/feeds/1', lambda x: None)
+        body = {'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : '1', 'at' : '2012-01-01T00:00:00Z'}]}
+        for i in range(3):
+            self.respond(token, body=body)
+        # repeated after a reconnect too
+        self.loseConnection()
+        self.connect()
+        self.respond(token, body=body)
+        series = store.getSeries('1', 'temp')
+        self.assertEqual(series._segments, [])
+        self.assertEqual(len(series._head), 1)
+        start = txpachube.store.parseTimestamp('2012-01-01T00:00:00Z')
+        self.assertEqual([dp.value for dp in store.query('1', 'temp', start, start + 60)], ['1'])
+
+
+    def test_SubscriptionStream(self):
+        d = self.client.subscribe_stream('/feeds/1', size=2)
+        token = self.protocol.sent[-1]['token']
+        self.respond(token)
+        token, stream = self.successResultOf(d)
+        self.assertEqual(stream.token, token)
+
+        waiting = stream.get()
+        self.assertNoResult(waiting)
+        for value in ['1', '2', '3', '4']:
+            self.respond(token, body={'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : value}]})
+        self.assertEqual(self.successResultOf(waiting).datastreams['temp'].current_value, '1')
+        # the oldest updates are dropped once the stream is full
+        self.assertEqual((stream.pending, stream.dropped), (2, 1))
+        self.assertEqual(self.successResultOf(stream.get()).datastreams['temp'].current_value, '3')
+
+        self.client.unsubscribe('/feeds/1', token)
+        self.assertTrue(stream.closed)
+        self.assertEqual(self.successResultOf(stream.get()).datastreams['temp'].current_value, '4')
+        self.failureResultOf(stream.get(), txpachube.stream.StreamClosed)
+
+
+    def test_NoRecoveryAfterDeliberateDisconnect(self):
+        self.subscribe('/feeds/1', lambda x: None)
+        self.client.disconnect()
+        self.loseConnection()
+        self.connect()
+        self.assertEqual(self.protocol.sent, [])
+        self.assertIdentical(self.client.lastRecovery, None)
+
+
+
+class DispatcherTestCase(PAWSClientTestCase):
+
+    def makeClient(self):
+        self.threadpool = FakeThreadPool()
+        self.dispatcher = txpachube.dispatch.SubscriptionDispatcher(threadpool=self.threadpool,
+                                                                     high_water=3,
+                                                                     low_water=1,
+                                                                     reactor=FakeReactor())
+        return txpachube.client.PAWSClient(api_key="key", dispatcher=self.dispatcher)
+
+
+    def update(self, token, value):
+        self.respond(token, body={'id' : 'temp', 'current_value' : value})
+
+
+    def test_SubscriptionUpdate(self):
+        updates = []
+        token, subscribed = self.subscribe('/feeds/1', updates.append)
+        self.respond(token, body={'id' : 1, 'datastreams' : [{'id' : 'temp', 'current_value' : '21'}]})
+        self.assertEqual(updates, [])
+        self.assertEqual(self.dispatcher.queueDepth(token), 1)
+        self.threadpool.runOne()
+        self.assertEqual(updates[0].datastreams['temp'].current_value, '21')
+        self.assertEqual(self.dispatcher.queueDepth(token), 0)
+
+
+    def test_SubscriptionStream(self):
+        d = self.client.subscribe_stream('/feeds/1/datastreams/temp')
+        self.respond(self.protocol.sent[-1]['token'])
+        token, stream = self.successResultOf(d)
+        waiting = stream.get()
+        self.update(token, '21')
+        self.assertNoResult(waiting)
+        self.threadpool.runOne()
+        self.assertEqual(self.successResultOf(waiting).current_value, '21')
+
+
+    def test_PerTokenOrdering(self):
+        first, second = [], []
+        token1 = self.subscribe('/feeds/1/datastreams/temp', first.append)[0]
+        token2 = self.subscribe('/feeds/2/datastreams/temp', second.append)[0]
+        self.update(token1, '1')
+        self.update(token1, '2')
+        self.update(token2, 'a')
+
+        # only one update per token is handed to the pool at a time
+        self.assertEqual(len(self.threadpool.work), 2)
+        self.assertEqual(self.dispatcher.queueDepths(), {token1 : 2, token2 : 1})
+
+        self.threadpool.runOne(1)
+        self.assertEqual([d.current_value for d in second], ['a'])
+        self.threadpool.runOne(0)
+        self.threadpool.runOne(0)
+        self.assertEqual([d.current_value for d in first], ['1', '2'])
+        self.assertEqual(self.dispatcher.queueDepths(), {})
+
+
+    def test_Backpressure(self):
+        token = self.subscribe('/feeds/1/datastreams/temp', lambda x: None)[0]
+        for value in range(4):
+            self.update(token, str(value))
+        self.assertTrue(self.protocol.transport.paused)
+        self.threadpool.runOne()
+        self.assertTrue(self.protocol.transport.paused)
+        self.threadpool.runOne()
+        self.assertFalse(self.protocol.transport.paused)
+
+
+    def test_HandlerErrorDoesNotStallQueue(self):
+        updates = []
+        def handler(datastream):
+            updates.append(datastream)
+            raise Exception("handler failure")
+        token = self.subscribe('/feeds/1/datastreams/temp', handler)[0]
+        self.update(token, '1')
+        self.update(token, '2')
+        self.threadpool.runOne()
+        self.threadpool.runOne()
+        self.assertEqual(len(updates), 2)
+
+
+    def test_Conflation(self):
+        updates = []
+        token = self.subscribe('/feeds/1', updates.append, conflate=True)[0]
+        def update(*datastreams):
+            body = {'id' : 1, 'datastreams' : [{'id' : i, 'current_value' : v} for i, v in datastreams]}
+            self.respond(token, body=body)
+        update(('a', '1'), ('b', '1'))
+        update(('a', '2'))
+        update(('a', '3'), ('c', '3'))
+        update(('b', '4'))
+
+        # the first update is being processed, the rest are merged into one
+        self.assertEqual(self.dispatcher.queueDepth(token), 2)
+        self.assertEqual(self.client.subscriptionHandlers[token].dropped, 2)
+        self.threadpool.runOne()
+        self.threadpool.runOne()
+        self.assertEqual(len(updates), 2)
+        latest = dict([(k, d.current_value) for k, d in updates[1].datastreams.items()])
+        self.assertEqual(latest, {'a' : '3', 'b' : '4', 'c' : '3'})
+
+
+    def test_PassthroughBytes(self):
+        updates = []
+        token = self.subscribe('/feeds/1', updates.append,
+                               passthrough=txpachube.client.Subscription.PassthroughBytes)[0]
+        msg = '{"body": {"id": 1, "datastreams": [{"id": "a", "current_value": "1"}]}, "resource": "/feeds/1", "token": "%s"}' % token
+        self.client._messageHandler(msg)
+        self.threadpool.runOne()
+        self.assertEqual(updates, ['{"id": 1, "datastreams": [{"id": "a", "current_value": "1"}]}'])
+
+
+    def test_PassthroughDict(self):
+        updates = []
+        token = self.subscribe('/feeds/1', updates.append,
+                               passthrough=txpachube.client.Subscription.PassthroughDict)[0]
+        body = {'id' : 1, 'datastreams' : [{'id' : 'a', 'current_value' : '1'}]}
+        self.respond(token, body=body)
+        self.threadpool.runOne()
+        self.assertEqual(updates, [body])
+
+
+    def test_SelectedDatastreams(self):
+        updates = []
+        token = self.subscribe('/feeds/1', updates.append, datastreams=['a', 'c'])[0]
+        body = {'id' : 1, 'datastreams' : [{'id' : i, 'current_value' : '1'} for i in 'abc']}
+        self.respond(token, body=body)
+        self.threadpool.runOne()
+        self.assertEqual(sorted(updates[0].datastreams.keys()), ['a', 'c'])
+
+
+    def test_InvalidPassthroughOptions(self):
+        d = self.client.subscribe('/feeds/1', lambda x: None, conflate=True,
+                                  passthrough=txpachube.client.Subscription.PassthroughBytes)
+        self.failureResultOf(d)
+        self.assertEqual(self.protocol.sent, [])
+
+
+    def test_Diff(self):
+        updates = []
+        token = self.subscribe('/feeds/1', updates.append, diff=True)[0]
+        def update(*datastreams):
+            body = {'id' : 1, 'datastreams' : [{'id' : i, 'current_value' : v, 'at' : t} for i, v, t in datastreams]}
+            self.respond(token, body=body)
+            self.threadpool.runOne()
+        update(('a', '1', 't1'), ('b', '1', 't1'))
+        update(('a', '1', 't2'), ('b', '2', 't2'))
+        update(('a', '1', 't3'))
+
+        Change = txpachube.client.DatastreamChange
+        self.assertEqual(updates, [[Change('a', None, '1', 't1'), Change('b', None, '1', 't1')],
+                                   [Change('b', '1', '2', 't2')]])
@@ -0,0 +1,1010 @@
+#!/usr/bin/env python
+
+#
+# This script provides test cases for the request path of the REST client
+# that can be run without a connection to the Pachube service. The web
+# agent is replaced by a fake agent that returns canned responses.
+#
+import json
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+try:
+    import txpachube
+    import txpachube.client
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import os
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+    import txpachube.client
+import txpachube.blocking
+import txpachube.breaker
+import txpachube.decode
+import txpachube.encoder
+import txpachube.history
+import txpachube.instrument
+import txpachube.interning
+import txpachube.ratelimit
+import txpachube.retry
+import txpachube.store
+import txpachube.sync
+import txpachube.tenant
+
+
+
+class FakeResponse(object):
+    """ Stands in for a twisted.web.client.Response """
+
+    def __init__(self, code=200, body="", headers=None):
+        self.code = code
+        self.phrase = "Phrase"
+        self.headers = Headers(headers or {})
+        self.body = body
+        self.length = len(body)
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+
+class FakeBodyTransport(object):
+    """ Stands in for the transport a response body is delivered over """
+
+    def __init__(self):
+        self.stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+
+class StalledResponse(FakeResponse):
+    """ A response whose body delivery starts but never completes """
+
+    def deliverBody(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(FakeBodyTransport())
+        protocol.dataReceived(self.body)
+
+
+
+class FakeAgent(object):
+    """
+    Stands in for a twisted.web.client.Agent. Each request is answered with
+    the next queued result, which is either a FakeResponse, an exception or
+    a Deferred that is returned as is.
+    """
+
+    def __init__(self, results=None):
+        self.results = list(results or [])
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        self.requests.append((method, uri, headers, bodyProducer))
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        if isinstance(result, defer.Deferred):
+            return result
+        return defer.succeed(result)
+
+
+
+ENVIRONMENT_JSON = '{"id" : 1, "title" : "test", "datastreams" : [{"id" : "temp", "current_value" : "21"}]}'
+
+
+
+class ClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.agent = FakeAgent()
+        self.client = self.makeClient()
+        self.client.agent = self.agent
+        self.client.clock = self.clock
+
+
+    def makeClient(self):
+        return txpachube.client.Client(api_key="key", feed_id="1")
+
+
+
+class RequestTestCase(ClientTestCase):
+
+    def test_GetEndpoint(self):
+        getEndpoint = txpachube.client.getEndpoint
+        self.assertEqual(getEndpoint("https://api.pachube.com/v2/feeds.json?per_page=5"), 'feeds')
+        self.assertEqual(getEndpoint("https://api.pachube.com/v2/feeds/1/datastreams/temp.json"), 'datastreams')
+        self.assertEqual(getEndpoint("https://api.pachube.com/v2/feeds/1/datastreams/temp/datapoints/2012-02-22T11:22:31Z"), 'datapoints')
+        self.assertEqual(getEndpoint("https://api.pachube.com/v2/keys/abc"), 'keys')
+
+
+    def test_ReadFeed(self):
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        environment = self.successResultOf(self.client.read_feed())
+        self.assertEqual(environment.datastreams['temp'].current_value, '21')
+        method, uri, headers, bodyProducer = self.agent.requests[0]
+        self.assertEqual(method, 'GET')
+        self.assertEqual(uri, 'https://api.pachube.com/v2/feeds/1.json')
+        self.assertEqual(headers.getRawHeaders('X-PachubeApiKey'), ['key'])
+
+
+    def test_RequestTemplates(self):
+        templates = self.client.templates
+        self.assertEqual(templates.url('datapoint', ('1', 'temp', '2012-02-22T11:22:31Z', 'json')),
+                         'https://api.pachube.com/v2/feeds/1/datastreams/temp/datapoints/2012-02-22T11:22:31Z.json')
+        self.assertEqual(templates.url('feeds', ('json',), {'per_page' : 5}),
+                         'https://api.pachube.com/v2/feeds.json?per_page=5')
+        headers = templates.headers('key')
+        self.assertIdentical(templates.headers('key'), headers)
+        self.assertEqual(headers.getRawHeaders('User-Agent'), ['txpachube Client'])
+        self.assertEqual(templates.headers('other').getRawHeaders('X-PachubeApiKey'), ['other'])
+
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON), FakeResponse(body=ENVIRONMENT_JSON)])
+        self.client.read_feed()
+        self.client.read_feed()
+        self.assertIdentical(self.agent.requests[0][2], self.agent.requests[1][2])
+
+
+    def test_DictHeaders(self):
+        self.agent.results.append(FakeResponse(code=200))
+        d = self.client._get('https://api.pachube.com/v2/feeds/1.json', {'X-PachubeApiKey' : 'key'})
+        self.successResultOf(d)
+        headers = self.agent.requests[0][2]
+        self.assertEqual(headers.getRawHeaders('X-PachubeApiKey'), ['key'])
+        self.assertEqual(headers.getRawHeaders('User-Agent'), ['txpachube Client'])
+
+
+    def test_StructureBodyProducer(self):
+        environment = txpachube.Environment()
+        environment.setCurrentValue('temp', '22')
+        producer = txpachube.encoder.StructureBodyProducer(environment)
+        self.agent.results.append(FakeResponse(code=200))
+        self.assertTrue(self.successResultOf(self.client.update_feed(data=producer)))
+        method, uri, headers, bodyProducer = self.agent.requests[0]
+        self.assertIdentical(bodyProducer, producer)
+        written = []
+        bodyProducer.startProducing(type('Consumer', (object,), {'write' : lambda self, data: written.append(data)})())
+        self.assertEqual(len(written[0]), bodyProducer.length)
+        self.assertEqual(json.loads(written[0])['datastreams'], [{'id' : 'temp', 'current_value' : '22'}])
+
+
+    def test_NumericValues(self):
+        self.client.numeric_values = 'float'
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        environment = self.successResultOf(self.client.read_feed())
+        self.assertEqual(environment.datastreams['temp'].current_value + 1, 22)
+
+
+    def test_InternTable(self):
+        self.client.intern_table = txpachube.interning.InternTable()
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON), FakeResponse(body=ENVIRONMENT_JSON)])
+        first = self.successResultOf(self.client.read_feed())
+        second = self.successResultOf(self.client.read_feed())
+        self.assertIdentical(first.datastreams['temp'].id, second.datastreams['temp'].id)
+
+
+    def test_RequestFailurePropagates(self):
+        self.agent.results.append(error.ConnectionRefusedError())
+        self.failureResultOf(self.client.read_feed(), error.ConnectionRefusedError)
+
+
+
+class RetryTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.policy = txpachube.retry.RetryPolicy(max_retries=2, base_delay=1.0, jitter=0.0, clock=self.clock)
+        return txpachube.client.Client(api_key="key", feed_id="1", retry_policy=self.policy)
+
+
+    def test_RetryServerError(self):
+        self.agent.results.extend([FakeResponse(code=503), FakeResponse(code=502), FakeResponse(body=ENVIRONMENT_JSON)])
+        d = self.client.read_feed()
+        self.clock.advance(1.0)
+        self.assertNoResult(d)
+        self.clock.advance(2.0)
+        self.assertEqual(self.successResultOf(d).id, 1)
+        stats = self.policy.stats['feeds']
+        self.assertEqual((stats.requests, stats.retries, stats.added_latency), (1, 2, 3.0))
+
+
+    def test_RetryConnectionError(self):
+        self.agent.results.extend([error.ConnectionRefusedError(), FakeResponse(body=ENVIRONMENT_JSON)])
+        d = self.client.read_feed()
+        self.clock.advance(1.0)
+        self.assertEqual(self.successResultOf(d).id, 1)
+
+
+    def test_RetryAfter(self):
+        self.agent.results.extend([FakeResponse(code=429, headers={'Retry-After' : ['10']}),
+                                   FakeResponse(code=201, headers={'Location' : ['/v2/feeds/2']})])
+        # 429 responses are retried even for non-idempotent requests
+        d = self.client.create_feed(data="{}")
+        self.clock.advance(9.0)
+        self.assertNoResult(d)
+        self.clock.advance(1.0)
+        self.assertEqual(self.successResultOf(d), '2')
+
+
+    def test_PostNotRetriedOnServerError(self):
+        self.agent.results.append(FakeResponse(code=500))
+        d = self.client.create_feed(data="{}")
+        self.failureResultOf(d)
+        self.assertEqual(len(self.agent.requests), 1)
+
+
+    def test_RetriesExhausted(self):
+        self.agent.results.extend([FakeResponse(code=503)] * 3)
+        d = self.client.update_feed(data="{}")
+        self.clock.advance(1.0)
+        self.clock.advance(2.0)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(self.policy.stats['feeds'].exhausted, 1)
+
+
+    def test_RetryBudget(self):
+        self.policy.budget = txpachube.retry.RetryBudget(ratio=0.0, min_retries=1, clock=self.clock)
+        self.agent.results.extend([FakeResponse(code=503)] * 3)
+        d = self.client.update_feed(data="{}")
+        self.clock.advance(1.0)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(self.policy.stats['feeds'].budget_exceeded, 1)
+
+
+
+class RateLimitTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.limiter = txpachube.ratelimit.RateLimiter(limits={txpachube.ratelimit.Read : (1.0, 2),
+                                                               txpachube.ratelimit.Write : (0.5, 1)},
+                                                       clock=self.clock)
+        return txpachube.client.Client(api_key="key", feed_id="1", rate_limiter=self.limiter)
+
+
+    def test_RequestsDelayedNotRejected(self):
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON) for i in range(4)])
+        results = [self.client.read_feed() for i in range(4)]
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertNoResult(results[2])
+        self.clock.advance(1.0)
+        self.assertEqual(len(self.agent.requests), 3)
+        self.clock.advance(1.0)
+        for d in results:
+            self.assertEqual(self.successResultOf(d).id, 1)
+
+
+    def test_SeparateBuckets(self):
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON) for i in range(4)])
+        self.client.read_feed()
+        self.client.update_feed(data="{}")
+        self.client.read_feed(api_key="other")
+        d = self.client.update_feed(data="{}")
+        self.assertEqual(len(self.agent.requests), 3)
+        self.assertEqual(self.limiter.levels(), {("key", txpachube.ratelimit.Read) : 1.0,
+                                                 ("key", txpachube.ratelimit.Write) : 0.0,
+                                                 ("other", txpachube.ratelimit.Read) : 1.0})
+        self.clock.advance(2.0)
+        self.assertEqual(len(self.agent.requests), 4)
+
+
+    def test_CancelWaitingRequest(self):
+        bucket = txpachube.ratelimit.TokenBucket(1.0, 1, clock=self.clock)
+        bucket.acquire()
+        d = bucket.acquire()
+        self.assertEqual(bucket.waiting, 1)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(bucket.waiting, 0)
+
+
+    def test_InvalidRate(self):
+        self.assertRaises(Exception, txpachube.ratelimit.TokenBucket, 0, 1, clock=self.clock)
+        self.assertRaises(Exception, txpachube.ratelimit.RateLimiter, {txpachube.ratelimit.Read : (0, 1)})
+        limiter = txpachube.ratelimit.RateLimiter(clock=self.clock)
+        self.assertRaises(Exception, limiter.setLimits, "key", {txpachube.ratelimit.Write : (-1.0, 1)})
+
+
+
+class CircuitBreakerTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.breakers = txpachube.breaker.CircuitBreakers(window=4, min_requests=4, error_rate=0.5,
+                                                          latency=5.0, reset_timeout=10.0, clock=self.clock)
+        self.changes = []
+        self.breakers.addObserver(lambda *change: self.changes.append(change))
+        return txpachube.client.Client(api_key="key", feed_id="1", circuit_breakers=self.breakers)
+
+
+    def test_OpensOnErrorRate(self):
+        self.agent.results.extend([FakeResponse(code=500), FakeResponse(body=ENVIRONMENT_JSON),
+                                   FakeResponse(code=503), FakeResponse(body=ENVIRONMENT_JSON)])
+        for i in range(4):
+            self.client.read_feed().addErrback(lambda f: None)
+        self.assertEqual(self.breakers.states(), {'feeds' : txpachube.breaker.Open})
+        self.assertEqual(self.changes, [('feeds', txpachube.breaker.Closed, txpachube.breaker.Open)])
+
+        # requests fail fast while the circuit is open
+        self.failureResultOf(self.client.read_feed(), txpachube.breaker.CircuitOpenError)
+        self.assertEqual(len(self.agent.requests), 4)
+
+        # other endpoint families are not affected
+        self.agent.results.append(FakeResponse(body='{"id" : "temp", "current_value" : "21"}'))
+        self.successResultOf(self.client.read_datastream(datastream_id="temp"))
+
+
+    def test_OpensOnLatency(self):
+        breaker = self.breakers.get('feeds')
+        for i in range(4):
+            self.assertTrue(breaker.allowRequest())
+            breaker.record(False, 6.0 if i % 2 else 1.0)
+        self.assertEqual(breaker.state, txpachube.breaker.Open)
+
+
+    def test_HalfOpenProbe(self):
+        self.agent.results.extend([FakeResponse(code=500)] * 4)
+        for i in range(4):
+            self.client.read_feed().addErrback(lambda f: None)
+        self.clock.advance(10.0)
+
+        # one probe is allowed through, a failed probe re-opens the circuit
+        self.agent.results.append(error.ConnectionRefusedError())
+        self.failureResultOf(self.client.read_feed(), error.ConnectionRefusedError)
+        self.failureResultOf(self.client.read_feed(), txpachube.breaker.CircuitOpenError)
+
+        # a successful probe closes it
+        self.clock.advance(10.0)
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        self.successResultOf(self.client.read_feed())
+        self.assertEqual([new for endpoint, old, new in self.changes],
+                         [txpachube.breaker.Open, txpachube.breaker.HalfOpen, txpachube.breaker.Open,
+                          txpachube.breaker.HalfOpen, txpachube.breaker.Closed])
+
+
+    def test_ProbeTakenWhenSent(self):
+        limits = {txpachube.ratelimit.Read : (0.05, 1)}
+        self.client.rate_limiter = txpachube.ratelimit.RateLimiter(limits=limits, clock=self.clock)
+        breaker = self.breakers.get('feeds')
+        breaker._setState(txpachube.breaker.Open)
+        self.clock.advance(10.0)
+        self.agent.results.append(FakeResponse(body='{"id" : "temp", "current_value" : "21"}'))
+        self.successResultOf(self.client.read_datastream(datastream_id="temp"))
+
+        # a request waiting for its rate limit does not hold the probe, so
+        # cancelling it leaves the probe for the next request
+        waiting = self.client.read_feed()
+        self.assertEqual(breaker._probes, 0)
+        waiting.cancel()
+        self.failureResultOf(waiting, defer.CancelledError)
+        self.clock.advance(20.0)
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        self.successResultOf(self.client.read_feed())
+        self.assertEqual(breaker.state, txpachube.breaker.Closed)
+
+
+    def test_EarlierRequestDoesNotSettleProbe(self):
+        breaker = self.breakers.get('feeds')
+        earlier = [defer.Deferred(), defer.Deferred()]
+        self.agent.results.extend(earlier + [FakeResponse(code=500)] * 4)
+        for i in range(6):
+            self.client.read_feed().addErrback(lambda f: None)
+        self.assertEqual(breaker.state, txpachube.breaker.Open)
+        self.clock.advance(10.0)
+        probe = defer.Deferred()
+        self.agent.results.append(probe)
+        self.client.read_feed().addErrback(lambda f: None)
+        self.assertEqual(breaker.state, txpachube.breaker.HalfOpen)
+
+        # requests sent before the circuit opened finish during the probe
+        earlier[0].callback(FakeResponse(body=ENVIRONMENT_JSON))
+        earlier[1].callback(FakeResponse(code=500))
+        self.assertEqual(breaker.state, txpachube.breaker.HalfOpen)
+        self.assertEqual(breaker._probes, 1)
+        probe.callback(FakeResponse(body=ENVIRONMENT_JSON))
+        self.assertEqual(breaker.state, txpachube.breaker.Closed)
+
+
+    def test_TimeoutsOpenCircuit(self):
+        for i in range(4):
+            self.agent.results.append(defer.Deferred(canceller=lambda d: None))
+            d = self.client.read_feed(timeout=5.0)
+            self.clock.advance(5.0)
+            self.failureResultOf(d, error.TimeoutError)
+        self.assertEqual(self.breakers.states(), {'feeds' : txpachube.breaker.Open})
+
+        # a probe that times out re-opens the circuit
+        self.clock.advance(10.0)
+        self.agent.results.append(defer.Deferred(canceller=lambda d: None))
+        d = self.client.read_feed(timeout=5.0)
+        self.clock.advance(5.0)
+        self.failureResultOf(d, error.TimeoutError)
+        self.assertEqual(self.breakers.states(), {'feeds' : txpachube.breaker.Open})
+
+
+    def test_CancelledProbe(self):
+        breaker = self.breakers.get('feeds')
+        breaker._setState(txpachube.breaker.Open)
+        self.clock.advance(10.0)
+        self.agent.results.append(defer.Deferred(canceller=lambda d: None))
+        d = self.client.read_feed()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        # the probe is released without closing the circuit
+        self.assertEqual(breaker.state, txpachube.breaker.HalfOpen)
+        self.assertEqual(breaker._probes, 0)
+        self.agent.results.append(FakeResponse(code=500))
+        self.client.read_feed().addErrback(lambda f: None)
+        self.assertEqual(breaker.state, txpachube.breaker.Open)
+
+
+    def test_ProbeLimit(self):
+        breaker = self.breakers.get('feeds')
+        breaker._setState(txpachube.breaker.Open)
+        self.clock.advance(10.0)
+        self.assertTrue(breaker.allowRequest())
+        self.assertFalse(breaker.allowRequest())
+
+
+
+class TimeoutTestCase(ClientTestCase):
+
+    def makeClient(self):
+        return txpachube.client.Client(api_key="key", feed_id="1", timeout=10.0)
+
+
+    def test_DefaultTimeoutCancelsRequest(self):
+        cancelled = []
+        self.agent.results.append(defer.Deferred(canceller=cancelled.append))
+        d = self.client.read_feed()
+        self.clock.advance(9.0)
+        self.assertNoResult(d)
+        self.clock.advance(1.0)
+        self.failureResultOf(d, error.TimeoutError)
+        self.assertEqual(len(cancelled), 1)
+
+
+    def test_PerCallTimeout(self):
+        self.agent.results.append(defer.Deferred(canceller=lambda d: None))
+        d = self.client.update_feed(data="{}", timeout=2.0)
+        self.clock.advance(2.0)
+        self.failureResultOf(d, error.TimeoutError)
+
+
+    def test_TimeoutCancelsBodyDelivery(self):
+        response = StalledResponse(body=ENVIRONMENT_JSON[:10])
+        self.agent.results.append(response)
+        d = self.client.read_feed()
+        self.clock.advance(10.0)
+        self.failureResultOf(d, error.TimeoutError)
+        self.assertTrue(response.protocol.transport.stopped)
+        # the connection closing after the abort is ignored
+        response.protocol.connectionLost(failure.Failure(error.ConnectionAborted()))
+
+
+    def test_CallerCancellation(self):
+        response = StalledResponse()
+        self.agent.results.append(response)
+        d = self.client.read_feed()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertTrue(response.protocol.transport.stopped)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_BodyFailure(self):
+        response = StalledResponse()
+        self.agent.results.append(response)
+        d = self.client.read_feed()
+        response.protocol.connectionLost(failure.Failure(error.ConnectionLost()))
+        self.failureResultOf(d, error.ConnectionLost)
+
+
+
+class InstrumentationTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.sink = txpachube.instrument.HistogramSink()
+        instrumentation = txpachube.instrument.Instrumentation(sinks=[self.sink], clock=self.clock)
+        return txpachube.client.Client(api_key="key", feed_id="1", instrumentation=instrumentation)
+
+
+    def test_RequestPhases(self):
+        headers = defer.Deferred()
+        response = StalledResponse(body=ENVIRONMENT_JSON)
+        self.agent.results.append(headers)
+        d = self.client.read_feed()
+        self.clock.advance(0.5)
+        headers.callback(response)
+        self.clock.advance(0.25)
+        response.protocol.connectionLost(failure.Failure(ResponseDone()))
+        self.successResultOf(d)
+
+        summary = self.sink.summary()
+        def value(metric):
+            result = summary[(metric, 'GET', 'feeds')]
+            self.assertEqual(result['count'], 1)
+            return result['total']
+        self.assertEqual(value(txpachube.instrument.Headers_Time), 0.5)
+        self.assertEqual(value(txpachube.instrument.Body_Time), 0.25)
+        self.assertEqual(value(txpachube.instrument.Total_Time), 0.75)
+        self.assertEqual(value(txpachube.instrument.Decode_Time), 0.0)
+        self.assertEqual(value(txpachube.instrument.Request_Bytes), 0)
+        self.assertEqual(value(txpachube.instrument.Response_Bytes), len(ENVIRONMENT_JSON))
+
+
+    def test_RequestBytes(self):
+        self.agent.results.append(FakeResponse())
+        self.client.update_datastream(datastream_id="temp", data='{"current_value" : "1"}')
+        self.assertEqual(self.sink.histograms[(txpachube.instrument.Request_Bytes, 'PUT', 'datastreams')].total, 23)
+
+
+    def test_DecodeMethod(self):
+        d = self.client._decodeStructure(ENVIRONMENT_JSON, txpachube.DataFormats.JSON, txpachube.View_Feed_Msg, "POST")
+        self.successResultOf(d)
+        self.assertEqual(self.sink.histograms.keys(), [(txpachube.instrument.Decode_Time, 'POST', 'feeds')])
+
+
+    def test_FailingSinkIgnored(self):
+        class BrokenSink(object):
+            def record(self, *args):
+                raise Exception("broken")
+        self.client.instrumentation.addSink(BrokenSink())
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        self.successResultOf(self.client.read_feed())
+
+
+    def test_Histogram(self):
+        histogram = txpachube.instrument.Histogram(max_samples=10)
+        for value in range(1, 21):
+            histogram.add(value)
+        summary = histogram.summary()
+        self.assertEqual((summary['count'], summary['total'], summary['min'], summary['max']), (20, 210.0, 11, 20))
+        self.assertEqual(histogram.percentile(50), 16)
+
+
+    def test_StatsdFormat(self):
+        sink = txpachube.instrument.StatsdSink(prefix="pachube")
+        self.addCleanup(sink.socket.close)
+        self.assertEqual(sink.format(txpachube.instrument.Headers_Time, 0.0125, 'GET', 'feeds'),
+                         "pachube.headers_time.get.feeds:12.500|ms")
+        self.assertEqual(sink.format(txpachube.instrument.Response_Bytes, 120, 'GET', 'feeds'),
+                         "pachube.response_bytes.get.feeds:120|c")
+
+
+
+class HistoryTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.store = txpachube.store.TimeSeriesStore(segment_size=2)
+        return txpachube.client.Client(api_key="key", feed_id="1", store=self.store)
+
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.clock.advance(txpachube.store.parseTimestamp('2012-01-02T00:00:00Z'))
+
+
+    def history(self, *points):
+        body = {'id' : 'temp', 'datapoints' : [{'at' : at, 'value' : value} for at, value in points]}
+        return FakeResponse(body=json.dumps(body))
+
+
+    def test_Timestamps(self):
+        parse = txpachube.store.parseTimestamp
+        self.assertEqual(parse('2012-01-01T00:00:00Z'), 1325376000)
+        self.assertEqual(parse('2012-01-01T01:00:00.5+01:00'), 1325376000.5)
+        self.assertEqual(txpachube.store.formatTimestamp(1325376000.5), '2012-01-01T00:00:00.500000Z')
+
+
+    def test_ReadDatastreamStoresHistory(self):
+        self.agent.results.append(self.history(('2012-01-01T00:10:00Z', '1'), ('2012-01-01T00:20:00Z', '2')))
+        parameters = {'start' : '2012-01-01T00:00:00Z', 'end' : '2012-01-01T01:00:00Z'}
+        self.successResultOf(self.client.read_datastream(datastream_id="temp", parameters=parameters))
+        start = txpachube.store.parseTimestamp(parameters['start'])
+        self.assertEqual(self.store.gaps('1', 'temp', start, start + 3600), [])
+
+        # downsampled history is not stored
+        self.agent.results.append(self.history(('2012-01-01T03:00:00Z', '5')))
+        parameters = {'start' : '2012-01-01T02:00:00Z', 'end' : '2012-01-01T04:00:00Z', 'interval' : 60}
+        self.successResultOf(self.client.read_datastream(datastream_id="temp", parameters=parameters))
+        self.assertEqual(len(self.store.query('1', 'temp', 0, self.clock.seconds())), 2)
+
+
+    def test_OnlyGapsFetched(self):
+        self.agent.results.append(self.history(('2012-01-01T00:10:00Z', '1'), ('2012-01-01T00:20:00Z', '2')))
+        parameters = {'start' : '2012-01-01T00:00:00Z', 'end' : '2012-01-01T01:00:00Z'}
+        self.successResultOf(self.client.read_datastream(datastream_id="temp", parameters=parameters))
+
+        self.agent.results.append(self.history(('2012-01-01T01:30:00Z', '3')))
+        d = self.client.read_datastream_history(datastream_id="temp", start='2012-01-01T00:00:00Z',
+                                                end='2012-01-01T02:00:00Z')
+        datastream = self.successResultOf(d)
+        self.assertEqual([dp.value for dp in datastream.datapoints], ['1', '2', '3'])
+        self.assertEqual(len(self.agent.requests), 2)
+        uri = self.agent.requests[1][1]
+        self.assertTrue('start=2012-01-01T01%3A00%3A00.000000Z' in uri)
+        self.assertTrue('end=2012-01-01T02%3A00%3A00.000000Z' in uri)
+
+        # the whole range is now answered locally
+        self.successResultOf(self.client.read_datastream_history(datastream_id="temp", start='2012-01-01T00:00:00Z',
+                                                                 end='2012-01-01T02:00:00Z'))
+        self.assertEqual(len(self.agent.requests), 2)
+
+
+    def test_LongGapFetchedInWindows(self):
+        self.agent.results.extend([self.history(), self.history()])
+        self.successResultOf(self.client.read_datastream_history(datastream_id="temp", start='2012-01-01T00:00:00Z',
+                                                                 end='2012-01-01T12:00:00Z'))
+        self.assertEqual(len(self.agent.requests), 2)
+
+
+    def test_TruncatedPageContinues(self):
+        points = [('2012-01-01T00:%02d:00Z' % i, str(i)) for i in range(10)]
+        full = self.history(*points)
+        self.patch(txpachube.client, 'Max_Per_Page', len(points))
+        self.agent.results.extend([full, self.history(('2012-01-01T00:30:00Z', 'last'))])
+        d = self.client.read_datastream_history(datastream_id="temp", start='2012-01-01T00:00:00Z',
+                                                end='2012-01-01T01:00:00Z')
+        datastream = self.successResultOf(d)
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertEqual(datastream.datapoints[-1].value, 'last')
+        self.assertTrue('start=2012-01-01T00%3A09%3A00.000000Z' in self.agent.requests[1][1])
+
+
+    def test_Segments(self):
+        series = txpachube.store.Series(segment_size=2)
+        series.append([(1, 'a'), (2, 'b'), (3, 'c')])
+        self.assertEqual(len(series._segments), 1)
+        series.append([(4, 'd')])
+        series.append([(0, 'z')])
+        self.assertEqual(len(series._segments), 2)
+        self.assertEqual(series.query(0, 2), [(0, 'z'), (1, 'a'), (2, 'b')])
+        series.cover(0, 2)
+        series.cover(5, 6)
+        self.assertEqual(series.gaps(0, 10), [(2, 5), (6, 10)])
+
+
+
+class SyncTestCase(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.clock.advance(txpachube.store.parseTimestamp('2012-01-01T12:00:00Z'))
+        self.received = []
+        self.checkpoint = txpachube.sync.Checkpoint(self.mktemp())
+
+
+    def makeSync(self, datastreams=(("1", "temp"),), **kwargs):
+        return txpachube.sync.IncrementalSync(self.client, datastreams, checkpoint=self.checkpoint,
+                                              handler=lambda *args: self.received.append(args),
+                                              clock=self.clock, **kwargs)
+
+
+    def history(self, *points):
+        body = {'id' : 'temp', 'datapoints' : [{'at' : at, 'value' : value} for at, value in points]}
+        return FakeResponse(body=json.dumps(body))
+
+
+    def test_FetchesOnlyNewerDatapoints(self):
+        self.checkpoint.set("1", "temp", '2012-01-01T11:00:00Z')
+        # find_previous returns the datapoint at the watermark as well
+        self.agent.results.append(self.history(('2012-01-01T11:00:00Z', '1'), ('2012-01-01T11:30:00Z', '2')))
+        result = self.successResultOf(self.makeSync().run())
+        self.assertEqual(result.synced, {"1/temp" : 1})
+        self.assertEqual([dp.value for dp in self.received[0][2]], ['2'])
+        uri = self.agent.requests[0][1]
+        self.assertTrue('start=2012-01-01T11%3A00%3A00Z' in uri)
+        self.assertTrue('find_previous=true' in uri)
+
+        # the newest datapoint read is checkpointed and a second run starts from it
+        self.assertEqual(txpachube.sync.Checkpoint(self.checkpoint.path).get("1", "temp"),
+                         '2012-01-01T11:30:00Z')
+        self.clock.advance(60)
+        self.agent.results.append(self.history(('2012-01-01T11:30:00Z', '2'), ('2012-01-01T11:45:00Z', '3')))
+        result = self.successResultOf(self.makeSync().run())
+        self.assertTrue('start=2012-01-01T11%3A30%3A00Z' in self.agent.requests[1][1])
+        # a datapoint stored late, after the end of the first run, is found
+        self.assertEqual(result.synced, {"1/temp" : 1})
+        self.assertEqual([dp.value for dp in self.received[1][2]], ['3'])
+
+
+    def test_FullPageContinuesFromLastDatapoint(self):
+        self.patch(txpachube.client, 'Max_Per_Page', 2)
+        self.checkpoint.set("1", "temp", '2012-01-01T11:00:00Z')
+        self.agent.results.extend([self.history(('2012-01-01T11:10:00Z', '1'), ('2012-01-01T11:20:00Z', '2')),
+                                   self.history(('2012-01-01T11:40:00Z', '3'))])
+        result = self.successResultOf(self.makeSync().run())
+        self.assertEqual(result.synced, {"1/temp" : 3})
+        self.assertTrue('start=2012-01-01T11%3A20%3A00Z' in self.agent.requests[1][1])
+
+
+    def test_DatapointAtStartRead(self):
+        self.agent.results.append(self.history(('2012-01-01T11:00:00Z', '1')))
+        result = self.successResultOf(self.makeSync(initial_start='2012-01-01T11:00:00Z').run())
+        self.assertEqual(result.synced, {"1/temp" : 1})
+        self.assertEqual(self.checkpoint.get("1", "temp"), '2012-01-01T11:00:00Z')
+
+        # and not read again by the next run
+        self.agent.results.append(self.history(('2012-01-01T11:00:00Z', '1')))
+        result = self.successResultOf(self.makeSync().run())
+        self.assertEqual(result.synced, {"1/temp" : 0})
+        self.assertEqual(self.checkpoint.get("1", "temp"), '2012-01-01T11:00:00Z')
+
+
+    def test_Lag(self):
+        self.checkpoint.set("1", "temp", '2012-01-01T11:00:00Z')
+        self.agent.results.append(self.history())
+        self.successResultOf(self.makeSync(lag=600).run())
+        self.assertTrue('end=2012-01-01T11%3A50%3A00.000000Z' in self.agent.requests[0][1])
+
+
+    def test_ConcurrentDatastreams(self):
+        deferreds = [defer.Deferred() for i in range(3)]
+        self.agent.results.extend(deferreds)
+        datastreams = [("1", "a"), ("1", "b"), ("2", "c")]
+        d = self.makeSync(datastreams=datastreams, concurrency=2,
+                          initial_start='2012-01-01T11:00:00Z').run()
+        self.assertEqual(len(self.agent.requests), 2)
+        deferreds[0].callback(self.history())
+        self.assertEqual(len(self.agent.requests), 3)
+        deferreds[1].errback(error.ConnectionRefusedError())
+        deferreds[2].callback(self.history())
+        result = self.successResultOf(d)
+        self.assertEqual(sorted(result.synced.keys()), ["1/a", "2/c"])
+        self.assertEqual(list(result.failed.keys()), ["1/b"])
+        self.assertEqual(self.checkpoint.get("1", "b"), None)
+
+
+
+class DownsampleTestCase(ClientTestCase):
+
+    def history(self, *points):
+        body = {'id' : 'temp', 'datapoints' : [{'at' : at, 'value' : value} for at, value in points]}
+        return FakeResponse(body=json.dumps(body))
+
+
+    def test_PlanPicksCoarsestInterval(self):
+        day = 86400
+        plan = txpachube.history.planQuery(0, 30 * day, 500)
+        # 30 days over 500 points is one point every 5184s
+        self.assertEqual(plan.interval, 3600)
+        self.assertEqual(plan.windows, [(0, 30 * day)])
+
+        plan = txpachube.history.planQuery(0, 2 * 365 * day, 100)
+        self.assertEqual(plan.interval, 86400)
+        self.assertEqual(len(plan.windows), 2)
+
+        # the page size limits the window too
+        plan = txpachube.history.planQuery(0, day, 1440)
+        self.assertEqual(plan.interval, 60)
+        self.assertEqual(plan.windows, [(0, 60000), (60000, day)])
+
+        # raw history when even the finest interval is too coarse
+        plan = txpachube.history.planQuery(0, 3600, 1000)
+        self.assertEqual(plan.interval, 0)
+        self.assertFalse('interval_type' in plan.parameters(str)[0])
+
+
+    def test_PlanParameters(self):
+        plan = txpachube.history.planQuery(0, 86400, 24)
+        self.assertEqual(plan.parameters(txpachube.store.formatTimestamp),
+                         [{'start' : '1970-01-01T00:00:00.000000Z', 'end' : '1970-01-02T00:00:00.000000Z',
+                           'interval' : 3600, 'interval_type' : 'discrete', 'per_page' : 1000}])
+
+
+    def test_ReadDownsampled(self):
+        self.agent.results.extend([self.history(('2012-01-01T00:00:00Z', '1'), ('2012-01-01T12:00:00Z', '2')),
+                                   self.history(('2012-01-01T12:00:00Z', '2'), ('2012-01-01T23:59:00Z', '3'))])
+        d = self.client.read_datastream_downsampled(datastream_id="temp", start='2012-01-01T00:00:00Z',
+                                                    end='2012-01-02T00:00:00Z', points=1440)
+        datastream = self.successResultOf(d)
+        self.assertEqual([dp.value for dp in datastream.datapoints], ['1', '2', '3'])
+        self.assertEqual(len(self.agent.requests), 2)
+        self.assertTrue('interval=60' in self.agent.requests[0][1])
+        self.assertTrue('interval_type=discrete' in self.agent.requests[0][1])
+
+
+
+class TenantTestCase(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.limiter = txpachube.ratelimit.RateLimiter(limits={}, clock=self.clock)
+        self.resolver = txpachube.tenant.KeyResolver({1 : 'a', 2 : 'b'})
+        self.tenants = txpachube.tenant.TenantClient(self.resolver, client=self.client, rate_limiter=self.limiter,
+                                                     concurrency=1, clock=self.clock)
+
+
+    def test_ResolvesKey(self):
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        environment = self.successResultOf(self.tenants.read_feed(feed_id=2))
+        self.assertEqual(environment.id, 1)
+        method, uri, headers, bodyProducer = self.agent.requests[0]
+        self.assertEqual(uri, 'https://api.pachube.com/v2/feeds/2.json')
+        self.assertEqual(headers.getRawHeaders('X-PachubeApiKey'), ['b'])
+
+
+    def test_MultipleRequestMethodsUnavailable(self):
+        # each would make several requests for a single rate limit token
+        for method in ['read_datastream_history', 'read_datastream_downsampled']:
+            self.assertFalse(method in txpachube.tenant.Tenant_Methods)
+            self.assertRaises(AttributeError, getattr, self.tenants, method)
+        self.assertTrue('read_datastream' in txpachube.tenant.Tenant_Methods)
+
+
+    def test_UnknownFeed(self):
+        self.failureResultOf(self.tenants.read_feed(feed_id=3))
+        self.resolver.default = 'c'
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        self.successResultOf(self.tenants.read_feed(feed_id=3))
+        self.assertEqual(self.agent.requests[0][2].getRawHeaders('X-PachubeApiKey'), ['c'])
+
+
+    def test_FairQueuing(self):
+        responses = [defer.Deferred() for i in range(4)]
+        self.agent.results.extend(responses)
+        results = [self.tenants.read_feed(feed_id=1) for i in range(3)]
+        results.append(self.tenants.read_feed(feed_id=2))
+        self.assertEqual(self.tenants.scheduler.queued('a'), 2)
+        self.assertEqual(self.tenants.scheduler.queued(), 3)
+        for response in responses:
+            response.callback(FakeResponse(body=ENVIRONMENT_JSON))
+        keys = [headers.getRawHeaders('X-PachubeApiKey')[0] for method, uri, headers, bodyProducer in self.agent.requests]
+        self.assertEqual(keys, ['a', 'a', 'b', 'a'])
+        for d in results:
+            self.successResultOf(d)
+
+
+    def test_CancelQueued(self):
+        self.agent.results.extend([defer.Deferred(), FakeResponse(body=ENVIRONMENT_JSON)])
+        first = self.tenants.read_feed(feed_id=1)
+        second = self.tenants.read_feed(feed_id=2)
+        second.cancel()
+        self.failureResultOf(second, defer.CancelledError)
+        self.assertEqual(self.tenants.scheduler.queued(), 0)
+        self.assertEqual(len(self.agent.requests), 1)
+
+
+    def test_PerKeyLimits(self):
+        self.limiter.limits = {txpachube.ratelimit.Read : (1.0, 1)}
+        self.limiter.setLimits('b', {txpachube.ratelimit.Read : (10.0, 5)})
+        self.assertEqual(self.limiter.getBucket('a', 'GET').burst, 1)
+        self.assertEqual(self.limiter.getBucket('b', 'GET').burst, 5)
+        self.tenants.scheduler.concurrency = 10
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON) for i in range(4)])
+        limited = [self.tenants.read_feed(feed_id=1) for i in range(2)]
+        self.successResultOf(limited[0])
+        self.assertNoResult(limited[1])
+        for i in range(2):
+            self.successResultOf(self.tenants.read_feed(feed_id=2))
+        self.clock.advance(1.0)
+        self.successResultOf(limited[1])
+
+
+
+class ImmediateReactor(object):
+    """ Stands in for a reactor running in another thread """
+
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+
+
+class BlockingTestCase(ClientTestCase):
+
+    def setUp(self):
+        ClientTestCase.setUp(self)
+        self.blocking = txpachube.blocking.BlockingClient(client=self.client, reactor=ImmediateReactor())
+
+
+    def test_BlockingCall(self):
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        environment = self.blocking.read_feed(feed_id=1)
+        self.assertEqual(environment.datastreams['temp'].current_value, '21')
+
+
+    def test_FailureRaised(self):
+        self.agent.results.append(error.ConnectionRefusedError())
+        self.assertRaises(error.ConnectionRefusedError, self.blocking.read_feed)
+
+
+    def test_UnsupportedCall(self):
+        self.assertRaises(Exception, self.blocking.call, '_sendRequest')
+        self.assertRaises(AttributeError, getattr, self.blocking, 'unknown')
+
+
+    def test_Submit(self):
+        self.agent.results.extend([FakeResponse(body=ENVIRONMENT_JSON), error.ConnectionRefusedError()])
+        future = self.blocking.submit('read_feed', feed_id=1)
+        self.assertEqual(future.result().id, 1)
+        future = self.blocking.submit('read_feed', feed_id=1)
+        self.assertRaises(error.ConnectionRefusedError, future.result)
+
+    if txpachube.blocking.futures is None:
+        test_Submit.skip = "concurrent.futures is not installed"
+
+
+
+class RecordingThreadPool(object):
+    """ Stands in for a ThreadPool, running work immediately and counting it """
+
+    def __init__(self):
+        self.calls = 0
+
+    def callInThreadWithCallback(self, onResult, func, *args, **kw):
+        self.calls += 1
+        try:
+            result = func(*args, **kw)
+        except Exception:
+            onResult(False, failure.Failure())
+        else:
+            onResult(True, result)
+
+
+
+class DecodeTestCase(ClientTestCase):
+
+    def makeClient(self):
+        self.threadpool = RecordingThreadPool()
+        decoder = txpachube.decode.ThreadDecoder(threadpool=self.threadpool, reactor=ImmediateReactor())
+        return txpachube.client.Client(api_key="key", feed_id="1", decoder=decoder,
+                                       decode_threshold=len(ENVIRONMENT_JSON) + 1)
+
+
+    def test_SmallBodyDecodedInline(self):
+        self.agent.results.append(FakeResponse(body=ENVIRONMENT_JSON))
+        self.assertEqual(self.successResultOf(self.client.read_feed()).id, 1)
+        self.assertEqual(self.threadpool.calls, 0)
+
+
+    def test_LargeBodyDecodedInPool(self):
+        body = ENVIRONMENT_JSON + ' '
+        self.agent.results.extend([FakeResponse(body=body), FakeResponse(body='{"id" : ')])
+        environment = self.successResultOf(self.client.read_feed())
+        self.assertEqual(environment.datastreams['temp'].current_value, '21')
+        self.assertEqual(self.threadpool.calls, 1)
+        self.client.decode_threshold = 0
+        self.failureResultOf(self.client.read_feed())
+
+
+    def test_ProcessDecoder(self):
+        decoder = txpachube.decode.ProcessDecoder(processes=1)
+        self.addCleanup(decoder.close)
+        d = decoder.decode(txpachube.View_Feed_Msg, ENVIRONMENT_JSON, txpachube.DataFormats.JSON)
+        d.addCallback(lambda environment: self.assertEqual(environment.datastreams['temp'].current_value, '21'))
+        failed = decoder.decode(txpachube.View_Feed_Msg, '{"id" : ', txpachube.DataFormats.JSON)
+        self.assertFailure(failed, Exception)
+        return defer.gatherResults([d, failed])
+
+
+    def test_ProcessDecoderFailures(self):
+        # the pool processes are forked with the patched function
+        self.patch(txpachube.decode, 'decodeStructure', lambda kind, data, format: lambda: None)
+        decoder = txpachube.decode.ProcessDecoder(processes=1)
+        self.addCleanup(decoder.close)
+        unpicklable = decoder.decode(txpachube.View_Feed_Msg, ENVIRONMENT_JSON, txpachube.DataFormats.JSON)
+        self.assertFailure(unpicklable, Exception)
+        return unpicklable
+
+
+    def test_ProcessDecoderClosed(self):
+        decoder = txpachube.decode.ProcessDecoder(processes=1)
+        decoder.close()
+        self.failureResultOf(decoder.decode(txpachube.View_Feed_Msg, ENVIRONMENT_JSON, txpachube.DataFormats.JSON))
+
+
+    def test_ProcessDecoderTimeout(self):
+        clock = task.Clock()
+        decoder = txpachube.decode.ProcessDecoder(processes=1, timeout=5.0, reactor=clock)
+        self.addCleanup(decoder.close)
+        # stands in for a pool whose process died
+        self.patch(decoder.pool, 'apply_async', lambda *args, **kwargs: None)
+        d = decoder.decode(txpachube.View_Feed_Msg, ENVIRONMENT_JSON, txpachube.DataFormats.JSON)
+        self.assertNoResult(d)
+        clock.advance(5.0)
+        self.failureResultOf(d, error.TimeoutError)
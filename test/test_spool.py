@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+#
+# This script provides test cases for the write-ahead spool that can be
+# run without a connection to the Pachube service. Writes are sent to a
+# fake client that records them.
+#
+import os
+import StringIO
+from twisted.internet import defer, error, task
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web.client import FileBodyProducer, ResponseDone
+from twisted.web.http_headers import Headers
+try:
+    import txpachube
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+import txpachube.client
+import txpachube.encoder
+import txpachube.spool
+
+
+
+class FakeClient(object):
+    """
+    Stands in for a txpachube.client.Client. Each write returns the next
+    queued result, True if there are none.
+    """
+
+    def __init__(self):
+        self.writes = []
+        self.results = []
+
+    def _write(self, method, kwargs):
+        self.writes.append((method, kwargs))
+        if self.results:
+            result = self.results.pop(0)
+            if isinstance(result, Exception):
+                return defer.fail(result)
+            return defer.succeed(result)
+        return defer.succeed(True)
+
+    def create_datapoints(self, **kwargs):
+        return self._write('create_datapoints', kwargs)
+
+    def update_feed(self, **kwargs):
+        return self._write('update_feed', kwargs)
+
+
+
+class FakeResponse(object):
+    """ Stands in for a twisted.web.client.Response with an empty body """
+
+    def __init__(self, code):
+        self.code = code
+        self.phrase = "Phrase"
+        self.headers = Headers()
+        self.length = 0
+
+    def deliverBody(self, protocol):
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+
+class FakeAgent(object):
+    """
+    Stands in for a twisted.web.client.Agent, answering every request with
+    a 200 response. Agent only accepts byte string urls.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        if not isinstance(uri, bytes):
+            return defer.fail(TypeError("url must be bytes, not unicode"))
+        self.requests.append((method, uri, bodyProducer))
+        return defer.succeed(FakeResponse(200))
+
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.spool = txpachube.spool.Spool(self.directory, segment_size=64)
+        self.addCleanup(lambda: self.spool.close())
+
+
+    def reopen(self):
+        self.spool.close()
+        self.spool = txpachube.spool.Spool(self.directory, segment_size=64)
+
+
+    def segments(self):
+        return sorted([n for n in os.listdir(self.directory) if n.endswith(txpachube.spool.Segment_Suffix)])
+
+
+    def test_AppendAndReload(self):
+        sequences = [self.spool.append("record %s" % i) for i in range(5)]
+        self.assertEqual(sequences, [1, 2, 3, 4, 5])
+        self.reopen()
+        self.assertEqual(self.spool.pending(), [(i + 1, "record %s" % i) for i in range(5)])
+        self.assertEqual(self.spool.append("next"), 6)
+
+
+    def test_AcknowledgeInOrder(self):
+        for i in range(4):
+            self.spool.append("record %s" % i)
+        self.spool.acknowledge(2)
+        self.assertEqual(self.spool.acknowledged, 0)
+        self.spool.acknowledge(1)
+        self.assertEqual(self.spool.acknowledged, 2)
+        self.reopen()
+        self.assertEqual([s for s, p in self.spool.pending()], [3, 4])
+
+
+    def test_CompactAcknowledgedSegments(self):
+        for i in range(20):
+            self.spool.append("record %02d" % i)
+        self.assertTrue(len(self.segments()) > 2)
+        for sequence in range(1, 21):
+            self.spool.acknowledge(sequence)
+        # only the active segment is kept
+        self.assertEqual(len(self.segments()), 1)
+        self.reopen()
+        self.assertEqual(self.spool.pending(), [])
+
+
+    def test_TornRecordDiscarded(self):
+        self.spool.append("complete")
+        self.spool.append("torn record")
+        self.spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+        self.reopen()
+        self.assertEqual(self.spool.pending(), [(1, "complete")])
+        self.assertEqual(self.spool.append("next"), 2)
+        self.reopen()
+        self.assertEqual(self.spool.pending(), [(1, "complete"), (2, "next")])
+
+
+
+class SpooledWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = self.mktemp()
+        self.clock = task.Clock()
+        self.client = FakeClient()
+        self.writer = self.makeWriter()
+
+
+    def makeWriter(self, **kwargs):
+        spool = txpachube.spool.Spool(self.directory)
+        writer = txpachube.spool.SpooledWriter(self.client, spool, retry_interval=5.0, clock=self.clock, **kwargs)
+        self.addCleanup(writer.stop)
+        return writer
+
+
+    def test_WriteAcknowledged(self):
+        d = self.writer.create_datapoints(feed_id="1", datastream_id="temp", data='{"datapoints" : []}')
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual(self.client.writes, [('create_datapoints', {'feed_id' : "1", 'datastream_id' : "temp",
+                                                                     'data' : '{"datapoints" : []}'})])
+        self.assertEqual(self.writer.spool.pending(), [])
+
+
+    def test_RetryInOrder(self):
+        self.client.results.extend([error.ConnectionRefusedError(), False])
+        first = self.writer.update_feed(data="1")
+        second = self.writer.update_feed(data="2")
+        self.assertEqual(len(self.client.writes), 1)
+        self.clock.advance(5.0)
+        self.clock.advance(5.0)
+        self.assertTrue(self.successResultOf(first))
+        self.assertTrue(self.successResultOf(second))
+        self.assertEqual([kwargs['data'] for method, kwargs in self.client.writes], ["1", "1", "1", "2"])
+
+
+    def test_ReplayOnRestart(self):
+        self.client.results.append(error.ConnectionRefusedError())
+        self.writer.update_feed(data="1")
+        self.writer.create_datapoints(data="2")
+        self.writer.stop()
+
+        self.client.writes = []
+        writer = self.makeWriter()
+        self.assertEqual(writer.start(), 2)
+        self.assertEqual(self.client.writes, [('update_feed', {'data' : "1"}), ('create_datapoints', {'data' : "2"})])
+        self.assertEqual(writer.spool.pending(), [])
+
+
+    def test_WriteBeforeStart(self):
+        self.client.results.append(error.ConnectionRefusedError())
+        self.writer.update_feed(data="old")
+        self.writer.stop()
+
+        self.client.writes = []
+        writer = self.makeWriter()
+        d = writer.update_feed(data="new")
+        self.assertEqual(writer.start(), 1)
+        self.assertTrue(self.successResultOf(d))
+        self.assertEqual([kwargs['data'] for method, kwargs in self.client.writes], ["old", "new"])
+        self.assertEqual(writer.spool.pending(), [])
+
+
+    def test_ReplayThroughClient(self):
+        self.client.results.append(error.ConnectionRefusedError())
+        self.writer.create_datapoints(feed_id="1", datastream_id=u"temp", data='{"datapoints" : []}')
+        self.writer.stop()
+
+        client = txpachube.client.Client(api_key="key")
+        client.agent = FakeAgent()
+        spool = txpachube.spool.Spool(self.directory)
+        writer = txpachube.spool.SpooledWriter(client, spool, max_attempts=1, clock=self.clock)
+        self.addCleanup(writer.stop)
+        self.assertEqual(writer.start(), 1)
+        self.assertEqual(len(client.agent.requests), 1)
+        self.assertTrue('/feeds/1/datastreams/temp/datapoints' in client.agent.requests[0][1])
+        self.assertEqual(writer.spool.pending(), [])
+
+
+    def test_DiscardAfterMaxAttempts(self):
+        writer = self.makeWriter(max_attempts=2)
+        self.client.results.extend([False, False])
+        d = writer.update_feed(data="bad")
+        self.clock.advance(5.0)
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(writer.spool.pending(), [])
+
+
+    def test_UnsupportedMethod(self):
+        self.assertRaises(Exception, self.writer.write, 'delete_feed', feed_id="1")
+
+
+    def test_StructureData(self):
+        environment = txpachube.Environment()
+        environment.setCurrentValue('temp', '21')
+        self.writer.update_feed(data=environment)
+        self.writer.update_feed(data=txpachube.encoder.StructureBodyProducer(environment))
+        self.assertEqual([kwargs['data'] for method, kwargs in self.client.writes], [environment.encode()] * 2)
+
+        # data that can't be read back is rejected before it is spooled
+        self.assertRaises(Exception, self.writer.update_feed, data=FileBodyProducer(StringIO.StringIO("1")))
+        self.assertRaises(Exception, self.writer.update_feed, data=object())
+        self.assertEqual(len(self.writer.spool.pending()), 0)
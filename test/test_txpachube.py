@@ -21,6 +21,11 @@ except ImportError:
     import sys
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     import txpachube
+import txpachube.builder
+import txpachube.encoder
+import txpachube.interning
+import txpachube.numeric
+import txpachube.profiling
 
 
 
@@ -913,7 +918,252 @@ class DataStructureTestCase(unittest.TestCase):
         pass
     
             
-suite = unittest.TestLoader().loadTestsFromTestCase(DataStructureTestCase)
+class ProfilingTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.fromDict = txpachube.Environment.__dict__['fromDict']
+        self.profiler = txpachube.profiling.StructureProfiler()
+        self.profiler.enable()
+        
+        
+    def test_CollectsStatistics(self):
+        environment = txpachube.Environment()
+        environment.decode(TEST_FEED_JSON)
+        environment.encode(txpachube.DataFormats.XML)
+        
+        stats = self.profiler.stats
+        self.assertEqual(stats[('Environment', 'decode')][0], 1)
+        # __init__ populates the environment using fromDict too
+        self.assertEqual(stats[('Environment', 'fromDict')][0], 2)
+        self.assertEqual(stats[('Environment', 'toXml')][0], 1)
+        self.assertEqual(stats[('Datastream', 'fromDict')][0], len(environment.datastreams))
+        self.assertTrue(stats[('Environment', 'decode')][1] >= stats[('Environment', 'fromDict')][1])
+        self.assertEqual(self.profiler.objects['Environment'], 1)
+        self.assertEqual(self.profiler.objects['Datastream'], len(environment.datastreams))
+        self.assertTrue('Environment' in self.profiler.report())
+        
+        
+    def test_Disable(self):
+        self.profiler.disable()
+        self.assertFalse(self.profiler.enabled)
+        self.assertTrue(txpachube.Environment.__dict__['fromDict'] is self.fromDict)
+        txpachube.Environment().decode(TEST_FEED_JSON)
+        self.assertEqual(self.profiler.stats, {})
+        
+        
+    def test_ReportWhileLocked(self):
+        # a signal handler may interrupt the main thread while it records a call
+        txpachube.Environment().decode(TEST_FEED_JSON)
+        with self.profiler.lock:
+            self.assertTrue('Environment' in self.profiler.report())
+        
+        
+    def tearDown(self):
+        self.profiler.disable()
+        
+        
+            
+class BuilderTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.pool = txpachube.builder.StructurePool(size=4)
+        self.builder = txpachube.builder.UpdateBuilder(pool=self.pool)
+        
+        
+    def test_EncodeMatchesEnvironment(self):
+        environment = txpachube.Environment()
+        for builder_or_environment in [self.builder, environment]:
+            builder_or_environment.setCurrentValue('0', '12')
+            builder_or_environment.setCurrentValue(u'caf\xe9', u'1.5')
+            builder_or_environment.addDatapoint('1', '2012-01-01T00:00:00Z', '3')
+            builder_or_environment.addDatapoint('1', '2012-01-01T00:01:00Z', '4')
+        
+        self.assertEqual(json.loads(self.builder.encode()), json.loads(environment.encode()))
+        self.assertEqual(etree.fromstring(self.builder.encode(txpachube.DataFormats.XML)).tag,
+                         etree.fromstring(environment.encode(txpachube.DataFormats.XML)).tag)
+        self.assertRaises(Exception, self.builder.encode, 'csv')
+        
+        
+    def test_ReusesStructures(self):
+        for i in range(3):
+            self.builder.setCurrentValue('0', str(i))
+            self.builder.addDatapoint('0', '2012-01-01T00:00:00Z', str(i))
+            data = self.builder.encode()
+            self.builder.reset()
+        self.assertEqual(json.loads(data)['datastreams'], [{'id' : '0', 'current_value' : '2',
+                                                            'datapoints' : [{'at' : '2012-01-01T00:00:00Z',
+                                                                             'value' : '2'}]}])
+        # an environment, a datastream and a datapoint
+        self.assertEqual(self.pool.created, 3)
+        self.assertEqual(self.pool.reused, 4)
+        self.assertEqual(json.loads(self.builder.encode()), {'version' : list(txpachube.version)})
+        
+        
+    def test_ReleaseResets(self):
+        datastream = self.pool.acquire(txpachube.Datastream, id='0', current_value='1', tags=['a'])
+        datastream.addDatapoint('2012-01-01T00:00:00Z', '1')
+        datapoints = datastream.datapoints
+        self.pool.release(datastream)
+        self.assertEqual(datastream.toDict(), txpachube.Datastream().toDict())
+        self.assertTrue(datastream.datapoints is datapoints)
+        self.assertTrue(self.pool.acquire(txpachube.Datastream) is datastream)
+        self.assertEqual(len(self.pool.free[txpachube.Datapoint]), 1)
+        
+        # a full pool leaves released objects to the garbage collector
+        for i in range(6):
+            self.pool.release(txpachube.Datapoint())
+        self.assertEqual(len(self.pool.free[txpachube.Datapoint]), 4)
+        
+        
+    def test_DoubleReleaseIgnored(self):
+        datastream = self.pool.acquire(txpachube.Datastream, id='0')
+        self.pool.release(datastream)
+        self.pool.release(datastream)
+        self.assertEqual(len(self.pool.free[txpachube.Datastream]), 1)
+        self.assertTrue(self.pool.acquire(txpachube.Datastream) is datastream)
+        self.assertFalse(self.pool.acquire(txpachube.Datastream) is datastream)
+        # once acquired again it can be released again
+        self.pool.release(datastream)
+        self.assertEqual(len(self.pool.free[txpachube.Datastream]), 1)
+        
+        
+        
+class EncoderTestCase(unittest.TestCase):
+    
+    def encode(self, structure, format):
+        buf = txpachube.encoder.EncodeBuffer()
+        txpachube.encoder.encode(structure, buf.write, format)
+        return buf.getvalue()
+        
+        
+    def test_EncodeToJson(self):
+        environment = txpachube.Environment()
+        environment.decode(TEST_FEED_JSON)
+        self.assertEqual(json.loads(self.encode(environment, txpachube.DataFormats.JSON)),
+                         json.loads(environment.encode()))
+        
+        datastream = environment.datastreams.values()[0]
+        # as toDict, tags are written as the text of the list
+        datastream.tags = ['t']
+        self.assertEqual(json.loads(self.encode(datastream, txpachube.DataFormats.JSON))[txpachube.DataFields.Tags],
+                         "['t']")
+        self.assertEqual(json.loads(self.encode(datastream, txpachube.DataFormats.JSON)),
+                         json.loads(datastream.encode()))
+        datastream.tags = []
+        self.assertEqual(json.loads(self.encode(datastream, txpachube.DataFormats.JSON)),
+                         json.loads(datastream.encode()))
+        
+        
+    def test_EncodeToXml(self):
+        environment = txpachube.Environment()
+        environment.decode(TEST_FEED_JSON)
+        environment.title = u'caf\xe9 <&>'
+        canonical = lambda data: etree.tostring(etree.fromstring(data))
+        self.assertEqual(canonical(self.encode(environment, txpachube.DataFormats.XML)),
+                         canonical(environment.encode(txpachube.DataFormats.XML)))
+        
+        
+    def test_OtherStructures(self):
+        user_list = txpachube.UserList(**{txpachube.DataFields.Users : json.loads(TEST_USERS_LIST_JSON)})
+        self.assertEqual(self.encode(user_list, txpachube.DataFormats.JSON), user_list.encode())
+        self.assertRaises(Exception, self.encode, user_list, 'csv')
+        
+        
+        
+class NumericTestCase(unittest.TestCase):
+    
+    def makeDatastream(self):
+        datastream = txpachube.Datastream(id='0', current_value='21.50', max_value='30', min_value='-0.0')
+        for value in ['0', '1e3', '12.5', 'offline']:
+            datastream.addDatapoint('2012-01-01T00:00:00Z', value)
+        return datastream
+        
+        
+    def test_FloatValues(self):
+        datastream = self.makeDatastream()
+        expected = json.loads(datastream.encode())
+        xml = datastream.encode(txpachube.DataFormats.XML)
+        txpachube.numeric.typeValues(datastream)
+        
+        self.assertEqual(datastream.current_value, 21.5)
+        self.assertTrue(isinstance(datastream.max_value, int))
+        values = [datapoint.value for datapoint in datastream.datapoints]
+        self.assertEqual(values[:3], [0, 1000.0, 12.5])
+        self.assertEqual(values[3], 'offline')
+        self.assertEqual(sum(values[:3]), 1012.5)
+        
+        # encoding writes the values as they were received
+        self.assertEqual(json.loads(datastream.encode()), expected)
+        self.assertEqual(datastream.encode(txpachube.DataFormats.XML), xml)
+        buf = txpachube.encoder.EncodeBuffer()
+        txpachube.encoder.encode(datastream, buf.write)
+        self.assertEqual(json.loads(buf.getvalue()), expected)
+        
+        
+    def test_DecimalValues(self):
+        datastream = self.makeDatastream()
+        expected = json.loads(datastream.encode())
+        txpachube.numeric.typeValues(datastream, txpachube.numeric.Decimal_Values)
+        self.assertEqual(datastream.current_value, txpachube.numeric.decimal.Decimal('21.5'))
+        self.assertEqual(json.loads(datastream.encode()), expected)
+        self.assertRaises(Exception, txpachube.numeric.typeValues, datastream, 'complex')
+        
+        
+    def test_EnvironmentList(self):
+        environment_list = txpachube.EnvironmentList()
+        environment_list.decode(TEST_FEEDS_LIST_JSON)
+        txpachube.numeric.typeValues(environment_list)
+        values = [datastream.current_value for environment in environment_list.feeds
+                  for datastream in environment.datastreams.values()]
+        self.assertTrue(435 in values)
+        self.assertTrue('hertz' in values)
+        
+        
+        
+class InterningTestCase(unittest.TestCase):
+    
+    def test_InternsRepeatedValues(self):
+        table = txpachube.interning.InternTable()
+        first = txpachube.EnvironmentList()
+        first.decode(TEST_FEEDS_LIST_JSON)
+        second = txpachube.EnvironmentList()
+        second.decode(TEST_FEEDS_LIST_JSON)
+        for environment_list in [first, second]:
+            self.assertTrue(table.internStructure(environment_list) is environment_list)
+        
+        first_environment, second_environment = first.feeds[0], second.feeds[0]
+        self.assertTrue(first_environment.status is second_environment.status)
+        self.assertTrue(first_environment.tags[0] is second_environment.tags[0])
+        self.assertTrue(first_environment.location.domain is second_environment.location.domain)
+        first_datastream, second_datastream = first_environment.datastreams['0'], second_environment.datastreams['0']
+        self.assertTrue(first_datastream.id is second_datastream.id)
+        self.assertTrue(first_datastream.tags[0] is second_datastream.tags[0])
+        # the datastreams are keyed by the interned ids
+        key = [k for k in second_environment.datastreams.keys() if k == '0'][0]
+        self.assertTrue(key is first_datastream.id)
+        self.assertEqual(first.toDict(), second.toDict())
+        
+        
+    def test_Bounded(self):
+        table = txpachube.interning.InternTable(size=2)
+        values = [u''.join([u'value', unicode(i)]) for i in range(3)]
+        for value in values:
+            self.assertTrue(table.intern(value) is value)
+        self.assertEqual(len(table), 2)
+        self.assertTrue(table.intern(u'value0') is values[0])
+        self.assertFalse(table.intern(u'value2') is values[2])
+        self.assertEqual(table.intern(5), 5)
+        table.clear()
+        self.assertEqual(len(table), 0)
+        
+        
+        
+suite = unittest.TestSuite([unittest.TestLoader().loadTestsFromTestCase(DataStructureTestCase),
+                            unittest.TestLoader().loadTestsFromTestCase(ProfilingTestCase),
+                            unittest.TestLoader().loadTestsFromTestCase(BuilderTestCase),
+                            unittest.TestLoader().loadTestsFromTestCase(EncoderTestCase),
+                            unittest.TestLoader().loadTestsFromTestCase(NumericTestCase),
+                            unittest.TestLoader().loadTestsFromTestCase(InterningTestCase)])
 
     
               
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+#
+# This script provides test cases for the multi-process ingestion
+# supervisor and workers. Most tests drive the supervisor and worker ends
+# directly; one starts real worker processes running a trivial job.
+#
+import os
+import sys
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+from twisted.trial import unittest
+try:
+    import txpachube
+    import txpachube.workers
+except ImportError:
+    # cater for situation where txpachube is not installed into Python distribution
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import txpachube
+    import txpachube.workers
+import txpachube.ratelimit
+
+
+# trial runs tests in a temporary directory, so find these before it does
+Test_Directory = os.path.dirname(os.path.abspath(__file__))
+Package_Directory = os.path.dirname(Test_Directory)
+
+
+
+def succeedJob(client, feed_id):
+    """ A job run in the worker processes started by the tests """
+    return defer.succeed(feed_id)
+
+
+
+class FakeProcessTransport(object):
+
+    def __init__(self):
+        self.written = []
+        self.stdinClosed = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def closeStdin(self):
+        self.stdinClosed = True
+
+
+
+class FakeProcessReactor(task.Clock):
+    """ A clock that records the processes spawned instead of starting them """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, processProtocol, executable, args, env=None):
+        self.spawned.append((processProtocol, args, env))
+        processProtocol.transport = FakeProcessTransport()
+        processProtocol.connectionMade()
+
+
+
+class SupervisorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.limiter = txpachube.ratelimit.RateLimiter(limits={txpachube.ratelimit.Read : (1.0, 1)},
+                                                       clock=self.reactor)
+        self.feeds = range(20)
+        self.supervisor = txpachube.workers.Supervisor(self.feeds, 'test_workers.succeedJob', workers=3,
+                                                       api_key='key', rate_limiter=self.limiter,
+                                                       reactor=self.reactor)
+
+
+    def messages(self, processProtocol):
+        return [txpachube.workers.json.loads(data) for data in processProtocol.transport.written]
+
+
+    def test_Sharding(self):
+        shards = self.supervisor.assignments()
+        self.assertEqual(sorted(sum(shards, [])), self.feeds)
+        self.assertEqual(shards, self.supervisor.assignments())
+        self.assertEqual(txpachube.workers.shard(7, 3), txpachube.workers.shard('7', 3))
+
+
+    def test_StartAssignsFeeds(self):
+        self.supervisor.start()
+        self.assertEqual(len(self.reactor.spawned), 3)
+        processProtocol, args, env = self.reactor.spawned[0]
+        self.assertEqual(env[txpachube.workers.Api_Key_Variable], 'key')
+        self.assertNotIn('key', args)
+        self.assertEqual(self.messages(processProtocol),
+                         [{'type' : 'assign', 'feeds' : self.supervisor.assignments()[0]}])
+
+
+    def test_SharedRateLimit(self):
+        self.supervisor.start()
+        first, second = self.supervisor.processes[0], self.supervisor.processes[1]
+        first.outReceived('{"type" : "acquire", "id" : 1, "api_key" : "key", "method" : "GET"}\n{"type" : "acq')
+        second.outReceived('{"type" : "acquire", "id" : 1, "api_key" : "key", "method" : "GET"}\n')
+        first.outReceived('uire", "id" : 2, "api_key" : "key", "method" : "GET"}\n')
+        grants = lambda p: [m['id'] for m in self.messages(p) if m['type'] == 'grant']
+        self.assertEqual((grants(first), grants(second)), ([1], []))
+        self.reactor.advance(1.0)
+        self.assertEqual((grants(first), grants(second)), ([1], [1]))
+        self.reactor.advance(1.0)
+        self.assertEqual((grants(first), grants(second)), ([1, 2], [1]))
+
+
+    def test_Throughput(self):
+        self.supervisor.start()
+        self.reactor.advance(10.0)
+        self.supervisor.processes[0].outReceived('{"type" : "stats", "completed" : 15, "failed" : 1}\n')
+        self.supervisor.processes[2].outReceived('{"type" : "stats", "completed" : 5, "failed" : 0}\n')
+        self.assertEqual((self.supervisor.completed, self.supervisor.failed), (20, 1))
+        self.assertEqual(self.supervisor.throughput(), 2.0)
+
+
+    def test_RestartWorker(self):
+        self.supervisor.start()
+        processProtocol = self.supervisor.processes[1]
+        processProtocol.processEnded(failure.Failure(Exception("crashed")))
+        self.assertEqual(len(self.reactor.spawned), 4)
+        self.assertNotIdentical(self.supervisor.processes[1], processProtocol)
+
+        self.supervisor.stop()
+        self.assertTrue(self.supervisor.processes[0].transport.stdinClosed)
+        self.supervisor.processes[0].processEnded(failure.Failure(Exception("stopped")))
+        self.assertEqual(len(self.reactor.spawned), 4)
+
+
+
+class WorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.results = dict()
+        self.worker = txpachube.workers.Worker(self.job, self.sent.append, interval=30.0, report_interval=5.0,
+                                               clock=self.clock)
+
+
+    def job(self, client, feed_id):
+        d = self.results[feed_id] = defer.Deferred()
+        return d
+
+
+    def test_RunsAssignedFeeds(self):
+        self.worker.messageReceived({'type' : 'assign', 'feeds' : [1, 2]})
+        self.assertEqual(sorted(self.results.keys()), [1, 2])
+        self.results.pop(1).callback(None)
+        self.results.pop(2).errback(Exception("failed"))
+        self.clock.advance(5.0)
+        self.assertEqual(self.sent, [{'type' : 'stats', 'completed' : 1, 'failed' : 1}])
+
+        # the feeds are run again after the interval
+        self.clock.advance(25.0)
+        self.assertEqual(sorted(self.results.keys()), [1, 2])
+
+
+    def test_RemoteRateLimit(self):
+        d = self.worker.rate_limiter.acquire('key', 'GET')
+        self.assertEqual(self.sent, [{'type' : 'acquire', 'id' : 1, 'api_key' : 'key', 'method' : 'GET'}])
+        self.assertNoResult(d)
+        self.worker.messageReceived({'type' : 'grant', 'id' : 1})
+        self.successResultOf(d)
+
+
+
+class WorkerProcessTestCase(unittest.TestCase):
+
+    timeout = 30
+
+    @defer.inlineCallbacks
+    def test_WorkerProcesses(self):
+        pythonPath = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join([Package_Directory, Test_Directory] +
+                                                   ([pythonPath] if pythonPath else []))
+        if pythonPath is None:
+            self.addCleanup(os.environ.pop, 'PYTHONPATH')
+        else:
+            self.addCleanup(os.environ.__setitem__, 'PYTHONPATH', pythonPath)
+
+        supervisor = txpachube.workers.Supervisor(range(10), 'test_workers.succeedJob', workers=2,
+                                                  report_interval=1.0, restart=False)
+        supervisor.start()
+        # the workers run their feeds on assignment, and send their final
+        # stats when asked to stop
+        supervisor.stop()
+        for i in range(100):
+            if not supervisor.processes:
+                break
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(supervisor.processes, {})
+        self.assertEqual((supervisor.completed, supervisor.failed), (10, 0))
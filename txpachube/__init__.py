@@ -374,7 +374,8 @@ class Datapoint(DataStructure):
         datapointDict = dict()
         for attribute in self._attributes:
             attribute_value = getattr(self, attribute, None)
-            if attribute_value:
+            # typed values may be zero
+            if attribute_value is not None and attribute_value != '':
                 datapointDict[attribute] = unicode(attribute_value)
         return datapointDict
     
@@ -401,7 +402,8 @@ class Datapoint(DataStructure):
         """
         value = etree.Element(DataFields.Value)
         value.attrib[DataFields.At] = self.at
-        value.text = self.value
+        if self.value is not None:
+            value.text = unicode(self.value)
         return value
 
 
@@ -422,6 +424,14 @@ class Datapoint(DataStructure):
                 self.value = value 
 
 
+    def reset(self):
+        """
+        Return the datapoint to its initial state so it can be reused.
+        """
+        self.at = None
+        self.value = None
+
+
 class Permission(DataStructure):
     """ Models a Permission item within a API key """
     
@@ -741,15 +751,16 @@ class Datastream(DataStructure):
                 tag = etree.SubElement(data, DataFields.Tag)
                 tag.text = tag_label
                 
-        if self.current_value:
+        # typed values may be zero
+        if self.current_value is not None and self.current_value != '':
             current_value = etree.SubElement(data, DataFields.Current_Value)
-            current_value.text = self.current_value
+            current_value.text = unicode(self.current_value)
             
-        if self.max_value:
+        if self.max_value is not None and self.max_value != '':
             max_value = etree.SubElement(data, DataFields.Maximum_Value)
             max_value.text = unicode(self.max_value)
         
-        if self.min_value:
+        if self.min_value is not None and self.min_value != '':
             min_value = etree.SubElement(data, DataFields.Minimum_Value)
             min_value.text = unicode(self.min_value)
                         
@@ -852,6 +863,23 @@ class Datastream(DataStructure):
         """
         self.current_value = None
         del self.datapoints[:]
+
+
+    def reset(self):
+        """
+        Return the datastream to its initial state so it can be reused.
+        The datapoints list is emptied in place rather than replaced.
+        """
+        self.id = None
+        self.at = None
+        self.current_value = None
+        self.max_value = None
+        self.min_value = None
+        self.updated = None
+        del self.datapoints[:]
+        if self.tags:
+            self.tags = []
+        self.unit = None
         
         
                               
@@ -1143,6 +1171,31 @@ class Environment(DataStructure):
         self.location = Locaiton(**locationKwargs)
 
 
+    def reset(self):
+        """
+        Return the environment to its initial state so it can be reused.
+        The datastreams dict is emptied in place rather than replaced.
+        """
+        self.creator = None
+        if isinstance(self.datastreams, dict):
+            self.datastreams.clear()
+        else:
+            # fromXml stores the datastreams as a list
+            self.datastreams = {}
+        self.description = None
+        self.feed = None
+        self.icon = None
+        self.id = None
+        self.location = None
+        self.private = None
+        self.status = None
+        self.tags = None
+        self.title = None
+        self.updated = None
+        self.version = version
+        self.website = None
+
+
 
 class EnvironmentList(DataStructure):
     """
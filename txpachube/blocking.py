@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+A thread safe, blocking facade over the Client for code that does not
+run in a Twisted reactor.
+
+Blocking code such as WSGI workers and batch scripts can not use the
+Deferreds returned by a Client directly. A BlockingClient runs the
+reactor in a background thread, owns a Client living in that thread, and
+makes each call from the caller's thread by passing it to the reactor
+thread and waiting for the result. Many worker threads can share one
+BlockingClient, and so one client with its connections, rate limits and
+circuit breakers, instead of each running their own.
+
+    client = BlockingClient(api_key=API_KEY)
+    environment = client.read_feed(feed_id=FEED_ID)
+    future = client.submit('read_feed', feed_id=FEED_ID)
+    environment = future.result()
+    client.close()
+
+Every public Client method is available as a blocking method with the
+same arguments. Failures are raised as exceptions in the caller's
+thread. submit returns a concurrent.futures.Future instead, and requires
+the concurrent.futures module, provided by the futures package on
+Python 2.
+
+The reactor can only run once per process, so if the application
+already runs the reactor in another thread pass it in and no thread is
+started. Calls must never be made from the reactor thread itself, as
+they would wait forever for a result that thread has to produce.
+"""
+
+import logging
+import threading
+from twisted.internet import defer, threads
+import txpachube.client
+
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
+
+
+
+# The Client methods available through a BlockingClient
+Blocking_Methods = [name for name in dir(txpachube.client.Client)
+                    if not name.startswith('_') and callable(getattr(txpachube.client.Client, name))]
+
+
+
+class ReactorThread(object):
+    """
+    Runs a reactor in a daemon thread.
+    """
+
+    def __init__(self, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.thread = None
+
+
+    def start(self, timeout=10.0):
+        """
+        Start the reactor thread and wait until the reactor is running.
+
+        @param timeout: The time, in seconds, to wait for the reactor to start
+        @type timeout: float
+        """
+        if self.thread is not None:
+            return
+        started = threading.Event()
+        self.reactor.callWhenRunning(started.set)
+        self.thread = threading.Thread(target=self.reactor.run, kwargs={'installSignalHandlers' : False},
+                                       name="txpachube reactor")
+        self.thread.daemon = True
+        self.thread.start()
+        if not started.wait(timeout):
+            err_str = "Reactor thread did not start within %ss" % timeout
+            logging.error(err_str)
+            raise Exception(err_str)
+
+
+    def stop(self, timeout=10.0):
+        """
+        Stop the reactor and wait for its thread to exit.
+        """
+        if self.thread is None:
+            return
+        self.reactor.callFromThread(self.reactor.stop)
+        self.thread.join(timeout)
+        self.thread = None
+
+
+
+class BlockingClient(object):
+    """
+    Makes Client calls from any thread other than the reactor thread,
+    blocking until each completes.
+    """
+
+    def __init__(self, client=None, reactor=None, **kwargs):
+        """
+        @param client: The client to make calls with. If not set a Client is
+                       created in the reactor thread, passed any remaining
+                       keyword arguments.
+        @type client: txpachube.client.Client
+        @param reactor: A reactor already running in another thread. If not
+                        set the global reactor is started in a new thread.
+        """
+        self.reactorThread = None
+        if reactor is None:
+            self.reactorThread = ReactorThread()
+            self.reactorThread.start()
+            reactor = self.reactorThread.reactor
+        self.reactor = reactor
+        if client is None:
+            client = threads.blockingCallFromThread(reactor, txpachube.client.Client, **kwargs)
+        self.client = client
+
+
+    def _checkThread(self):
+        if self.reactorThread and threading.current_thread() is self.reactorThread.thread:
+            err_str = "BlockingClient calls can not be made from the reactor thread"
+            logging.error(err_str)
+            raise Exception(err_str)
+
+
+    def call(self, method, *args, **kwargs):
+        """
+        Call a Client method and wait for its result.
+
+        @param method: The name of the Client method
+        @type method: string
+
+        @return: The result the Client method's deferred fired with
+        """
+        if method not in Blocking_Methods:
+            err_str = "Unsupported blocking call %s" % method
+            logging.error(err_str)
+            raise Exception(err_str)
+        self._checkThread()
+        return threads.blockingCallFromThread(self.reactor, getattr(self.client, method), *args, **kwargs)
+
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Start a Client method call without waiting for its result.
+
+        @param method: The name of the Client method
+        @type method: string
+
+        @return: A future that is resolved with the result of the call
+        @rtype: concurrent.futures.Future
+        """
+        if futures is None:
+            err_str = "submit requires the concurrent.futures module (the futures package on Python 2)"
+            logging.error(err_str)
+            raise Exception(err_str)
+        if method not in Blocking_Methods:
+            err_str = "Unsupported blocking call %s" % method
+            logging.error(err_str)
+            raise Exception(err_str)
+        future = futures.Future()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            d = defer.maybeDeferred(getattr(self.client, method), *args, **kwargs)
+            d.addCallbacks(future.set_result, lambda reason: future.set_exception(reason.value))
+
+        self.reactor.callFromThread(start)
+        return future
+
+
+    def close(self):
+        """
+        Stop the reactor thread, if this object started it.
+        """
+        if self.reactorThread:
+            self.reactorThread.stop()
+            self.reactorThread = None
+
+
+    def __getattr__(self, name):
+        if name in Blocking_Methods:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
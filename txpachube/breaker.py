@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+"""
+Circuit breakers for requests made by the txpachube Client.
+
+When Pachube is degraded, requests wait for a full connection timeout
+before failing and callers pile up behind them. A CircuitBreaker watches
+the outcome and latency of the recent requests to one endpoint family
+(feeds, datastreams, datapoints, triggers, keys or users). When too many
+of them fail, or are too slow, the circuit opens and further requests
+fail immediately with a CircuitOpenError. After a cool down period the
+circuit becomes half open and lets a few probe requests through. If
+they succeed the circuit closes again, otherwise it re-opens. Only the
+outcome of a request sent since the last change of state is counted, so
+a request sent before the circuit opened can not decide a probe.
+
+Observers can be added to be told of every change of circuit state.
+"""
+
+import collections
+import logging
+from twisted.internet import reactor, defer
+
+
+
+# Circuit states
+Closed = 'closed'
+Open = 'open'
+HalfOpen = 'half-open'
+
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of sending a request while the circuit for its endpoint
+    family is open.
+    """
+
+
+
+class CircuitBreaker(object):
+    """
+    Tracks the health of one endpoint family and decides whether requests
+    to it may be sent.
+    """
+
+    def __init__(self, endpoint, window=20, min_requests=10, error_rate=0.5, latency=10.0,
+                 slow_rate=0.5, reset_timeout=30.0, half_open_probes=1, clock=None):
+        """
+        @param endpoint: The name of the endpoint family
+        @type endpoint: string
+        @param window: The number of recent requests whose outcome is considered
+        @type window: int
+        @param min_requests: The number of outcomes needed before the circuit can open
+        @type min_requests: int
+        @param error_rate: The fraction of failed requests that opens the circuit
+        @type error_rate: float
+        @param latency: The time, in seconds, above which a request counts as slow
+        @type latency: float
+        @param slow_rate: The fraction of slow requests that opens the circuit
+        @type slow_rate: float
+        @param reset_timeout: The time, in seconds, the circuit stays open before
+                              probe requests are allowed through.
+        @type reset_timeout: float
+        @param half_open_probes: The number of concurrent probe requests allowed
+                                 while the circuit is half open.
+        @type half_open_probes: int
+        """
+        self.endpoint = endpoint
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.half_open_probes = half_open_probes
+        self.clock = clock or reactor
+        self.observers = []
+
+        self.state = Closed
+        # incremented by every change of state
+        self.generation = 0
+        self.openedAt = None
+        self._probes = 0
+        # (failed, slow) tuples of the most recent outcomes
+        self._outcomes = collections.deque(maxlen=window)
+
+
+    def addObserver(self, observer):
+        """
+        Add a callable that is called with the endpoint, the old state and
+        the new state whenever the state of the circuit changes.
+        """
+        self.observers.append(observer)
+
+
+    def _setState(self, state):
+        oldState = self.state
+        self.state = state
+        self.generation += 1
+        self._probes = 0
+        if state == Open:
+            self.openedAt = self.clock.seconds()
+        if state == Closed:
+            self._outcomes.clear()
+        logging.warning("Circuit for %s changed from %s to %s" % (self.endpoint, oldState, state))
+        for observer in self.observers:
+            try:
+                observer(self.endpoint, oldState, state)
+            except Exception, ex:
+                logging.error("Circuit state observer failed: %s" % ex)
+
+
+    def isOpen(self):
+        """
+        Return True if the circuit is open and its reset timeout has not yet
+        passed, so a request would certainly be refused. Unlike allowRequest
+        this never takes a probe.
+        """
+        return self.state == Open and self.clock.seconds() - self.openedAt < self.reset_timeout
+
+
+    def allowRequest(self):
+        """
+        Return True if a request may be sent now. While half open each
+        allowed request is a probe and must be followed by a call to
+        record.
+        """
+        if self.state == Open:
+            if self.clock.seconds() - self.openedAt < self.reset_timeout:
+                return False
+            self._setState(HalfOpen)
+
+        if self.state == HalfOpen:
+            if self._probes >= self.half_open_probes:
+                return False
+            self._probes += 1
+        return True
+
+
+    def record(self, failed, elapsed, generation=None):
+        """
+        Record the outcome of a request that was allowed through.
+
+        @param failed: True if the request failed
+        @type failed: boolean
+        @param elapsed: The time, in seconds, the request took
+        @type elapsed: float
+        @param generation: The generation of the circuit when the request was
+                           sent. The outcome is ignored if the state of the
+                           circuit has changed since.
+        @type generation: int
+        """
+        if generation is not None and generation != self.generation:
+            return
+        slow = elapsed > self.latency
+        if self.state == HalfOpen:
+            if failed or slow:
+                self._setState(Open)
+            else:
+                self._setState(Closed)
+            return
+
+        if self.state == Open:
+            # a request sent before the circuit opened has finished
+            return
+
+        self._outcomes.append((failed, slow))
+        total = len(self._outcomes)
+        if total < self.min_requests:
+            return
+        failures = len([o for o in self._outcomes if o[0]])
+        slows = len([o for o in self._outcomes if o[1]])
+        if failures >= self.error_rate * total or slows >= self.slow_rate * total:
+            self._setState(Open)
+
+
+    def release(self, generation=None):
+        """
+        Give back a probe taken by allowRequest without recording an
+        outcome, for a probe abandoned by its caller.
+
+        @param generation: The generation of the circuit when the probe was
+                           taken. Nothing is given back if the state of the
+                           circuit has changed since.
+        @type generation: int
+        """
+        if generation is not None and generation != self.generation:
+            return
+        if self.state == HalfOpen and self._probes > 0:
+            self._probes -= 1
+
+
+    def observe(self, d, timedOut=None):
+        """
+        Record the outcome of a request when its deferred fires. Server
+        errors (5xx responses), timeouts and other exceptions count as
+        failures. A request cancelled by its caller says nothing about the
+        health of the endpoint: while half open its probe is released
+        without deciding the state of the circuit, otherwise only its
+        latency is recorded.
+
+        @param d: A deferred that returns a (response, responseBody) tuple
+        @type d: defer.Deferred
+        @param timedOut: A callable returning True if a cancellation of the
+                         request was caused by its timeout
+        @type timedOut: callable
+
+        @return: The deferred passed in
+        @rtype: defer.Deferred
+        """
+        started = self.clock.seconds()
+        generation = self.generation
+
+        def success(result):
+            response, responseBody = result
+            self.record(response.code >= 500, self.clock.seconds() - started, generation)
+            return result
+
+        def failure(reason):
+            if reason.check(defer.CancelledError) and not (timedOut and timedOut()):
+                if self.state == HalfOpen:
+                    self.release(generation)
+                else:
+                    self.record(False, self.clock.seconds() - started, generation)
+            else:
+                self.record(True, self.clock.seconds() - started, generation)
+            return reason
+
+        d.addCallbacks(success, failure)
+        return d
+
+
+
+class CircuitBreakers(object):
+    """
+    Holds a circuit breaker for each endpoint family. Every breaker is
+    created with the same settings.
+    """
+
+    def __init__(self, clock=None, **settings):
+        """
+        @param settings: Keyword arguments passed to each CircuitBreaker
+        """
+        self.clock = clock or reactor
+        self.settings = settings
+        self.breakers = dict()
+        self.observers = []
+
+
+    def addObserver(self, observer):
+        """
+        Add a callable that is called with the endpoint, the old state and
+        the new state whenever the state of any circuit changes.
+        """
+        self.observers.append(observer)
+        for breaker in self.breakers.values():
+            breaker.addObserver(observer)
+
+
+    def get(self, endpoint):
+        """
+        Return the circuit breaker for an endpoint family.
+        """
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = self.breakers[endpoint] = CircuitBreaker(endpoint, clock=self.clock, **self.settings)
+            for observer in self.observers:
+                breaker.addObserver(observer)
+        return breaker
+
+
+    def states(self):
+        """
+        Return the state of each circuit.
+
+        @return: A dict mapping endpoint family to circuit state
+        @rtype: dict
+        """
+        return dict([(endpoint, breaker.state) for endpoint, breaker in self.breakers.items()])
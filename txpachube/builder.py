@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+"""
+Reuse of data structures and encode buffers by high rate producers.
+
+A producer that builds a new Environment and Datastream for every update,
+encodes it and throws it away creates a lot of short lived objects. An
+UpdateBuilder keeps one Environment, takes its Datastream and Datapoint
+objects from a StructurePool, and encodes into an EncodeBuffer that is
+emptied, but not freed, between updates. Updates are written by the
+encoders of txpachube.encoder without building intermediate dicts. Once
+the pool has warmed up an update creates no new data structures.
+
+    builder = UpdateBuilder()
+    while running:
+        builder.setCurrentValue('temperature', read_temperature())
+        builder.setCurrentValue('humidity', read_humidity())
+        yield client.update_feed(api_key=key, feed_id=feed_id, data=builder.encode())
+        builder.reset()
+
+Objects handed out by a pool must not be used after they are released.
+"""
+
+import txpachube
+import txpachube.encoder
+
+
+
+class StructurePool(object):
+    """
+    A bounded free list of Environment, Datastream and Datapoint objects.
+    Released objects are reset in place and handed out again by acquire.
+    """
+
+    def __init__(self, size=1024):
+        """
+        @param size: The maximum number of free objects kept for each class.
+                     Objects released to a full pool are left to the
+                     garbage collector.
+        @type size: int
+        """
+        self.size = size
+        # class -> list of free objects
+        self.free = dict()
+        # ids of the objects in the free lists
+        self._freeIds = set()
+        self.created = 0
+        self.reused = 0
+
+
+    def acquire(self, cls, **kwargs):
+        """
+        Return an object of the class, reusing a released one if available.
+
+        @param cls: The data structure class
+        @type cls: class
+        @param kwargs: Attribute values to set on the object
+
+        @rtype: txpachube.DataStructure
+        """
+        free = self.free.get(cls)
+        if free:
+            structure = free.pop()
+            self._freeIds.discard(id(structure))
+            self.reused += 1
+            if kwargs:
+                structure.fromDict(kwargs)
+        else:
+            structure = cls(**kwargs)
+            self.created += 1
+        return structure
+
+
+    def release(self, structure):
+        """
+        Reset an object and return it to the pool. The datastreams of an
+        Environment, and the datapoints of a Datastream, are released too.
+        Releasing an object that is already in the pool does nothing.
+
+        @param structure: The object to release
+        @type structure: txpachube.Environment, txpachube.Datastream or txpachube.Datapoint
+        """
+        if id(structure) in self._freeIds:
+            return
+        if isinstance(structure, txpachube.Environment):
+            datastreams = structure.datastreams
+            if isinstance(datastreams, dict):
+                datastreams = datastreams.values()
+            for datastream in datastreams:
+                self.release(datastream)
+        elif isinstance(structure, txpachube.Datastream):
+            for datapoint in structure.datapoints:
+                self.release(datapoint)
+        structure.reset()
+
+        free = self.free.get(structure.__class__)
+        if free is None:
+            free = self.free[structure.__class__] = []
+        if len(free) < self.size:
+            free.append(structure)
+            self._freeIds.add(id(structure))
+
+
+
+class UpdateBuilder(object):
+    """
+    Builds feed updates, made of datastream current values and datapoints,
+    from pooled objects and encodes them into a reusable buffer.
+    """
+
+    def __init__(self, pool=None):
+        """
+        @param pool: The pool to take datastreams and datapoints from. Builders
+                     may share a pool.
+        @type pool: StructurePool
+        """
+        self.pool = pool or StructurePool()
+        self.environment = self.pool.acquire(txpachube.Environment)
+        self.buffer = txpachube.encoder.EncodeBuffer()
+
+
+    def _getDatastream(self, datastream_id):
+        datastream = self.environment.datastreams.get(datastream_id)
+        if datastream is None:
+            datastream = self.pool.acquire(txpachube.Datastream)
+            datastream.id = datastream_id
+            self.environment.datastreams[datastream_id] = datastream
+        return datastream
+
+
+    def setCurrentValue(self, datastream_id, value):
+        """
+        Set the current value for a datastream.
+
+        @param datastream_id: The identifier of the datastream to be updated
+        @type datastream_id: string
+        @param value: The current value for the datastream
+        @type value: string
+        """
+        self._getDatastream(datastream_id).current_value = value
+
+
+    def addDatapoint(self, datastream_id, at_time, value):
+        """
+        Add a datapoint to a datastream.
+
+        @param datastream_id: The identifier of the datastream to be updated
+        @type datastream_id: string
+        @param at_time: The timestamp for the datapoint, in ISO8601 format
+        @type at_time: string
+        @param value: The value of the datapoint
+        @type value: string
+        """
+        datapoint = self.pool.acquire(txpachube.Datapoint)
+        datapoint.at = at_time
+        datapoint.value = value
+        self._getDatastream(datastream_id).datapoints.append(datapoint)
+
+
+    def encode(self, format=txpachube.DataFormats.JSON):
+        """
+        Encode the update into the builder's buffer.
+
+        @param format: The format to encode the update in [json|xml]
+        @type format: string
+
+        @return: The encoded update
+        @rtype: string
+        """
+        self.buffer.reset()
+        txpachube.encoder.encode(self.environment, self.buffer.write, format)
+        return self.buffer.getvalue()
+
+
+    def bodyProducer(self, format=txpachube.DataFormats.JSON):
+        """
+        Return a request body producer for the update, encoded into the
+        builder's buffer. The producer must not be used once the builder
+        encodes the next update.
+
+        @param format: The format to encode the update in [json|xml]
+        @type format: string
+
+        @rtype: txpachube.encoder.StructureBodyProducer
+        """
+        return txpachube.encoder.StructureBodyProducer(self.environment, format, self.buffer)
+
+
+    def reset(self):
+        """
+        Release the datastreams and datapoints of the update to the pool so
+        the builder can be used for the next update.
+        """
+        datastreams = self.environment.datastreams
+        for datastream in datastreams.itervalues():
+            self.pool.release(datastream)
+        datastreams.clear()
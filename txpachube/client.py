@@ -2,17 +2,160 @@
 
 import json
 import logging
+import re
 import txpachube
+import txpachube.breaker
+import txpachube.decode
+import txpachube.history
+import txpachube.instrument
+import txpachube.numeric
+import txpachube.store
+import txpachube.stream
 import urllib
 import uuid
-from twisted.internet import reactor, defer
+from collections import OrderedDict, namedtuple
+from twisted.internet import reactor, defer, error, task
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
+from twisted.python import failure
 from twisted.web.client import Agent, ResponseDone
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
 from zope.interface import implements
 
 
+# The endpoint families of the Pachube API. Statistics and policies
+# applied to requests are kept per endpoint family.
+Endpoint_Families = ['feeds', 'datastreams', 'datapoints', 'triggers', 'keys', 'users']
+
+
+# The endpoint family each kind of returned data structure comes from
+Structure_Endpoints = {txpachube.List_Feeds_Msg : 'feeds',
+                       txpachube.View_Feed_Msg : 'feeds',
+                       txpachube.View_Datastream_Msg : 'datastreams',
+                       txpachube.View_Datapoint_Msg : 'datapoints',
+                       txpachube.List_Triggers_Msg : 'triggers',
+                       txpachube.View_Trigger_Msg : 'triggers',
+                       txpachube.List_Keys_Msg : 'keys',
+                       txpachube.View_Key_Msg : 'keys',
+                       txpachube.List_Users_Msg : 'users',
+                       txpachube.View_User_Msg : 'users'}
+
+
+# History query limits. Raw (interval 0) history can be read at most six
+# hours at a time, and at most 1000 datapoints per page.
+Raw_History_Window = txpachube.history.Intervals[0][1]
+Default_Per_Page = 100
+Max_Per_Page = txpachube.history.Max_Per_Page
+
+
+def getEndpoint(url):
+    """
+    Return the endpoint family (feeds, datastreams, datapoints, triggers,
+    keys or users) that a request url belongs to. The most specific family
+    in the path is used, so a datapoint url within a feed's datastream
+    belongs to the datapoints family.
+    
+    @param url: The url used during the request
+    @type url: string
+    
+    @return: The endpoint family, or 'other' if the url is not recognised
+    @rtype: string
+    """
+    path = url.split('?', 1)[0]
+    endpoint = 'other'
+    for segment in path.split('/'):
+        segment = segment.split('.', 1)[0]
+        if segment in Endpoint_Families:
+            endpoint = segment
+    return endpoint
+
+
+
+# The path of each kind of request url, relative to the api url.
+Url_Paths = {'feeds' : '/feeds.%s',
+             'feed' : '/feeds/%s.%s',
+             'feed_delete' : '/feeds/%s',
+             'datastreams' : '/feeds/%s/datastreams.%s',
+             'datastream' : '/feeds/%s/datastreams/%s.%s',
+             'datastream_delete' : '/feeds/%s/datastreams/%s',
+             'datapoints' : '/feeds/%s/datastreams/%s/datapoints.%s',
+             'datapoints_delete' : '/feeds/%s/datastreams/%s/datapoints',
+             'datapoint' : '/feeds/%s/datastreams/%s/datapoints/%s.%s',
+             'datapoint_delete' : '/feeds/%s/datastreams/%s/datapoints/%s',
+             'triggers' : '/triggers.%s',
+             'trigger' : '/triggers/%s.%s',
+             'trigger_delete' : '/triggers/%s',
+             'users' : '/users.%s',
+             'user' : '/users/%s.%s',
+             'keys' : '/keys.%s',
+             'key' : '/keys/%s.%s',
+             'key_delete' : '/keys/%s'}
+
+
+
+class RequestTemplates(object):
+    """
+    Builds the urls and headers of requests. The url templates are joined
+    to the api url once, and the request headers of each api key are built
+    once and reused by every later request made with that key.
+
+    The cached Headers objects are shared between requests and must not be
+    modified. The common headers are copied when the templates are
+    created, so later changes to them are not seen.
+    """
+
+    def __init__(self, api_url, headers, max_keys=1024):
+        """
+        @param api_url: The base url of the api, e.g. https://api.pachube.com/v2
+        @type api_url: string
+        @param headers: The headers common to every request
+        @type headers: dict
+        @param max_keys: The number of api keys whose headers are cached. The
+                         cache is emptied when it grows beyond this.
+        @type max_keys: int
+        """
+        self.urls = dict([(name, api_url + path) for name, path in Url_Paths.items()])
+        self.common = dict([(k, [v]) for k, v in headers.items()])
+        self.max_keys = max_keys
+        self._headers = dict()
+
+
+    def url(self, name, args, parameters=None):
+        """
+        Return a request url.
+
+        @param name: The kind of url, one of the keys of Url_Paths
+        @type name: string
+        @param args: The values substituted into the url template
+        @type args: tuple
+        @param parameters: Optional query parameters
+        @type parameters: dict
+
+        @rtype: string
+        """
+        url = self.urls[name] % args
+        if parameters:
+            url = "%s?%s" % (url, urllib.urlencode(parameters))
+        return url
+
+
+    def headers(self, api_key):
+        """
+        Return the request headers to use with an api key.
+
+        @rtype: twisted.web.http_headers.Headers
+        """
+        headers = self._headers.get(api_key)
+        if headers is None:
+            if len(self._headers) >= self.max_keys:
+                self._headers.clear()
+            rawHeaders = dict(self.common)
+            rawHeaders['X-PachubeApiKey'] = [api_key]
+            headers = self._headers[api_key] = Headers(rawHeaders)
+        return headers
+
+
+
 # NOTE:
 # In twisted 11.1.0 this class can be replaced by twisted.web.client.FileBodyProducer
 #
@@ -49,11 +192,19 @@ class ResponseBodyProtocol(Protocol):
     This object is used to receive the response body data
     after a request to a remote server.
     """
-    def __init__(self, finished, response):
-        self.finished = finished
+    def __init__(self, response):
+        self.finished = defer.Deferred(canceller=self._cancel)
         self.response = response
         self.buffer = []
 
+    def _cancel(self, finished):
+        """
+        Abandon the body delivery, closing the connection it arrives on.
+        """
+        self.buffer = []
+        if self.transport:
+            self.transport.stopProducing()
+
     def dataReceived(self, bytes):
         """
         Receive and store some bytes of the response data
@@ -64,8 +215,10 @@ class ResponseBodyProtocol(Protocol):
         """ 
         Return the response and the response body via the finished deferred.
         """
-        r = reason.trap(ResponseDone)
-        if r == ResponseDone:
+        if self.finished.called:
+            # the delivery was cancelled
+            return
+        if reason.check(ResponseDone):
             logging.debug(reason.getErrorMessage())
             responseData = "".join(self.buffer)
             self.buffer = []
@@ -73,6 +226,7 @@ class ResponseBodyProtocol(Protocol):
             self.finished.callback(result)
         else:
             logging.error("Problem reading response body: %s" % reason.getErrorMessage())
+            self.finished.errback(reason)
             
             
             
@@ -86,7 +240,10 @@ class Client(object):
     api_url = "api.pachube.com/v2"
     
     
-    def __init__(self, api_key=None, feed_id=None, use_http=False, timezone=None):
+    def __init__(self, api_key=None, feed_id=None, use_http=False, timezone=None, retry_policy=None,
+                 rate_limiter=None, circuit_breakers=None, timeout=60.0, instrumentation=None, store=None,
+                 pool=None, decoder=None, decode_threshold=64 * 1024, numeric_values=None,
+                 intern_table=None):
         """
         @param api_key: The default api key, with appropriate authorization privileges,
                         to use.
@@ -102,10 +259,63 @@ class Client(object):
                          the available settings see:
                          http://api.pachube.com/#time-zones
         @type timezone: string (eg. +3.5 or Adelaide
+        @param retry_policy: An optional policy used to retry requests that fail
+                             for transient reasons. If not set, requests are made
+                             once only.
+        @type retry_policy: txpachube.retry.RetryPolicy
+        @param rate_limiter: An optional rate limiter that delays requests so they
+                             stay within the Pachube API limits. Every attempt at
+                             a request, including retries, is limited.
+        @type rate_limiter: txpachube.ratelimit.RateLimiter
+        @param circuit_breakers: Optional circuit breakers that make requests to an
+                                 endpoint family fail fast while it is failing or
+                                 responding slowly.
+        @type circuit_breakers: txpachube.breaker.CircuitBreakers
+        @param timeout: The default time, in seconds, to wait for a request to
+                        complete before it is cancelled. A value of None
+                        disables the default timeout.
+        @type timeout: float
+        @param instrumentation: An optional object that records the latency and
+                                size of each request.
+        @type instrumentation: txpachube.instrument.Instrumentation
+        @param store: An optional local store that keeps the raw history read by
+                      read_datastream, and from which read_datastream_history
+                      answers queries.
+        @type store: txpachube.store.TimeSeriesStore
+        @param pool: An optional connection pool, allowing connections to be kept
+                     open and reused between requests. Requires twisted 12.1 or
+                     later.
+        @type pool: twisted.web.client.HTTPConnectionPool
+        @param decoder: An optional decoder that response bodies larger than the
+                        decode_threshold are decoded by, away from the reactor
+                        thread.
+        @type decoder: txpachube.decode.ThreadDecoder or txpachube.decode.ProcessDecoder
+        @param decode_threshold: The size, in bytes, of the response bodies that
+                                 are passed to the decoder.
+        @type decode_threshold: int
+        @param numeric_values: If set, datastream and datapoint values of the
+                               structures returned are converted to numbers
+                               of this kind. See txpachube.numeric.
+        @type numeric_values: string [float|decimal]
+        @param intern_table: An optional table that repeated values, such as
+                             datastream ids and tags, of the structures
+                             returned are shared through.
+        @type intern_table: txpachube.interning.InternTable
         
         """
         self.feed_id = feed_id
         self.api_key = api_key
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.circuit_breakers = circuit_breakers
+        self.timeout = timeout
+        self.instrumentation = instrumentation
+        self.store = store
+        self.decoder = decoder
+        self.decode_threshold = decode_threshold
+        self.numeric_values = numeric_values
+        self.intern_table = intern_table
+        self.clock = reactor
 
         prefix = "https"
         if use_http:
@@ -119,12 +329,18 @@ class Client(object):
         
         # The agent web client is responsible for handling all 
         # requests to and responses from the pachube site.
-        self.agent = Agent(reactor)
+        if pool is not None:
+            self.agent = Agent(reactor, pool=pool)
+        else:
+            self.agent = Agent(reactor)
         
         # Common header settings used in every request.
         self.headers = {'User-Agent': 'txpachube Client',
                         'Content-Type' : 'application/x-www-form-urlencoded'}    
         
+        # Precomputed urls and per api key headers.
+        self.templates = RequestTemplates(self.api_url, self.headers)
+        
             
     #
     # Callbacks
@@ -147,10 +363,10 @@ class Client(object):
         and the response body.
         @rtype: twisted.internet.defer.Deferred      
         """
-        logging.debug("Success communicating with url: %s" % (url))
-        finished = defer.Deferred()
-        response.deliverBody(ResponseBodyProtocol(finished, response))
-        return finished
+        logging.debug("Success communicating with url: %s", url)
+        protocol = ResponseBodyProtocol(response)
+        response.deliverBody(protocol)
+        return protocol.finished
 
 
     def _handleRequestFailure(self, failure, url=None):
@@ -168,13 +384,51 @@ class Client(object):
             logging.error('Error detected: %s' % (failure))
     
     
-    def _convertToPachubeStructure(self, data, format, kind):
+    def _convertToPachubeStructure(self, data, format, kind, method):
         """
-        Convert the data into a DataStructure object
+        Convert the data into a DataStructure object. The decode time is
+        recorded against the method of the request the data came from.
         """
+        if self.instrumentation:
+            started = self.instrumentation.clock.seconds()
         dataStructureClass = txpachube.getDataStructure(kind)
         dataStructure = dataStructureClass()
         dataStructure.decode(data, format)
+        if self.instrumentation:
+            self.instrumentation.record(txpachube.instrument.Decode_Time, self.instrumentation.clock.seconds() - started,
+                                        method, Structure_Endpoints.get(kind, 'other'))
+        return dataStructure
+
+
+    def _decodeStructure(self, data, format, kind, method):
+        """
+        Convert the data into a DataStructure object, in the decoder if the
+        client has one and the data is larger than the decode threshold.
+        
+        @param method: The method of the request that returned the data
+        @type method: string
+        
+        @return: A deferred that returns the DataStructure
+        @rtype: defer.Deferred
+        """
+        if self.decoder is None or len(data) < self.decode_threshold:
+            d = defer.maybeDeferred(self._convertToPachubeStructure, data, format, kind, method)
+        else:
+            d = self.decoder.decode(kind, data, format)
+            if self.instrumentation:
+                # the time spent waiting for the decoder is included
+                started = self.instrumentation.clock.seconds()
+                d.addCallback(self._recordDecode, kind, method, started)
+        if self.intern_table is not None:
+            d.addCallback(self.intern_table.internStructure)
+        if self.numeric_values:
+            d.addCallback(txpachube.numeric.typeValues, self.numeric_values)
+        return d
+
+
+    def _recordDecode(self, dataStructure, kind, method, started):
+        self.instrumentation.record(txpachube.instrument.Decode_Time, self.instrumentation.clock.seconds() - started,
+                                    method, Structure_Endpoints.get(kind, 'other'))
         return dataStructure
 
 
@@ -225,7 +479,7 @@ class Client(object):
     #
     
     @defer.inlineCallbacks
-    def _sendRequest(self, method, url, headers, bodyProducer):
+    def _sendRequest(self, method, url, headers, bodyProducer, timeout=None):
         """
         Send a request to the url, where the method argument defines the kind of request.
         Returns a deferred that returns a tuple containing the response header and the
@@ -235,33 +489,158 @@ class Client(object):
         @type method: string
         @param url: The url used during the request
         @type url: string
-        @param headers: A dict of header key value pairs to be used in the request
-        @type headers: dict
+        @param headers: The headers to be used in the request, either built by
+                        the request templates or a dict of header key value
+                        pairs to which the common headers are added.
+        @type headers: twisted.web.http_headers.Headers or dict
         @param bodyProducer: An object implementing IBodyProducer that is capable
                              of being used to send the request body data.
+        @param timeout: The time, in seconds, to wait for the request to complete,
+                        including any retries. If not set the client's default
+                        timeout is used.
+        @type timeout: float
         
         @return:  A deferred that returns a result tuple containing the response,
-        and the response body.
+        and the response body. If the request fails the deferred errbacks. If the
+        request times out it errbacks with a twisted.internet.error.TimeoutError.
+        Cancelling the deferred abandons the request and its connection.
         @rtype: twisted.internet.defer.Deferred        
         """
-        headers.update(self.headers)
-        logging.debug("method=%s, url=%s, headers=%s, bodyLength=%s" % (method,
-                                                                        url,
-                                                                        str(headers),
-                                                                        bodyProducer.length if bodyProducer else 0))
+        if isinstance(headers, Headers):
+            requestHeaders = headers
+        else:
+            headers.update(self.headers)
+            requestHeaders = Headers(dict([(k, [v]) for k,v in headers.items()]))
+        # formatted lazily, only when debug logging is enabled
+        logging.debug("method=%s, url=%s, headers=%s, bodyLength=%s", method, url, requestHeaders,
+                      bodyProducer.length if bodyProducer else 0)
+        # set once the request has timed out, so the attempt in flight when
+        # the timeout cancels it is recorded as timed out
+        timedOut = []
+        if self.retry_policy:
+            d = self.retry_policy.call(getEndpoint(url), method, self._attemptRequest,
+                                       method, url, requestHeaders, bodyProducer, timedOut)
+        else:
+            d = self._attemptRequest(method, url, requestHeaders, bodyProducer, timedOut)
+        if timeout is None:
+            timeout = self.timeout
+        if timeout:
+            self._applyTimeout(d, timeout, url, timedOut)
+        if self.instrumentation:
+            started = self.instrumentation.clock.seconds()
+            d.addBoth(self._recordTotal, method, url, started)
         try:
-            response = yield self.agent.request(method=method,
-                                                uri=url,
-                                                headers=Headers(dict([(k, [v]) for k,v in headers.items()])),
-                                                bodyProducer=bodyProducer)
-            (response, responseBody) = yield self._handleResponseHeader(response, url)
-            defer.returnValue((response, responseBody))
+            result = yield d
         except Exception, ex:
             self._handleRequestFailure(ex, url)
-            defer.returnValue(None)
+            raise
+        defer.returnValue(result)
+
+
+    def _recordTotal(self, result, method, url, started):
+        """
+        Record the total time taken by a call, including any retries.
+        """
+        self.instrumentation.record(txpachube.instrument.Total_Time, self.instrumentation.clock.seconds() - started,
+                                    method, getEndpoint(url))
+        return result
+
+
+    def _applyTimeout(self, d, timeout, url, timedOut):
+        """
+        Cancel a request deferred if it has not fired within the timeout. A
+        cancellation caused by the timeout is reported as a TimeoutError.
+        timedOut is appended to before the deferred is cancelled.
+        """
+        def expire():
+            timedOut.append(True)
+            d.cancel()
+
+        call = self.clock.callLater(timeout, expire)
+
+        def done(result):
+            if call.active():
+                call.cancel()
+            if timedOut and isinstance(result, failure.Failure) and result.check(defer.CancelledError):
+                raise error.TimeoutError("Request to %s timed out after %ss" % (url, timeout))
+            return result
+
+        d.addBoth(done)
+        
+        
+    def _attemptRequest(self, method, url, headers, bodyProducer, timedOut=None):
+        """
+        Make a single attempt at sending a request.
+        
+        @param method: The kind of request to make. [GET|PUT|POST|DELETE]
+        @type method: string
+        @param url: The url used during the request
+        @type url: string
+        @param headers: The headers to be used in the request
+        @type headers: twisted.web.http_headers.Headers
+        @param bodyProducer: An object implementing IBodyProducer that is capable
+                             of being used to send the request body data.
+        @param timedOut: A list that is not empty once the request has timed out
+        @type timedOut: list
+        
+        @return:  A deferred that returns a result tuple containing the response,
+        and the response body.
+        @rtype: twisted.internet.defer.Deferred        
+        """
+        breaker = None
+        if self.circuit_breakers:
+            breaker = self.circuit_breakers.get(getEndpoint(url))
+            if breaker.isOpen():
+                # fail fast rather than wait for a rate limit token
+                return self._circuitOpen(breaker)
+
+        if self.rate_limiter:
+            api_key = headers.getRawHeaders('X-PachubeApiKey', [None])[0]
+            d = self.rate_limiter.acquire(api_key, method)
+            d.addCallback(lambda _: self._allowedRequest(method, url, headers, bodyProducer, breaker, timedOut))
+        else:
+            d = self._allowedRequest(method, url, headers, bodyProducer, breaker, timedOut)
+        return d
+
+
+    def _allowedRequest(self, method, url, headers, bodyProducer, breaker=None, timedOut=None):
+        """
+        Send a request if its circuit breaker allows it. The breaker is only
+        asked once the request is about to be sent, so a half open probe is
+        not held while the request waits for its rate limit.
+        """
+        if breaker and not breaker.allowRequest():
+            return self._circuitOpen(breaker)
+        return self._request(method, url, headers, bodyProducer, breaker, timedOut)
+
+
+    def _circuitOpen(self, breaker):
+        return defer.fail(txpachube.breaker.CircuitOpenError("Circuit open for %s requests" % breaker.endpoint))
+
+
+    def _request(self, method, url, headers, bodyProducer, breaker=None, timedOut=None):
+        """
+        Send a request and retrieve the response body. If a circuit breaker
+        is passed in it is told the outcome and latency of the request, and
+        a request cancelled by its timeout counts as a failure.
+        """
+        if self.instrumentation:
+            timer = self.instrumentation.timer(method, getEndpoint(url), bodyProducer)
+        d = self.agent.request(method=method,
+                               uri=url,
+                               headers=headers,
+                               bodyProducer=bodyProducer)
+        if self.instrumentation:
+            d.addCallback(timer.headers)
+        d.addCallback(self._handleResponseHeader, url)
+        if self.instrumentation:
+            d.addCallback(timer.body)
+        if breaker:
+            breaker.observe(d, timedOut=(lambda: bool(timedOut)))
+        return d
 
 
-    def _get(self, url, headers):
+    def _get(self, url, headers, timeout=None):
         """ 
         Perform a get at the specified url 
         
@@ -269,15 +648,17 @@ class Client(object):
         @type url: string
         @param headers: A dict of header key value pairs to be used in the request
         @type headers: dict
+        @param timeout: The time, in seconds, to wait for the request to complete
+        @type timeout: float
 
         @return:  A deferred that returns a result tuple containing the response,
         and the response body.
         @rtype: twisted.internet.defer.Deferred
         """
-        return self._sendRequest("GET", url, headers, None)
+        return self._sendRequest("GET", url, headers, None, timeout)
         
         
-    def _put(self, url, headers, data):
+    def _put(self, url, headers, data, timeout=None):
         """ 
         Perform a put at the specified url 
         
@@ -285,17 +666,22 @@ class Client(object):
         @type url: string
         @param headers: A dict of header key value pairs to be used in the request
         @type headers: dict
-        @param data: The data that forms the body of the request.
-        @type data: string
+        @param data: The data that forms the body of the request, or a
+                     producer of it such as a txpachube.encoder.StructureBodyProducer
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete
+        @type timeout: float
 
         @return:  A deferred that returns a result tuple containing the response,
         and the response body.
         @rtype: twisted.internet.defer.Deferred
         """
-        return self._sendRequest("PUT", url, headers, RequestBodyProducer(data))
+        if not IBodyProducer.providedBy(data):
+            data = RequestBodyProducer(data)
+        return self._sendRequest("PUT", url, headers, data, timeout)
     
     
-    def _post(self, url, headers, data):
+    def _post(self, url, headers, data, timeout=None):
         """ 
         Perform a post at the specified url 
         
@@ -303,17 +689,22 @@ class Client(object):
         @type url: string
         @param headers: A dict of header key value pairs to be used in the request
         @type headers: dict
-        @param data: The data that forms the body of the request.
-        @type data: string
+        @param data: The data that forms the body of the request, or a
+                     producer of it such as a txpachube.encoder.StructureBodyProducer
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete
+        @type timeout: float
 
         @return:  A deferred that returns a result tuple containing the response,
         and the response body.
         @rtype: twisted.internet.defer.Deferred
         """
-        return self._sendRequest("POST", url, headers, RequestBodyProducer(data))       
+        if not IBodyProducer.providedBy(data):
+            data = RequestBodyProducer(data)
+        return self._sendRequest("POST", url, headers, data, timeout)       
     
     
-    def _delete(self, url, headers):
+    def _delete(self, url, headers, timeout=None):
         """ 
         Perform a delete at the specified url
         
@@ -321,12 +712,14 @@ class Client(object):
         @type url: string
         @param headers: A dict of header key value pairs to be used in the request
         @type headers: dict
+        @param timeout: The time, in seconds, to wait for the request to complete
+        @type timeout: float
 
         @return:  A deferred that returns a result tuple containing the response,
         and the response body.
         @rtype: twisted.internet.defer.Deferred
         """
-        return self._sendRequest("DELETE", url, headers, None)        
+        return self._sendRequest("DELETE", url, headers, None, timeout)        
         
     
     #
@@ -334,7 +727,7 @@ class Client(object):
     #
     
     @defer.inlineCallbacks
-    def list_feeds(self, api_key=None, format=txpachube.DataFormats.JSON, parameters=None):
+    def list_feeds(self, api_key=None, format=txpachube.DataFormats.JSON, parameters=None, timeout=None):
         """ 
         Returns a paged list of Pachube's feeds that are viewable by 
         the authenticated account with a default page size of 50 feeds.
@@ -345,6 +738,9 @@ class Client(object):
         @type format: string
         @param parameters: Additional parameters to configure the search query.
         @type parameters: dict
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the response body which is a paged
                  list of feeds (default 50 per page) viewable by the api_key 
@@ -427,24 +823,20 @@ class Client(object):
         value set during this object's instantiation (ie. in __init__) is used.        
         """
         
-        url = "%s/feeds.%s" % (self.api_url, format)
-        
-        if parameters:
-            params = urllib.urlencode(parameters)
-            url = "%s?%s" % (url, params)
+        url = self.templates.url('feeds', (format,), parameters)
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
     
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.List_Feeds_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.List_Feeds_Msg, "GET")
         defer.returnValue(dataStructure)
         
     
     @defer.inlineCallbacks  
-    def create_feed(self, api_key=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_feed(self, api_key=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """ 
         Creates a new feed.
         
@@ -453,7 +845,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: A string detailing the environment to be created.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the feed_id of the newly created feed. 
         @rtype: string
@@ -464,14 +859,14 @@ class Client(object):
         if format == txpachube.DataFormats.CSV:
             raise Exception("CSV format is not supported for creating feeds")
         
-        url = "%s/feeds.%s" % (self.api_url, format)
+        url = self.templates.url('feeds', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
     
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         location = self._getLocationFromHeader(response)
         feed_id = location.split("/")[-1]
         defer.returnValue(feed_id)
@@ -479,7 +874,7 @@ class Client(object):
         
     
     @defer.inlineCallbacks
-    def read_feed(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, parameters=None):
+    def read_feed(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, parameters=None, timeout=None):
         """ 
         Returns the most recent datastreams for environment [feed_id], viewable by the api_key provided
         
@@ -491,6 +886,9 @@ class Client(object):
         @type format: string
         @param parameters: Additional parameters to configure the search query.
         @type parameters: dict
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a txpachube.Environment object populated
                  from the body of the response.
@@ -585,24 +983,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s.%s" % (self.api_url, feed_id, format)
-        
-        if parameters:
-            params = urllib.urlencode(parameters)
-            url = "%s?%s" % (url, params)
+        url = self.templates.url('feed', (feed_id, format), parameters)
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_Feed_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_Feed_Msg, "GET")
         defer.returnValue(dataStructure)
         
     
     @defer.inlineCallbacks    
-    def update_feed(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def update_feed(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Updates [environment ID]'s environment and datastreams. If successful, the 
         current datastream values are stored and any changes in environment metadata
@@ -616,7 +1010,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: A representation of the feed in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success of the update based on
                  the response header data. 
@@ -628,20 +1025,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s.%s" % (self.api_url, feed_id, format)
+        url = self.templates.url('feed', (feed_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._put(url, headers, data)
+        (response, responseBody) = yield self._put(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
 
     
     @defer.inlineCallbacks
-    def delete_feed(self, api_key=None, feed_id=None):
+    def delete_feed(self, api_key=None, feed_id=None, timeout=None):
         """
         The DELETE request does not require a format to be used. A request made to 
         this URL will delete the object referred to by the ID. 
@@ -651,6 +1048,9 @@ class Client(object):
         @type api_key: string
         @param feed_id: The feed identifier
         @type feed_id: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success of the delete based on
                  the response header data. 
@@ -662,14 +1062,14 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s" % (self.api_url, feed_id)
+        url = self.templates.url('feed_delete', (feed_id,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
     
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
 
@@ -679,7 +1079,7 @@ class Client(object):
     #
     
     @defer.inlineCallbacks
-    def create_datastream(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_datastream(self, api_key=None, feed_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Creates new datastream(s) in environment [feed ID]. The body of the request 
         should contain a JSON, XML or CSV representation of the datastream to be created.
@@ -701,7 +1101,10 @@ class Client(object):
                             }
                           ], 
                         }
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the datastream_id of the created datastream
                  or None. 
@@ -713,21 +1116,21 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams.%s" % (self.api_url, feed_id, format)
+        url = self.templates.url('datastreams', (feed_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         location = self._getLocationFromHeader(response)
         datastream_id = location.split("/")[-1]
         defer.returnValue(datastream_id)
                            
     
     @defer.inlineCallbacks
-    def read_datastream(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, parameters=None): 
+    def read_datastream(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, parameters=None, timeout=None): 
         """
         Read the requested datastream.
 
@@ -741,6 +1144,9 @@ class Client(object):
         @type format: string
         @param parameters: Additional parameters to configure the png output.
         @type parameters: dict
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
 
         @return: A deferred that returns a txpachube.Datastream object or None
         @rtype: txpachube.Datastream
@@ -840,27 +1246,178 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s.%s" % (self.api_url, feed_id, datastream_id, format)
-        
-        if parameters:
-            params = urllib.urlencode(parameters)
-            url = "%s?%s" % (url, params)
+        url = self.templates.url('datastream', (feed_id, datastream_id, format), parameters)
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
         if format == txpachube.DataFormats.PNG:
             defer.returnValue(responseBody)
         else:
-            dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_Datastream_Msg)
+            dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_Datastream_Msg, "GET")
+            if self.store:
+                self._storeHistory(feed_id, datastream_id, parameters, dataStructure)
             defer.returnValue(dataStructure)
+
+
+    def _storeHistory(self, feed_id, datastream_id, parameters, datastream):
+        """
+        Record the raw datapoints of a read_datastream result in the store.
+        The time range requested is covered unless the result may have
+        been truncated, in which case only the range up to the last
+        datapoint returned is covered.
+        """
+        parameters = parameters or {}
+        if str(parameters.get('interval', 0)) != '0' or 'interval_type' in parameters or 'time' in parameters:
+            # not raw history
+            return
+        start = end = None
+        if ('start' in parameters and 'end' in parameters and 'duration' not in parameters and
+            str(parameters.get('page', 1)) == '1'):
+            start = txpachube.store.parseTimestamp(parameters['start'])
+            end = min(txpachube.store.parseTimestamp(parameters['end']), self.clock.seconds())
+            if len(datastream.datapoints) >= int(parameters.get('per_page', Default_Per_Page)):
+                end = max([txpachube.store.parseTimestamp(dp.at) for dp in datastream.datapoints])
+        if datastream.datapoints or start is not None:
+            self.store.recordHistory(feed_id, datastream_id, datastream.datapoints, start, end)
+
+
+    @defer.inlineCallbacks
+    def read_datastream_history(self, api_key=None, feed_id=None, datastream_id=None, start=None, end=None, timeout=None):
+        """
+        Read the raw datapoints of a datastream within a time range, using the
+        client's store. Only the parts of the range not already held by the
+        store are read from Pachube, in windows no longer than the maximum
+        range of a raw history query.
+
+        @param api_key: An api key with authorization settings allowing this action to be performed
+        @type api_key: string
+        @param feed_id: The feed identifier
+        @type feed_id: string
+        @param datastream_id: A datastream identifier
+        @type datastream_id: string
+        @param start: The start of the range as a timestamp, e.g. 2010-05-20T11:01:46Z
+        @type start: string
+        @param end: The end of the range as a timestamp. Defaults to the current time.
+        @type end: string
+        @param timeout: The time, in seconds, to wait for each request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
+
+        @return: A deferred that returns a txpachube.Datastream object holding
+                 the datapoints within the range.
+        @rtype: txpachube.Datastream
+        """
+        if self.store is None:
+            err_str = "read_datastream_history requires the client to have a store"
+            logging.error(err_str)
+            raise Exception(err_str)
+
+        if feed_id is None:
+            feed_id = self.feed_id
+
+        startSeconds = txpachube.store.parseTimestamp(start)
+        endSeconds = self.clock.seconds()
+        if end is not None:
+            endSeconds = min(endSeconds, txpachube.store.parseTimestamp(end))
+
+        previousGap = None
+        while True:
+            gaps = self.store.gaps(feed_id, datastream_id, startSeconds, endSeconds)
+            if not gaps:
+                break
+            if gaps[0] == previousGap:
+                logging.warning("Unable to fill gap %s in history of datastream %s/%s" % (previousGap, feed_id, datastream_id))
+                break
+            previousGap = gaps[0]
+            gapStart, gapEnd = gaps[0]
+            parameters = {'start' : txpachube.store.formatTimestamp(gapStart),
+                          'end' : txpachube.store.formatTimestamp(min(gapEnd, gapStart + Raw_History_Window)),
+                          'per_page' : Max_Per_Page}
+            yield self.read_datastream(api_key=api_key, feed_id=feed_id, datastream_id=datastream_id,
+                                       parameters=parameters, timeout=timeout)
+
+        datastream = txpachube.Datastream(id=datastream_id)
+        datastream.datapoints = self.store.query(feed_id, datastream_id, startSeconds, endSeconds)
+        defer.returnValue(datastream)
                  
     
+    @defer.inlineCallbacks
+    def read_datastream_downsampled(self, api_key=None, feed_id=None, datastream_id=None, start=None, end=None,
+                                    points=500, timeout=None):
+        """
+        Read the history of a datastream downsampled by Pachube to roughly the
+        number of points wanted. The coarsest interval giving at least that
+        many points is requested, using the fewest windowed queries allowed.
+
+        @param api_key: An api key with authorization settings allowing this action to be performed
+        @type api_key: string
+        @param feed_id: The feed identifier
+        @type feed_id: string
+        @param datastream_id: A datastream identifier
+        @type datastream_id: string
+        @param start: The start of the range as a timestamp, e.g. 2010-05-20T11:01:46Z
+        @type start: string
+        @param end: The end of the range as a timestamp. Defaults to the current time.
+        @type end: string
+        @param points: The number of points wanted
+        @type points: int
+        @param timeout: The time, in seconds, to wait for each request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
+
+        @return: A deferred that returns a txpachube.Datastream object holding
+                 the datapoints within the range.
+        @rtype: txpachube.Datastream
+        """
+        startSeconds = txpachube.store.parseTimestamp(start)
+        endSeconds = self.clock.seconds()
+        if end is not None:
+            endSeconds = txpachube.store.parseTimestamp(end)
+        plan = txpachube.history.planQuery(startSeconds, endSeconds, points)
+        logging.debug("Reading datastream %s/%s history with %s" % (feed_id, datastream_id, plan))
+
+        windows = [self._readHistoryWindow(api_key, feed_id, datastream_id, parameters, timeout)
+                   for parameters in plan.parameters(txpachube.store.formatTimestamp)]
+        try:
+            results = yield defer.gatherResults(windows, consumeErrors=True)
+        except defer.FirstError, ex:
+            ex.subFailure.raiseException()
+
+        # windows share their boundaries so may return the same datapoint
+        datapoints = dict()
+        for windowDatapoints in results:
+            for datapoint in windowDatapoints:
+                datapoints[txpachube.store.parseTimestamp(datapoint.at)] = datapoint
+        datastream = txpachube.Datastream(id=datastream_id)
+        datastream.datapoints = [datapoints[t] for t in sorted(datapoints)]
+        defer.returnValue(datastream)
+
+
+    @defer.inlineCallbacks
+    def _readHistoryWindow(self, api_key, feed_id, datastream_id, parameters, timeout):
+        """
+        Read all the datapoints of one history query, continuing from the
+        last datapoint read while pages are full.
+        """
+        datapoints = []
+        while True:
+            datastream = yield self.read_datastream(api_key=api_key, feed_id=feed_id, datastream_id=datastream_id,
+                                                    parameters=parameters, timeout=timeout)
+            page = [dp for dp in datastream.datapoints if dp.at]
+            datapoints.extend(page)
+            if len(page) < parameters['per_page']:
+                break
+            parameters = dict(parameters)
+            parameters['start'] = max(page, key=lambda dp: txpachube.store.parseTimestamp(dp.at)).at
+        defer.returnValue(datapoints)
+
+
     @defer.inlineCallbacks    
-    def update_datastream(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def update_datastream(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Update a single datastream
 
@@ -873,7 +1430,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: A representation of the datastream in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success of the create based on
                  the response header data. 
@@ -885,20 +1445,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s.%s" % (self.api_url, feed_id, datastream_id, format)
+        url = self.templates.url('datastream', (feed_id, datastream_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}      
+        headers = self.templates.headers(api_key)      
 
-        (response, responseBody) = yield self._put(url, headers, data)
+        (response, responseBody) = yield self._put(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
                 
     
     @defer.inlineCallbacks   
-    def delete_datastream(self, api_key=None, feed_id=None, datastream_id=None): 
+    def delete_datastream(self, api_key=None, feed_id=None, datastream_id=None, timeout=None): 
         """
         The DELETE request does not require a format to be used. A request made to 
         this URL will delete the object referred to by the ID. 
@@ -910,6 +1470,9 @@ class Client(object):
         @type feed_id: string
         @param datastream_id: A datastream identifier
         @type datastream_id: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the datastream delete. 
         @rtype: boolean
@@ -920,14 +1483,14 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s" % (self.api_url, feed_id, datastream_id)
+        url = self.templates.url('datastream_delete', (feed_id, datastream_id))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
             
@@ -937,7 +1500,7 @@ class Client(object):
     #
     
     @defer.inlineCallbacks
-    def create_datapoints(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_datapoints(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Creates new datapoints for datastream. The body of the request 
         should contain a JSON, XML or CSV representation of the datastream to be created.
@@ -963,7 +1526,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: A representation of the datastream in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the create action. 
         @rtype: boolean
@@ -974,20 +1540,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s/datapoints.%s" % (self.api_url, feed_id, datastream_id, format)
+        url = self.templates.url('datapoints', (feed_id, datastream_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
             
     
     @defer.inlineCallbacks
-    def read_datapoint(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, timestamp=None): 
+    def read_datapoint(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, timestamp=None, timeout=None): 
         """
         Read a specific datapoint from the specified timestamp.
 
@@ -1004,6 +1570,9 @@ class Client(object):
                           2012-02-22T11:22:31.130138Z
                           2012-02-22T11:22:31.130138+09:30
         @type timestamp: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
 
         @return: A deferred that returns the a txpachube.Datapoint object or None
         @rtype: string (in the format specified by the format argument)
@@ -1014,26 +1583,26 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s/datapoints/%s.%s" % (self.api_url, feed_id, datastream_id, timestamp, format)
+        url = self.templates.url('datapoint', (feed_id, datastream_id, timestamp, format))
 
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
 
         if "Not found" in responseBody:
             # the specified datapoint could not be found
             logging.info("The specified datapoint [%s] could not be found" % timestamp)
             defer.returnValue(None)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_Datapoint_Msg)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_Datapoint_Msg, "GET")
         defer.returnValue(dataStructure)
             
     
     @defer.inlineCallbacks
-    def update_datapoint(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, timestamp=None, data=None):
+    def update_datapoint(self, api_key=None, feed_id=None, datastream_id=None, format=txpachube.DataFormats.JSON, timestamp=None, data=None, timeout=None):
         """
         Modify the value of a datapoint at the specified timestamp
 
@@ -1051,7 +1620,10 @@ class Client(object):
                           2012-02-22T11:22:31.130138+09:30
         @type timestamp: string
         @param data: A representation of the updated datapoint in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status from updating the datapoint
         @rtype: boolean
@@ -1062,20 +1634,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s/datapoints/%s.%s" % (self.api_url, feed_id, datastream_id, timestamp, format)
+        url = self.templates.url('datapoint', (feed_id, datastream_id, timestamp, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}       
+        headers = self.templates.headers(api_key)       
 
-        (response, responseBody) = yield self._put(url, headers, data)
+        (response, responseBody) = yield self._put(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
         
     
     @defer.inlineCallbacks
-    def delete_datapoint(self, api_key=None, feed_id=None, datastream_id=None, timestamp=None):
+    def delete_datapoint(self, api_key=None, feed_id=None, datastream_id=None, timestamp=None, timeout=None):
         """
         Delete a single datapoint at the specified timestamp.
         This request does not require a format to be used.
@@ -1091,6 +1663,9 @@ class Client(object):
                           2012-02-22T11:22:31.130138Z
                           2012-02-22T11:22:31.130138+09:30
         @type parameters: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
 
         @return: A deferred that returns the success of the create based on
                  the response header data. 
@@ -1102,20 +1677,20 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s/datapoints/%s" % (self.api_url, feed_id, datastream_id, timestamp)
+        url = self.templates.url('datapoint_delete', (feed_id, datastream_id, timestamp))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
             
     
     @defer.inlineCallbacks    
-    def delete_datapoints(self, api_key=None, feed_id=None, datastream_id=None, parameters=None): 
+    def delete_datapoints(self, api_key=None, feed_id=None, datastream_id=None, parameters=None, timeout=None): 
         """
         Remove a range of datapoints for this datastream.
         This request does not require a format to be used
@@ -1160,6 +1735,9 @@ class Client(object):
         @type datastream_id: string
         @param parameters: Additional parameters to configure the png output.
         @type parameters: dict
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success of the create based on
                  the response header data. 
@@ -1171,18 +1749,14 @@ class Client(object):
         if feed_id is None:
             feed_id = self.feed_id
                     
-        url = "%s/feeds/%s/datastreams/%s/datapoints" % (self.api_url, feed_id, datastream_id)
-
-        if parameters:
-            params = urllib.urlencode(parameters)
-            url = "%s?%s" % (url, params)
+        url = self.templates.url('datapoints_delete', (feed_id, datastream_id), parameters)
                     
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
             
@@ -1192,7 +1766,7 @@ class Client(object):
     #
     
     @defer.inlineCallbacks
-    def list_triggers(self, api_key=None, format=txpachube.DataFormats.JSON):
+    def list_triggers(self, api_key=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Retrieve a list of all triggers for the authenticated account
 
@@ -1200,6 +1774,9 @@ class Client(object):
         @type api_key: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a list of triggers success of the create based on
                  the response header data. 
@@ -1208,20 +1785,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """     
-        url = "%s/triggers.%s" % (self.api_url, format)
+        url = self.templates.url('triggers', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.List_Triggers_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.List_Triggers_Msg, "GET")
         defer.returnValue(dataStructure)
         
                     
     @defer.inlineCallbacks    
-    def create_trigger(self, api_key=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_trigger(self, api_key=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Create a trigger
 
@@ -1230,7 +1807,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: Trigger definition in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the trigger_id of the newly created trigger. 
         @rtype: string
@@ -1239,21 +1819,21 @@ class Client(object):
         set during this object's instantiation (ie. in __init__) is used.        
         
         """       
-        url = "%s/triggers.%s" % (self.api_url, format)
+        url = self.templates.url('triggers', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         location = self._getLocationFromHeader(response)
         trigger_id = location.split("/")[-1]
         defer.returnValue(trigger_id)     
         
     
     @defer.inlineCallbacks    
-    def read_trigger(self, api_key=None, trigger_id=None, format=txpachube.DataFormats.JSON):
+    def read_trigger(self, api_key=None, trigger_id=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Returns a representation of a trigger 
         
@@ -1263,6 +1843,9 @@ class Client(object):
         @type trigger_id: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a taxpachube.Trigger object or None.
         @rtype: string
@@ -1270,20 +1853,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """      
-        url = "%s/triggers/%s.%s" % (self.api_url, trigger_id, format)
+        url = self.templates.url('trigger', (trigger_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)        
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_Trigger_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)        
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_Trigger_Msg, "GET")
         defer.returnValue(dataStructure)
                 
     
     @defer.inlineCallbacks    
-    def update_trigger(self, api_key=None, trigger_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def update_trigger(self, api_key=None, trigger_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Updates an existing trigger object. 
 
@@ -1294,7 +1877,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml]
         @type format: string
         @param data: A representation of the trigger in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the update action. 
         @rtype: boolean
@@ -1302,20 +1888,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.                
         """
-        url = "%s/triggers/%s.%s" % (self.api_url, trigger_id, format)
+        url = self.templates.url('trigger', (trigger_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._put(url, headers, data)
+        (response, responseBody) = yield self._put(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
         
 
     @defer.inlineCallbacks
-    def delete_trigger(self, api_key=None, trigger_id=None):
+    def delete_trigger(self, api_key=None, trigger_id=None, timeout=None):
         """
         Delete a trigger.
         WARNING: This is final and cannot be undone.
@@ -1324,6 +1910,9 @@ class Client(object):
         @type api_key: string
         @param trigger_id: The trigger identifier
         @type trigger_id: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the delete action. 
         @rtype: boolean
@@ -1331,14 +1920,14 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.      
         """           
-        url = "%s/triggers/%s" % (self.api_url, trigger_id)
+        url = self.templates.url('trigger_delete', (trigger_id,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)    
     
@@ -1349,7 +1938,7 @@ class Client(object):
     
     
     @defer.inlineCallbacks
-    def list_users(self, api_key=None, format=txpachube.DataFormats.JSON):
+    def list_users(self, api_key=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Retrieve a list of all users for the authenticated account
 
@@ -1357,6 +1946,9 @@ class Client(object):
         @type api_key: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a list of users in the format specified 
                  by the format argument. 
@@ -1365,20 +1957,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """     
-        url = "%s/users.%s" % (self.api_url, format)
+        url = self.templates.url('users', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.List_Users_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.List_Users_Msg, "GET")
         defer.returnValue(dataStructure)
             
     
     @defer.inlineCallbacks
-    def create_user(self, api_key=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_user(self, api_key=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Create a user
 
@@ -1387,7 +1979,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv]
         @type format: string
         @param data: User definition in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the user id of the created user or None. 
         @rtype: boolean
@@ -1395,21 +1990,21 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.        
         """      
-        url = "%s/users.%s" % (self.api_url, format)
+        url = self.templates.url('users', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         location = self._getLocationFromHeader(response)
         new_user = location.split("/")[-1]
         defer.returnValue(new_user)
 
     
     @defer.inlineCallbacks
-    def read_user(self, api_key=None, user_id=None, format=txpachube.DataFormats.JSON):
+    def read_user(self, api_key=None, user_id=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Returns the details of a specific user 
         
@@ -1419,6 +2014,9 @@ class Client(object):
         @type user_id: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a txpachube.User object or None
         @rtype: string
@@ -1426,20 +2024,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """      
-        url = "%s/users/%s.%s" % (self.api_url, user_id, format)
+        url = self.templates.url('user', (user_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_User_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_User_Msg, "GET")
         defer.returnValue(dataStructure)
         
     
     @defer.inlineCallbacks
-    def update_user(self, api_key=None, user_id=None, format=txpachube.DataFormats.JSON, data=None):
+    def update_user(self, api_key=None, user_id=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Updates details of an existing user object. 
 
@@ -1450,7 +2048,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml]
         @type format: string
         @param data: Details of the user in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the update user action. 
         @rtype: boolean
@@ -1458,20 +2059,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.                
         """
-        url = "%s/users/%s.%s" % (self.api_url, user_id, format)
+        url = self.templates.url('user', (user_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._put(url, headers, data)
+        (response, responseBody) = yield self._put(url, headers, data, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)    
     
 
     @defer.inlineCallbacks
-    def delete_user(self, api_key=None, user_id=None):
+    def delete_user(self, api_key=None, user_id=None, timeout=None):
         """
         Delete a user.
         WARNING: This is final and cannot be undone.
@@ -1480,6 +2081,9 @@ class Client(object):
         @type api_key: string
         @param user_id: The user identifier
         @type user_id: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success status of the delete user action. 
         @rtype: boolean
@@ -1487,14 +2091,14 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.      
         """
-        url = "%s/users/%s.%s" % (self.api_url, user_id, format)
+        url = self.templates.url('user', (user_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
         
@@ -1505,7 +2109,7 @@ class Client(object):
     
     
     @defer.inlineCallbacks
-    def list_api_keys(self, api_key=None, format=txpachube.DataFormats.JSON):
+    def list_api_keys(self, api_key=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Retrieve a list of all keys for the authenticated account.
 
@@ -1513,6 +2117,9 @@ class Client(object):
         @type api_key: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a keys the response header data. 
         @rtype: boolean
@@ -1520,20 +2127,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """     
-        url = "%s/keys.%s" % (self.api_url, format)
+        url = self.templates.url('keys', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.List_Keys_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.List_Keys_Msg, "GET")
         defer.returnValue(dataStructure)    
     
     
     @defer.inlineCallbacks
-    def create_api_key(self, api_key=None, format=txpachube.DataFormats.JSON, data=None):
+    def create_api_key(self, api_key=None, format=txpachube.DataFormats.JSON, data=None, timeout=None):
         """
         Create a new API key
 
@@ -1542,7 +2149,10 @@ class Client(object):
         @param format: The format to request the results in [json|xml|csv|png]
         @type format: string
         @param data: key definition in the appropriate format.
-        @type data: string
+        @type data: string or IBodyProducer
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the api key of the new key. 
         @rtype: string
@@ -1551,21 +2161,21 @@ class Client(object):
         set during this object's instantiation (ie. in __init__) is used.        
         
         """         
-        url = "%s/keys.%s" % (self.api_url, format)
+        url = self.templates.url('keys', (format,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._post(url, headers, data)
+        (response, responseBody) = yield self._post(url, headers, data, timeout=timeout)
         location = self._getLocationFromHeader(response)
         new_api_key = location.split("/")[-1]
         defer.returnValue(new_api_key)
 
 
     @defer.inlineCallbacks
-    def read_api_key(self, api_key=None, key_id=None, format=txpachube.DataFormats.JSON):
+    def read_api_key(self, api_key=None, key_id=None, format=txpachube.DataFormats.JSON, timeout=None):
         """ 
         Returns the details of a specific API Key 
         
@@ -1575,6 +2185,9 @@ class Client(object):
         @type key_id: string
         @param format: The format to request the results in [json|xml]
         @type format: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns a txpachube.Key object or None
         @rtype: string
@@ -1582,20 +2195,20 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.
         """      
-        url = "%s/keys/%s.%s" % (self.api_url, key_id, format)
+        url = self.templates.url('key', (key_id, format))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._get(url, headers)
-        dataStructure = self._convertToPachubeStructure(responseBody, format, txpachube.View_Key_Msg)
+        (response, responseBody) = yield self._get(url, headers, timeout=timeout)
+        dataStructure = yield self._decodeStructure(responseBody, format, txpachube.View_Key_Msg, "GET")
         defer.returnValue(dataStructure)
             
     
     @defer.inlineCallbacks
-    def delete_api_key(self, api_key=None, key_id=None):
+    def delete_api_key(self, api_key=None, key_id=None, timeout=None):
         """
         Delete a API key.
         WARNING: This is final and cannot be undone.
@@ -1604,6 +2217,9 @@ class Client(object):
         @type api_key: string
         @param key_id: The API key identifier
         @type key_id: string
+        @param timeout: The time, in seconds, to wait for the request to complete.
+                        If not set the client's default timeout is used.
+        @type timeout: float
         
         @return: A deferred that returns the success of the delete key action.
         @rtype: boolean
@@ -1611,14 +2227,14 @@ class Client(object):
         If api_key argument is not set when calling this method then the default value
         set during this object's instantiation (ie. in __init__) is used.      
         """
-        url = "%s/keys/%s" % (self.api_url, key_id)
+        url = self.templates.url('key_delete', (key_id,))
         
         if api_key is None:
             api_key = self.api_key
             
-        headers = {'X-PachubeApiKey': api_key}
+        headers = self.templates.headers(api_key)
 
-        (response, responseBody) = yield self._delete(url, headers)
+        (response, responseBody) = yield self._delete(url, headers, timeout=timeout)
         response_code = self._getResponseCodeStatusFromHeader(response)
         defer.returnValue(response_code)
 
@@ -1690,11 +2306,20 @@ class PAWSProtocolFactory(ReconnectingClientFactory):
     port = 8081
     host = 'beta.pachube.com'
     
-    def __init__(self, messageHandler):
+    def __init__(self, messageHandler, connectionHandler=None):
         self.connection = None
         self.connected = False
         self.messageHandler = messageHandler
         
+        # An optional callable that is informed of every change in the
+        # connection state. The PAWSClient uses this to detect when a
+        # lost connection has been re-established.
+        self.connectionHandler = connectionHandler
+        
+        # Set when reading from the connection has been paused to apply
+        # backpressure. A paused state is carried across reconnections.
+        self.paused = False
+        
         # These attributes are used during the connect/disconnect sequence
         # to inform caller that the sequence has completed and to provide
         # the state of the connect/disconnect request.
@@ -1720,6 +2345,9 @@ class PAWSProtocolFactory(ReconnectingClientFactory):
             disconnectedState = not state
             self._disconnectDeferred.callback(disconnectedState)
             self._disconnectDeferred = None
+            
+        if self.connectionHandler:
+            self.connectionHandler(state)
 
         
     def connect(self):
@@ -1772,6 +2400,8 @@ class PAWSProtocolFactory(ReconnectingClientFactory):
         @type proto: a PAWSProtocol instance
         """
         self.connection = proto
+        if self.paused:
+            proto.transport.pauseProducing()
         self._connectionStateHandler(True)
         
         
@@ -1792,12 +2422,14 @@ class PAWSProtocolFactory(ReconnectingClientFactory):
 
     def clientConnectionLost(self, connector, reason):
         logging.debug('PAWS connection lost.  Reason: %s' %  reason)
+        self.connection = None
         self._connectionStateHandler(False)
         ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
         
         
     def clientConnectionFailed(self, connector, reason):
         logging.error('PAWS connection failed. Reason: %s' % reason)
+        self.connection = None
         self._connectionStateHandler(False)
         ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
 
@@ -1809,6 +2441,265 @@ class PAWSProtocolFactory(ReconnectingClientFactory):
         """
         self.connection.send(data)
 
+        
+    def pauseProducing(self):
+        """
+        Stop reading data from the PAWS service. This is used to apply
+        backpressure when received messages can not be processed quickly
+        enough.
+        """
+        self.paused = True
+        if self.connection:
+            self.connection.transport.pauseProducing()
+
+
+    def resumeProducing(self):
+        """
+        Resume reading data from the PAWS service.
+        """
+        self.paused = False
+        if self.connection:
+            self.connection.transport.resumeProducing()
+
+
+
+
+# Used to find the token and body in a PAWS message when a subscription
+# update is passed through without parsing the entire message.
+_rawTokenPattern = re.compile(r'"token"\s*:\s*"([^"]*)"')
+_rawBodyPattern = re.compile(r'"body"\s*:\s*')
+_rawDecoder = json.JSONDecoder()
+_resourcePattern = re.compile(r'^/feeds/([^/.]+)(?:/datastreams/([^/.]+))?')
+
+
+
+# Describes a change in the value of a datastream between two subscription
+# updates. Subscriptions made with diff enabled deliver a list of these.
+DatastreamChange = namedtuple('DatastreamChange', ['id', 'old_value', 'new_value', 'at'])
+
+
+
+class Subscription(object):
+    """
+    Holds the details of an active PAWS subscription. The token, resource
+    and handler are retained so that update messages can be routed to the
+    handler and so the subscription can be re-issued after a reconnection.
+    """
+    
+    # Passthrough modes. Instead of a txpachube data structure the handler
+    # receives the update message body as the raw JSON string received, or
+    # as the dict produced by parsing it.
+    PassthroughBytes = 'bytes'
+    PassthroughDict = 'dict'
+    Valid_Passthrough_Modes = [PassthroughBytes, PassthroughDict]
+    
+    
+    def __init__(self, token, resource, handler, dataStructureClass, conflate=False,
+                 passthrough=None, datastreams=None, diff=False):
+        """
+        @param token: The token used to subscribe to the resource
+        @type token: string
+        @param resource: The resource subscribed to
+        @type resource: string
+        @param handler: A callable that will receive the update data
+        @type handler: callable
+        @param dataStructureClass: The txpachube data structure class used
+                                   to decode update messages.
+        @type dataStructureClass: txpachube.DataStructure
+        @param conflate: When set, updates that are still waiting to be processed
+                         are merged with newer updates so only the latest state
+                         is delivered.
+        @type conflate: boolean
+        @param passthrough: If set, the handler receives the update message body
+                            undecoded, as a PassthroughBytes string or a
+                            PassthroughDict dict, instead of a data structure.
+        @type passthrough: string
+        @param datastreams: If set, only the datastreams with these identifiers
+                            are kept from feed updates, so only they are decoded.
+        @type datastreams: list
+        @param diff: When set, the last known value of each datastream is kept and
+                     the handler receives a list of DatastreamChange items for the
+                     datastreams whose value changed, instead of a data structure.
+        @type diff: boolean
+        """
+        if passthrough is not None and passthrough not in Subscription.Valid_Passthrough_Modes:
+            raise Exception("Invalid passthrough mode \'%s\' not in %s" % (passthrough,
+                                                                           Subscription.Valid_Passthrough_Modes))
+        if passthrough == Subscription.PassthroughBytes and (conflate or datastreams is not None):
+            raise Exception("Conflation and datastream selection require the update to be parsed, "
+                            "they can not be used with the %s passthrough mode" % passthrough)
+        if passthrough is not None and diff:
+            raise Exception("The diff and passthrough modes can not be used together")
+        self.token = token
+        self.resource = resource
+        self.handler = handler
+        self.dataStructureClass = dataStructureClass
+        self.conflate = conflate
+        self.passthrough = passthrough
+        self.datastreams = None
+        if datastreams is not None:
+            self.datastreams = frozenset(datastreams)
+        self.diff = diff
+        
+        # The last known (value, at) of each datastream, used in diff mode
+        self.lastState = dict()
+        
+        # The number of updates that were merged into a newer update
+        # instead of being delivered.
+        self.dropped = 0
+        
+        
+    def process(self, body):
+        """
+        Decode an update message body and pass it to the handler.
+        
+        @param body: The body of a subscription update message
+        @type body: dict, or string in the PassthroughBytes mode
+        """
+        update = self.decode(body)
+        if self.diff and not update:
+            # nothing changed
+            return
+        self.handler(update)
+        
+        
+    def decode(self, body):
+        """
+        Convert an update message body into the form delivered to the handler.
+        
+        @param body: The body of a subscription update message
+        @type body: dict, or string in the PassthroughBytes mode
+        """
+        if self.passthrough == Subscription.PassthroughBytes:
+            return body
+        
+        if self.datastreams is not None:
+            body = self.selectDatastreams(body)
+            
+        if self.passthrough == Subscription.PassthroughDict:
+            return body
+        if self.diff:
+            return self.changes(body)
+        return self.dataStructureClass(**body)
+    
+    
+    def changes(self, body):
+        """
+        Compare the datastream values in an update message body with the
+        last known values, record the new values and return the changes.
+        
+        Datastreams seen for the first time are reported with an old_value
+        of None. Datastreams absent from the update are left unchanged.
+        
+        @param body: The body of a feed or datastream update message
+        @type body: dict
+        
+        @return: The datastreams whose current value changed
+        @rtype: list of DatastreamChange
+        """
+        if self.dataStructureClass is txpachube.Datastream:
+            datastreams = [body]
+        else:
+            datastreams = body.get(txpachube.DataFields.Datastreams) or []
+            
+        changes = []
+        for datastream in datastreams:
+            datastream_id = datastream.get(txpachube.DataFields.Id)
+            value = datastream.get(txpachube.DataFields.Current_Value)
+            at = datastream.get(txpachube.DataFields.At)
+            previous = self.lastState.get(datastream_id)
+            if previous is None or previous[0] != value:
+                old_value = None
+                if previous is not None:
+                    old_value = previous[0]
+                changes.append(DatastreamChange(datastream_id, old_value, value, at))
+            self.lastState[datastream_id] = (value, at)
+        return changes
+    
+    
+    def selectDatastreams(self, body):
+        """
+        Return a copy of a feed update message body holding only the
+        selected datastreams.
+        
+        @param body: The body of a feed subscription update message
+        @type body: dict
+        
+        @rtype: dict
+        """
+        datastreams = body.get(txpachube.DataFields.Datastreams)
+        if not datastreams:
+            return body
+        selected = dict(body)
+        selected[txpachube.DataFields.Datastreams] = [d for d in datastreams if d.get(txpachube.DataFields.Id) in self.datastreams]
+        return selected
+        
+        
+    def merge(self, pendingBody, body):
+        """
+        Merge an update message body into an older one that has not been
+        processed yet, returning a body holding the newest state.
+        
+        Feed updates may not carry every datastream, so the datastreams
+        of the two bodies are combined with the newer values taking
+        precedence. Any other field is taken from the newer body.
+        
+        @param pendingBody: The body of the update waiting to be processed
+        @type pendingBody: dict
+        @param body: The body of the newer update
+        @type body: dict
+        
+        @return: The merged update message body
+        @rtype: dict
+        """
+        self.dropped += 1
+        merged = dict(pendingBody)
+        merged.update(body)
+        
+        pendingDatastreams = pendingBody.get(txpachube.DataFields.Datastreams)
+        datastreams = body.get(txpachube.DataFields.Datastreams)
+        if pendingDatastreams and datastreams:
+            combined = OrderedDict()
+            for datastream in pendingDatastreams + datastreams:
+                combined[datastream.get(txpachube.DataFields.Id)] = datastream
+            merged[txpachube.DataFields.Datastreams] = combined.values()
+        return merged
+
+
+
+class RecoveryReport(object):
+    """
+    Describes a session recovery performed by the PAWSClient after a lost
+    connection to the PAWS service was re-established.
+    """
+    
+    def __init__(self, outage, duration, resubscribed, failed, replayed):
+        """
+        @param outage: The number of seconds the connection was unavailable
+        @type outage: float
+        @param duration: The number of seconds from reconnection until every
+                         subscription had been re-established.
+        @type duration: float
+        @param resubscribed: The number of subscriptions re-established
+        @type resubscribed: int
+        @param failed: The tokens of subscriptions that could not be re-established
+        @type failed: list
+        @param replayed: The number of in-flight requests sent again
+        @type replayed: int
+        """
+        self.outage = outage
+        self.duration = duration
+        self.resubscribed = resubscribed
+        self.failed = failed
+        self.replayed = replayed
+        
+        
+    def __str__(self):
+        return "outage=%.3fs, recovery=%.3fs, resubscribed=%s, failed=%s, replayed=%s" % (self.outage,
+                                                                                            self.duration,
+                                                                                            self.resubscribed,
+                                                                                            len(self.failed),
+                                                                                            self.replayed)
 
 
 
@@ -1821,32 +2712,107 @@ class PAWSClient(object):
     The main feature of this class is its ability to subscribe to
     resource paths (e.g. feeds, datastreams) and get notified of
     updates when they occur.
+    
+    If the connection to the PAWS service is lost the factory will
+    reconnect automatically. Once reconnected the client recovers the
+    session by re-issuing the subscribe requests for all the active
+    subscriptions. Requests that were awaiting a response when the
+    connection was lost are either failed or sent again, according
+    to the pending_policy.
     """
     
-    def __init__(self, api_key=None, feed_id=None):
+    # Policies for requests awaiting a response when the connection is lost
+    FailPending = 'fail'
+    ReplayPending = 'replay'
+    Valid_Pending_Policies = [FailPending, ReplayPending]
+    
+    
+    def __init__(self, api_key=None, feed_id=None, pending_policy=FailPending,
+                 resubscribe_batch_size=20, resubscribe_interval=1.0, recoveryHandler=None,
+                 dispatcher=None, rate_limiter=None, store=None):
         """
         @param api_key: The api key, with appropriate authorization privileges to use.
         @type api_key: string
         @param feed_id: The default feed identifier to use
         @type feed_id: string
-        """
+        @param pending_policy: What to do with requests awaiting a response when
+                               the connection is lost. FailPending errbacks them
+                               immediately. ReplayPending holds them, and any
+                               requests made while disconnected, and sends them
+                               again once the connection is re-established.
+        @type pending_policy: string
+        @param resubscribe_batch_size: The maximum number of subscribe requests
+                                       sent at once during session recovery.
+        @type resubscribe_batch_size: int
+        @param resubscribe_interval: The delay, in seconds, between each batch
+                                     of subscribe requests during session recovery.
+        @type resubscribe_interval: float
+        @param recoveryHandler: An optional callable that is passed a RecoveryReport
+                                each time a session recovery completes.
+        @type recoveryHandler: callable
+        @param dispatcher: An optional dispatcher that processes subscription updates
+                           off the reactor thread. If not set, updates are decoded and
+                           passed to the subscription handler on the reactor thread.
+        @type dispatcher: txpachube.dispatch.SubscriptionDispatcher
+        @param rate_limiter: An optional rate limiter that delays requests so they
+                             stay within the Pachube API limits.
+        @type rate_limiter: txpachube.ratelimit.RateLimiter
+        @param store: An optional local store that records the datastream values
+                      received in subscription updates.
+        @type store: txpachube.store.TimeSeriesStore
+        """
+        if pending_policy not in PAWSClient.Valid_Pending_Policies:
+            raise Exception("Invalid pending policy \'%s\' not in %s" % (pending_policy,
+                                                                          PAWSClient.Valid_Pending_Policies))
         self.api_key = api_key
         self.feed_id = feed_id
+        self.pending_policy = pending_policy
+        self.resubscribe_batch_size = resubscribe_batch_size
+        self.resubscribe_interval = resubscribe_interval
+        self.recoveryHandler = recoveryHandler
+        self.rate_limiter = rate_limiter
+        self.store = store
 
         # Store the response callback processing chains associated with each request.
         # Responses can be associated to the originating requests through the token.
         # the token forms the key in this dict.
         self.pendingResponses = dict()
         
+        # When the ReplayPending policy is in use the serialized request of
+        # each pending response is kept so it can be sent again after a
+        # reconnection. An ordered dict keeps the replay in request order.
+        self._pendingMessages = OrderedDict()
+        
         # Subscriptions use the same token approach to map the message data to the 
-        # originating request. The values of each dict item is a tuple of the 
-        # callback handler function to pass the response data to and a txpachube
-        # data structure class that is used to decode the data upon its receipt.
+        # originating request. The values of each dict item is a Subscription
+        # holding the callback handler function to pass the response data to and
+        # a txpachube data structure class that is used to decode the data upon
+        # its receipt.
         self.subscriptionHandlers = dict()
         
+        # Tokens of the subscriptions using the PassthroughBytes mode. The
+        # update messages for these are routed without parsing the message.
+        self._passthroughBytesTokens = set()
+        
         self.headers = {'X-PachubeApiKey': self.api_key}
         
-        self.factory = PAWSProtocolFactory(self._messageHandler)
+        # Session recovery state. The clock is a separate attribute so that
+        # tests can substitute a deterministic one.
+        self.clock = reactor
+        self._sessionEstablished = False
+        self._connectionLostAt = None
+        self.lastRecovery = None
+        # the deferred of the most recent session recovery
+        self.recovery = None
+        # incremented for each recovery started, so a recovery can tell that
+        # a newer one has replaced it
+        self._recoveries = 0
+        
+        self.factory = PAWSProtocolFactory(self._messageHandler, self._connectionStateChanged)
+        
+        self.dispatcher = dispatcher
+        if self.dispatcher:
+            self.dispatcher.producer = self.factory
     
         
     def connect(self):
@@ -1889,18 +2855,24 @@ class PAWSClient(object):
         chain can process the message and return it to the caller.
         """
         logging.debug("PAWSClient has received a message:\n%s\n" % msg)
+        if self._passthroughBytesTokens:
+            token = self._getRawToken(msg)
+            if token in self._passthroughBytesTokens and token not in self.pendingResponses:
+                body = self._getRawResponseBody(msg)
+                if body is not None:
+                    self._deliver(self.subscriptionHandlers[token], body)
+                    return
+                
         data = json.loads(msg)
         token = data['token']
 
         if token in self.pendingResponses:
-            self.pendingResponses[token].callback(data)
-            del self.pendingResponses[token]
+            self._pendingMessages.pop(token, None)
+            self.pendingResponses.pop(token).callback(data)
 
         elif token in self.subscriptionHandlers:
             body = self._getResponseBody(data)
-            handler, dataStructureClass = self.subscriptionHandlers[token]
-            dataStructure = dataStructureClass(**body)
-            handler(dataStructure)            
+            self._deliver(self.subscriptionHandlers[token], body)
             
         else:
             logging.error("Unrecognised message with token %s not in pendingResponses or subscriptionHandlers" % token)
@@ -1909,11 +2881,177 @@ class PAWSClient(object):
             logging.error("No handler to process:\n%s\n" % json.dumps(data, sort_keys=True, indent=2))
   
   
+    def _deliver(self, subscription, body):
+        """
+        Pass a subscription update message body on for processing.
+        """
+        if self.store:
+            self._storeUpdate(subscription, body)
+        if self.dispatcher:
+            self.dispatcher.dispatch(subscription, body)
+        else:
+            subscription.process(body)
+            
+            
+    def _storeUpdate(self, subscription, body):
+        """
+        Record the datastream values in a subscription update in the store.
+        """
+        match = _resourcePattern.match(subscription.resource)
+        if match is None:
+            return
+        feed_id, datastream_id = match.groups()
+        if isinstance(body, basestring):
+            body = json.loads(body)
+        try:
+            if datastream_id is None:
+                for datastream in body.get(txpachube.DataFields.Datastreams, []):
+                    self.store.recordUpdate(feed_id, datastream)
+            else:
+                datastream = dict(body)
+                datastream.setdefault(txpachube.DataFields.Id, datastream_id)
+                self.store.recordUpdate(feed_id, datastream)
+        except Exception, ex:
+            logging.error("Unable to store update for %s: %s" % (subscription.resource, ex))
+
+
     def _generateToken(self):
         """
         Make a unique token that can be used to match requests with the response.
         """
         return str(uuid.uuid1())
+
+
+    #
+    # Session recovery
+    #
+    
+    
+    def _connectionStateChanged(self, connected):
+        """
+        Called by the factory whenever the connection state changes. A lost
+        connection is handled according to the pending policy and, once
+        the factory has reconnected, the session is recovered.
+        """
+        if connected:
+            self._sessionEstablished = True
+            if self._connectionLostAt is not None:
+                disconnectedAt = self._connectionLostAt
+                self._connectionLostAt = None
+                self._recoveries += 1
+                self.recovery = self._recoverSession(disconnectedAt)
+                self.recovery.addErrback(self._recoveryFailed)
+                
+        elif self._sessionEstablished and self.factory.continueTrying:
+            # The connection was lost rather than deliberately closed, so
+            # the factory will attempt to reconnect. Connection failures
+            # during the reconnection attempts also arrive here.
+            if self.store:
+                # updates may be missed until the subscriptions are recovered
+                self.store.interrupt()
+            if self._connectionLostAt is None:
+                self._connectionLostAt = self.clock.seconds()
+                logging.warning("PAWS connection lost with %s pending responses and %s subscriptions" % (len(self.pendingResponses),
+                                                                                                        len(self.subscriptionHandlers)))
+            if self.pending_policy == PAWSClient.FailPending:
+                self._failPending()
+            
+            
+    def _failPending(self):
+        """
+        Errback every request still waiting for a response.
+        """
+        pending = self.pendingResponses
+        self.pendingResponses = dict()
+        self._pendingMessages.clear()
+        for token, d in pending.items():
+            d.errback(error.ConnectionLost("PAWS connection lost before response to %s was received" % token))
+            
+            
+    def _replayPending(self):
+        """
+        Send again, in their original order, all the requests that were
+        waiting for a response or that were made while disconnected.
+        
+        @return: The number of requests sent
+        @rtype: int
+        """
+        messages = self._pendingMessages.values()
+        for message in messages:
+            self.factory.send(message)
+        return len(messages)
+    
+    
+    @defer.inlineCallbacks
+    def _recoverSession(self, disconnectedAt):
+        """
+        Re-establish the session after a reconnection. Pending requests are
+        replayed and every active subscription is re-issued, using its
+        original token, in batches of resubscribe_batch_size separated by
+        resubscribe_interval seconds so the service is not flooded.
+        
+        @param disconnectedAt: The time at which the connection was lost
+        @type disconnectedAt: float
+        
+        The recovery is abandoned, returning None, if the connection is lost
+        again or a newer recovery has started before a batch is sent.
+        
+        @return: A deferred that returns a RecoveryReport once every subscribe
+                 request has been acknowledged.
+        @rtype: defer.Deferred
+        """
+        recovery = self._recoveries
+        started = self.clock.seconds()
+        replayed = 0
+        if self.pending_policy == PAWSClient.ReplayPending:
+            replayed = self._replayPending()
+        
+        subscriptions = self.subscriptionHandlers.values()
+        logging.info("PAWS connection re-established, re-subscribing %s resources" % len(subscriptions))
+        
+        batchSize = max(1, self.resubscribe_batch_size)
+        acknowledgements = []
+        for index in range(0, len(subscriptions), batchSize):
+            if index:
+                yield task.deferLater(self.clock, self.resubscribe_interval, lambda: None)
+            if not self.connected or recovery != self._recoveries:
+                logging.warning("PAWS session recovery abandoned after %s of %s re-subscriptions" % (index, len(subscriptions)))
+                # the subscribe requests already sent may fail with the lost connection
+                defer.DeferredList(acknowledgements, consumeErrors=True)
+                defer.returnValue(None)
+            for subscription in subscriptions[index:index + batchSize]:
+                d = self._sendRequest("subscribe", subscription.resource, token=subscription.token)
+                d.addCallback(self._getResponseCodeStatusFromHeader)
+                acknowledgements.append(d)
+        
+        results = yield defer.DeferredList(acknowledgements, consumeErrors=True)
+        failed = []
+        for subscription, (success, subscribed) in zip(subscriptions, results):
+            if not (success and subscribed):
+                failed.append(subscription.token)
+                
+        finished = self.clock.seconds()
+        report = RecoveryReport(outage=started - disconnectedAt,
+                                duration=finished - started,
+                                resubscribed=len(subscriptions) - len(failed),
+                                failed=failed,
+                                replayed=replayed)
+        self.lastRecovery = report
+        if failed:
+            logging.error("PAWS session recovery could not re-subscribe tokens: %s" % failed)
+        logging.info("PAWS session recovery completed: %s" % report)
+        if self.recoveryHandler:
+            self.recoveryHandler(report)
+        defer.returnValue(report)
+
+
+    def _recoveryFailed(self, reason):
+        """
+        Log a failure of the session recovery, including one raised by the
+        recoveryHandler, rather than leave it unhandled.
+        """
+        logging.error("PAWS session recovery failed: %s" % reason.getErrorMessage())
+        return None
     
 
     #
@@ -1930,6 +3068,31 @@ class PAWSClient(object):
         return response['body']
     
     
+    def _getRawToken(self, msg):
+        """
+        Return the token from a message without parsing the whole message,
+        or None if no token is found.
+        """
+        match = _rawTokenPattern.search(msg)
+        if match:
+            return match.group(1)
+        return None
+    
+    
+    def _getRawResponseBody(self, msg):
+        """
+        Return the response body, as the JSON string it was received in,
+        from a message. None is returned if the message has no body.
+        """
+        match = _rawBodyPattern.search(msg)
+        if match is None:
+            return None
+        start = match.end()
+        # The body value has to be scanned to find where it ends
+        body, end = _rawDecoder.raw_decode(msg, start)
+        return msg[start:end]
+    
+    
     def _convertToPachubeStructure(self, data, kind):
         """
         Convert the data into a DataStructure object
@@ -2012,12 +3175,42 @@ class PAWSClient(object):
         
         logging.debug("About to send:\n%s\n" % json.dumps(message, sort_keys=True, indent=2))
         
+        serializedMessage = json.dumps(message)
+        if self.rate_limiter:
+            d = self.rate_limiter.acquire(self.api_key, method)
+            d.addCallback(lambda _: self._transmit(token, serializedMessage))
+            return d
+        return self._transmit(token, serializedMessage)
+    
+    
+    def _transmit(self, token, serializedMessage):
+        """
+        Send a serialized request message and register the deferred that
+        will be fired by the response.
+        
+        @param token: The token of the request
+        @type token: string
+        @param serializedMessage: The JSON encoded request message
+        @type serializedMessage: string
+        
+        @return:  A deferred that returns a the response.
+        @rtype: twisted.internet.defer.Deferred        
+        """
+        replay = self.pending_policy == PAWSClient.ReplayPending
+        
         if self.connected:
-            self.factory.send(json.dumps(message))
-            self.pendingResponses[token] = defer.Deferred()
-            return self.pendingResponses[token]
+            self.factory.send(serializedMessage)
+        elif replay:
+            logging.warning("No connection exists, request will be sent upon reconnection")
         else:
-            logging.error("Send failed, no connection exists")
+            err_str = "Send failed, no connection exists"
+            logging.error(err_str)
+            return defer.fail(Exception(err_str))
+        
+        if replay:
+            self._pendingMessages[token] = serializedMessage
+        self.pendingResponses[token] = defer.Deferred()
+        return self.pendingResponses[token]
             
 
 
@@ -2587,7 +3780,8 @@ class PAWSClient(object):
 
 
     @defer.inlineCallbacks
-    def subscribe(self, resource, subscriptionHandler):
+    def subscribe(self, resource, subscriptionHandler, conflate=False, passthrough=None, datastreams=None,
+                  diff=False):
         """
         Subscribe to the resource for updates of changes.
         
@@ -2596,6 +3790,27 @@ class PAWSClient(object):
         @param subscriptionHandler: A callable that will receive the data structure
                                    returned periodically as a result of the subscription.
         @type subscriptionHandler: callable
+        @param conflate: Deliver only the latest state to a handler that can not
+                         keep up. Updates waiting in the dispatcher queue are merged
+                         with newer updates for the same subscription and the number
+                         of updates merged away is counted in the Subscription's
+                         dropped attribute. This has no effect unless the client
+                         has a dispatcher, as otherwise no updates are ever queued.
+        @type conflate: boolean
+        @param passthrough: Skip the decoding of updates into data structures. With
+                            Subscription.PassthroughBytes the handler receives the
+                            update body as the JSON string received. With
+                            Subscription.PassthroughDict it receives the parsed dict.
+        @type passthrough: string
+        @param datastreams: Datastream identifiers to select from feed updates.
+                            Only these datastreams are decoded and passed on.
+        @type datastreams: list
+        @param diff: Deliver only what changed. The last known value of each
+                     datastream is kept and the handler receives a list of
+                     DatastreamChange(id, old_value, new_value, at) items for the
+                     datastreams whose current value changed. Updates that change
+                     nothing are not delivered.
+        @type diff: boolean
         
         @return: A tuple containing the token used for subscription and a deferred 
                 that returns the state of the subscription request. The token is 
@@ -2609,13 +3824,49 @@ class PAWSClient(object):
         else:
             dataStructureClass = txpachube.Environment
 
+        # Create the subscription first so invalid options are reported
+        # before anything is sent.
+        subscription = Subscription(None, resource, subscriptionHandler, dataStructureClass,
+                                    conflate=conflate, passthrough=passthrough, datastreams=datastreams,
+                                    diff=diff)
         (token, response) = yield self._subscribe(resource)
         response_code = self._getResponseCodeStatusFromHeader(response)
-        self.subscriptionHandlers[token] = (subscriptionHandler, dataStructureClass)
+        subscription.token = token
+        self.subscriptionHandlers[token] = subscription
+        if passthrough == Subscription.PassthroughBytes:
+            self._passthroughBytesTokens.add(token)
         result = (token, response_code)
         defer.returnValue(result)      
     
     
+    @defer.inlineCallbacks
+    def subscribe_stream(self, resource, size=1000, **kwargs):
+        """
+        Subscribe to the resource, queueing the updates in a stream that the
+        caller pulls them from instead of passing them to a handler.
+        
+        @param resource: The resource to access
+        @type resource: string
+        @param size: The number of updates the stream holds before the oldest
+                     is discarded.
+        @type size: int
+        
+        Any other keyword arguments are the subscription options accepted
+        by subscribe.
+        
+        @return: A deferred that returns a tuple containing the token used for
+                 the subscription and the txpachube.stream.SubscriptionStream
+                 the updates are queued in. Unsubscribing closes the stream.
+        @rtype: tuple
+        """
+        stream = txpachube.stream.SubscriptionStream(size=size)
+        (token, response_code) = yield self.subscribe(resource, stream, **kwargs)
+        stream.token = token
+        if not response_code:
+            stream.close()
+        defer.returnValue((token, stream))
+    
+    
     @defer.inlineCallbacks
     def unsubscribe(self, resource, token):
         """
@@ -2630,7 +3881,12 @@ class PAWSClient(object):
         @rtype: boolean
         """
         if token in self.subscriptionHandlers:
-            del self.subscriptionHandlers[token]
+            subscription = self.subscriptionHandlers.pop(token)
+            if isinstance(subscription.handler, txpachube.stream.SubscriptionStream):
+                subscription.handler.close()
+            self._passthroughBytesTokens.discard(token)
+            if self.dispatcher:
+                self.dispatcher.discard(token)
 
         response = yield self._unsubscribe(resource, token)
         status_code = self._getResponseCodeStatusFromHeader(response)
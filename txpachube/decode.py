@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""
+Decoding of large responses away from the reactor thread.
+
+The Client decodes each response body into a DataStructure on the
+reactor thread. Decoding a large list_feeds page or datastream history
+takes long enough to hold up all other network activity. A Client given
+a decoder passes response bodies larger than its decode_threshold to the
+decoder instead, which returns a deferred that fires with the decoded
+DataStructure.
+
+ThreadDecoder decodes in a thread pool. The interpreter lock is still
+held while decoding, but the reactor thread is switched back in
+regularly so sockets keep being serviced. ProcessDecoder decodes in a
+pool of processes, using other cores, at the cost of pickling each
+decoded structure back to the reactor process. Create a ProcessDecoder
+before starting the reactor, as its processes are forked from the
+current one.
+
+Python 2 pools only call back with results, never with errors, so the
+pool processes return an (ok, value) tuple and pickle the structure
+themselves, and a decode that fails in any of these steps fails its
+deferred. A pool process that dies loses its decode, which only a
+timeout can report.
+"""
+
+import cPickle as pickle
+import logging
+import multiprocessing
+from twisted.internet import reactor as _reactor
+from twisted.internet import defer, error, threads
+import txpachube
+
+
+
+def decodeStructure(kind, data, format):
+    """
+    Decode data into the DataStructure for a kind of message.
+
+    @param kind: The kind of message, e.g. txpachube.View_Feed_Msg
+    @type kind: string
+    @param data: The encoded data
+    @type data: string
+    @param format: The format of the data [json|xml]
+    @type format: string
+
+    @rtype: txpachube.DataStructure
+    """
+    dataStructure = txpachube.getDataStructure(kind)()
+    dataStructure.decode(data, format)
+    return dataStructure
+
+
+def _describe(ex):
+    return "%s: %s" % (ex.__class__.__name__, ex)
+
+
+def _decodeInProcess(kind, data, format):
+    """
+    Decode in a pool process. Python 2 pools have no error callback, so
+    failures are returned rather than raised. The structure is pickled
+    here so that a failure to pickle it is returned too.
+    """
+    try:
+        return (True, pickle.dumps(decodeStructure(kind, data, format), pickle.HIGHEST_PROTOCOL))
+    except Exception, ex:
+        return (False, _describe(ex))
+
+
+
+class ThreadDecoder(object):
+    """
+    Decodes in a thread pool.
+    """
+
+    def __init__(self, threadpool=None, reactor=None):
+        """
+        @param threadpool: The thread pool to decode in. If not set the
+                           reactor's thread pool is used.
+        @type threadpool: twisted.python.threadpool.ThreadPool
+        """
+        self.reactor = reactor or _reactor
+        self.threadpool = threadpool or self.reactor.getThreadPool()
+
+
+    def decode(self, kind, data, format):
+        """
+        @return: A deferred that returns the decoded DataStructure
+        @rtype: defer.Deferred
+        """
+        return threads.deferToThreadPool(self.reactor, self.threadpool, decodeStructure, kind, data, format)
+
+
+
+class ProcessDecoder(object):
+    """
+    Decodes in a pool of processes.
+    """
+
+    def __init__(self, processes=None, timeout=None, reactor=None):
+        """
+        @param processes: The number of processes. Defaults to the number of cpus.
+        @type processes: int
+        @param timeout: The time, in seconds, after which a decode that has not
+                        returned fails with a TimeoutError. If not set a decode
+                        lost by a pool process that died never returns.
+        @type timeout: float
+        """
+        self.reactor = reactor or _reactor
+        self.timeout = timeout
+        self.pool = multiprocessing.Pool(processes)
+
+
+    def decode(self, kind, data, format):
+        """
+        @return: A deferred that returns the decoded DataStructure
+        @rtype: defer.Deferred
+        """
+        d = defer.Deferred()
+
+        def decoded(result):
+            # called in the pool's result thread
+            success, value = result
+            if success:
+                try:
+                    value = pickle.loads(value)
+                except Exception, ex:
+                    success, value = False, _describe(ex)
+            self.reactor.callFromThread(self._decoded, d, kind, (success, value))
+
+        try:
+            self.pool.apply_async(_decodeInProcess, (kind, data, format), callback=decoded)
+        except Exception, ex:
+            # e.g. the pool has been closed
+            self._decoded(d, kind, (False, _describe(ex)))
+            return d
+
+        if self.timeout:
+            timeoutCall = self.reactor.callLater(self.timeout, self._timedOut, d, kind)
+            d.addBoth(self._cancelTimeout, timeoutCall)
+        return d
+
+
+    def _decoded(self, d, kind, result):
+        if d.called:
+            # the decode timed out
+            return
+        success, value = result
+        if success:
+            d.callback(value)
+        else:
+            err_str = "Error decoding %s message: %s" % (kind, value)
+            logging.error(err_str)
+            d.errback(Exception(err_str))
+
+
+    def _timedOut(self, d, kind):
+        err_str = "Decoding %s message timed out after %ss" % (kind, self.timeout)
+        logging.error(err_str)
+        d.errback(error.TimeoutError(err_str))
+
+
+    def _cancelTimeout(self, result, timeoutCall):
+        if timeoutCall.active():
+            timeoutCall.cancel()
+        return result
+
+
+    def close(self):
+        """
+        Stop the pool processes once queued decodes have finished.
+        """
+        self.pool.close()
+        self.pool.join()
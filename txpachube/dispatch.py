@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+"""
+Dispatch PAWS subscription updates away from the reactor thread.
+
+By default a PAWSClient decodes each subscription update and calls the
+subscription handler on the reactor thread, so one slow handler delays
+every other subscription and all other network activity. A
+SubscriptionDispatcher moves the decoding of update messages into
+txpachube data structures, and the call to the handler, into a thread
+pool.
+
+Updates for the same subscription token are processed one at a time, in
+the order they were received, while updates for different tokens run
+concurrently. Subscription handlers must therefore be thread safe with
+respect to each other, but a single handler is never called concurrently
+with itself.
+
+Subscriptions made with conflation enabled never have more than one
+update waiting. A newer update is merged into the waiting one so the
+handler only receives the latest state.
+
+When the number of queued updates reaches a high water mark the
+dispatcher pauses its producer (the PAWS connection) so the socket stops
+being read. Reading resumes once the queues have drained to a low water
+mark.
+"""
+
+import collections
+import logging
+from twisted.internet import reactor as _reactor
+from twisted.internet import threads
+
+
+
+class SubscriptionDispatcher(object):
+    """
+    Processes subscription updates in a thread pool while preserving the
+    order of updates within each subscription.
+    """
+
+    def __init__(self, threadpool=None, high_water=1000, low_water=None, reactor=None):
+        """
+        @param threadpool: The thread pool to process updates in. If not
+                           set the reactor's thread pool is used.
+        @type threadpool: twisted.python.threadpool.ThreadPool
+        @param high_water: The total number of queued updates at which the
+                           producer is paused.
+        @type high_water: int
+        @param low_water: The total number of queued updates at which a paused
+                          producer is resumed. Defaults to half the high_water.
+        @type low_water: int
+        @param reactor: The reactor used to return results from the thread pool.
+        """
+        self.reactor = reactor or _reactor
+        self.threadpool = threadpool or self.reactor.getThreadPool()
+        self.high_water = high_water
+        if low_water is None:
+            low_water = high_water // 2
+        self.low_water = low_water
+
+        # An object providing pauseProducing and resumeProducing that is
+        # used to apply backpressure. This is normally the PAWS factory.
+        self.producer = None
+        self.paused = False
+
+        # The pending updates for each subscription token. The value of each
+        # item is a deque of (subscription, body) tuples.
+        self._queues = dict()
+
+        # Tokens which currently have an update being processed in the pool
+        self._active = set()
+
+        self.queued = 0
+
+
+    def dispatch(self, subscription, body):
+        """
+        Queue a subscription update for processing.
+
+        @param subscription: The subscription the update belongs to
+        @type subscription: txpachube.client.Subscription
+        @param body: The body of the update message
+        @type body: dict
+        """
+        token = subscription.token
+        if token not in self._queues:
+            self._queues[token] = collections.deque()
+        queue = self._queues[token]
+        
+        if subscription.conflate and queue:
+            # Replace the waiting update with one holding the newest state
+            pendingSubscription, pendingBody = queue[-1]
+            queue[-1] = (subscription, subscription.merge(pendingBody, body))
+            return
+        
+        queue.append((subscription, body))
+        self.queued += 1
+
+        if self.queued >= self.high_water and not self.paused:
+            self._pause()
+
+        if token not in self._active:
+            self._processNext(token)
+
+
+    def discard(self, token):
+        """
+        Drop any queued updates for a subscription token. This is used when
+        a subscription is cancelled. An update already being processed
+        is allowed to complete.
+
+        @param token: The subscription token
+        @type token: string
+        """
+        queue = self._queues.get(token)
+        if queue:
+            self.queued -= len(queue)
+            queue.clear()
+        if token not in self._active:
+            self._queues.pop(token, None)
+        self._checkResume()
+
+
+    def queueDepth(self, token):
+        """
+        Return the number of updates waiting to be processed, including any
+        update currently being processed, for a subscription token.
+
+        @param token: The subscription token
+        @type token: string
+
+        @rtype: int
+        """
+        depth = len(self._queues.get(token, ()))
+        if token in self._active:
+            depth += 1
+        return depth
+
+
+    def queueDepths(self):
+        """
+        Return the queue depth of every subscription token with pending updates.
+
+        @return: A dict of token to queue depth
+        @rtype: dict
+        """
+        tokens = set(self._queues.keys()) | self._active
+        return dict([(token, self.queueDepth(token)) for token in tokens])
+
+
+    def _processNext(self, token):
+        """
+        Start processing the oldest queued update for a token in the thread pool.
+        """
+        queue = self._queues.get(token)
+        if not queue:
+            self._active.discard(token)
+            self._queues.pop(token, None)
+            return
+
+        subscription, body = queue.popleft()
+        self.queued -= 1
+        self._active.add(token)
+        self._checkResume()
+
+        d = threads.deferToThreadPool(self.reactor, self.threadpool, subscription.process, body)
+        d.addErrback(self._processFailed, token)
+        d.addBoth(lambda _: self._processNext(token))
+
+
+    def _processFailed(self, failure, token):
+        logging.error("Error processing update for subscription %s: %s" % (token, failure.getErrorMessage()))
+
+
+    def _pause(self):
+        self.paused = True
+        logging.debug("Subscription queues full (%s updates), pausing PAWS connection" % self.queued)
+        if self.producer:
+            self.producer.pauseProducing()
+
+
+    def _checkResume(self):
+        if self.paused and self.queued <= self.low_water:
+            self.paused = False
+            logging.debug("Subscription queues drained (%s updates), resuming PAWS connection" % self.queued)
+            if self.producer:
+                self.producer.resumeProducing()
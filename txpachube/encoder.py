@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+
+"""
+Encoding of data structures straight to bytes.
+
+DataStructure.encode builds a dict with toDict, or an element tree with
+toXml, and then serializes it. For a large batch of datapoints the
+intermediate structure costs more than the output. The encoders here
+write JSON, or EEML XML, from the attributes of Environment, Datastream,
+Datapoint, Unit and Location objects straight to a write callable.
+Other data structures are written using their own encode method.
+
+The output decodes to the same structure as the output of encode,
+including datastream tags, which Datastream.toDict writes as the text of
+the Python list.
+
+    buf = EncodeBuffer()
+    encode(environment, buf.write, DataFormats.JSON)
+    data = buf.getvalue()
+
+A StructureBodyProducer can be passed as the data of a Client update or
+create call in place of an encoded string.
+"""
+
+import cStringIO
+import json
+import logging
+import txpachube
+from twisted.internet import defer
+from twisted.web.iweb import IBodyProducer
+from xml.sax.saxutils import escape, quoteattr
+from zope.interface import implements
+
+
+
+Eeml_Header = ('<eeml xmlns:eeml="%s" version="0.5.1" eeml:schemaLocation="http://www.eeml.org/xsd/005" '
+               'eeml:xsi="http://www.w3.org/2001/XMLSchema-instance">' % txpachube.namespace_map[txpachube.EEML_NAMESPACE])
+Eeml_Footer = '</eeml>'
+
+
+
+class EncodeBuffer(object):
+    """
+    A byte buffer that keeps its memory when it is reset, so it can be
+    written to again without growing from empty.
+    """
+
+    def __init__(self):
+        self.buffer = cStringIO.StringIO()
+        self.write = self.buffer.write
+
+
+    def reset(self):
+        """
+        Discard the contents of the buffer.
+        """
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+
+    def getvalue(self):
+        """
+        @return: The contents of the buffer
+        @rtype: string
+        """
+        return self.buffer.getvalue()
+
+
+    def __len__(self):
+        return self.buffer.tell()
+
+
+
+_encode_basestring_ascii = json.encoder.encode_basestring_ascii
+
+
+
+def _text(value):
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    return value
+
+
+def _jsonString(value):
+    """ Return a value as a JSON string, ASCII escaped as json.dumps does by default """
+    if isinstance(value, basestring):
+        return _encode_basestring_ascii(value)
+    return _encode_basestring_ascii(unicode(value))
+
+
+def _jsonValue(value):
+    """ Return a value as JSON, keeping the type of values that are not strings """
+    if isinstance(value, basestring):
+        return _encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+def _xmlText(value):
+    """ Return a value as escaped XML text, as etree.tostring does """
+    return escape(_text(value)).encode('ascii', 'xmlcharrefreplace')
+
+
+def _xmlAttribute(value):
+    return quoteattr(_text(value)).encode('ascii', 'xmlcharrefreplace')
+
+
+def _isSet(value):
+    """ Return whether a value is written, allowing for typed values of zero """
+    return value is not None and value != ''
+
+
+def _xmlElement(write, tag, value):
+    tag = str(tag)
+    write('<%s>%s</%s>' % (tag, _xmlText(value), tag))
+
+
+def _datastreamValues(environment):
+    datastreams = environment.datastreams
+    if isinstance(datastreams, dict):
+        # fromXml stores the datastreams as a list
+        return datastreams.itervalues()
+    return datastreams
+
+
+
+class JsonEncoder(object):
+    """
+    Writes data structures as JSON.
+    """
+
+    def __init__(self, write):
+        """
+        @param write: A callable taking each string of output
+        @type write: callable
+        """
+        self.write = write
+
+
+    def encode(self, structure):
+        """
+        Write a data structure.
+
+        @param structure: The data structure to write
+        @type structure: txpachube.DataStructure
+        """
+        writer = self._writers.get(structure.__class__)
+        if writer is None:
+            self.write(structure.encode(txpachube.DataFormats.JSON))
+        else:
+            writer(self, structure)
+
+
+    def _writeMembers(self, members):
+        """ Write an object from (key, JSON value) pairs """
+        write = self.write
+        write('{')
+        separator = ''
+        for key, value in members:
+            write(separator)
+            separator = ', '
+            write('"%s": ' % str(key))
+            write(value)
+        write('}')
+
+
+    def writeDatapoint(self, datapoint):
+        # datapoints are written with a single write as batches can be large
+        if datapoint.at and _isSet(datapoint.value):
+            self.write('{"at": %s, "value": %s}' % (_jsonString(datapoint.at), _jsonString(datapoint.value)))
+        elif datapoint.at:
+            self.write('{"at": %s}' % _jsonString(datapoint.at))
+        elif _isSet(datapoint.value):
+            self.write('{"value": %s}' % _jsonString(datapoint.value))
+        else:
+            self.write('{}')
+
+
+    def writeUnit(self, unit):
+        self._writeMembers([(attribute, _jsonString(getattr(unit, attribute)))
+                            for attribute in unit._attributes if getattr(unit, attribute, None)])
+
+
+    def writeLocation(self, location):
+        self._writeMembers([(attribute, _jsonValue(getattr(location, attribute)))
+                            for attribute in location._attributes if getattr(location, attribute, None)])
+
+
+    def writeDatastream(self, datastream):
+        write = self.write
+        write('{')
+        separator = ''
+        for attribute in datastream._attributes:
+            value = getattr(datastream, attribute, None)
+            if value is None or value == []:
+                continue
+            write(separator)
+            separator = ', '
+            write('"%s": ' % str(attribute))
+            if attribute == txpachube.DataFields.Datapoints:
+                self._writeList(value, self.writeDatapoint)
+            elif attribute == txpachube.DataFields.Unit:
+                self.writeUnit(value)
+            else:
+                # as toDict, tags are written as the text of the list
+                write(_jsonString(value))
+        write('}')
+
+
+    def writeEnvironment(self, environment):
+        write = self.write
+        write('{')
+        separator = ''
+        for attribute in environment._attributes:
+            value = getattr(environment, attribute, None)
+            if not value:
+                continue
+            write(separator)
+            separator = ', '
+            write('"%s": ' % str(attribute))
+            if attribute == txpachube.DataFields.Location:
+                self.writeLocation(value)
+            elif attribute == txpachube.DataFields.Datastreams:
+                self._writeList(_datastreamValues(environment), self.writeDatastream)
+            elif attribute == txpachube.DataFields.Tags:
+                write('[%s]' % ', '.join([_jsonValue(tag) for tag in value]))
+            else:
+                write(_jsonValue(value))
+        write('}')
+
+
+    def _writeList(self, items, writer):
+        write = self.write
+        write('[')
+        separator = ''
+        for item in items:
+            write(separator)
+            separator = ', '
+            writer(item)
+        write(']')
+
+
+    _writers = {txpachube.Datapoint : writeDatapoint,
+                txpachube.Unit : writeUnit,
+                txpachube.Location : writeLocation,
+                txpachube.Datastream : writeDatastream,
+                txpachube.Environment : writeEnvironment}
+
+
+
+class XmlEncoder(object):
+    """
+    Writes data structures as EEML XML.
+    """
+
+    def __init__(self, write):
+        """
+        @param write: A callable taking each string of output
+        @type write: callable
+        """
+        self.write = write
+
+
+    def encode(self, structure):
+        """
+        Write a data structure wrapped in the eeml element.
+
+        @param structure: The data structure to write
+        @type structure: txpachube.DataStructure
+        """
+        writer = self._writers.get(structure.__class__)
+        if writer is None:
+            self.write(structure.encode(txpachube.DataFormats.XML))
+        else:
+            self.write(Eeml_Header)
+            writer(self, structure)
+            self.write(Eeml_Footer)
+
+
+    def _writeStart(self, tag, attributes):
+        """ Write a start tag with the attributes that are set, in name order as etree does """
+        write = self.write
+        write('<%s' % str(tag))
+        for name, value in sorted(attributes):
+            if value:
+                write(' %s=%s' % (str(name), _xmlAttribute(value)))
+        write('>')
+
+
+    def writeDatapoint(self, datapoint):
+        # datapoints are written with a single write as batches can be large
+        if datapoint.at:
+            self.write('<value at=%s>%s</value>' % (_xmlAttribute(datapoint.at),
+                                                    _xmlText(datapoint.value) if _isSet(datapoint.value) else ''))
+        else:
+            _xmlElement(self.write, txpachube.DataFields.Value, datapoint.value if _isSet(datapoint.value) else '')
+
+
+    def writeUnit(self, unit):
+        self._writeStart(txpachube.DataFields.Unit, [(txpachube.DataFields.Type, unit.type),
+                                                     (txpachube.DataFields.Symbol, unit.symbol)])
+        if unit.label:
+            self.write(_xmlText(unit.label))
+        self.write('</unit>')
+
+
+    def writeLocation(self, location):
+        write = self.write
+        self._writeStart(txpachube.DataFields.Location, [(txpachube.DataFields.Domain, location.domain),
+                                                         (txpachube.DataFields.Exposure, location.exposure),
+                                                         (txpachube.DataFields.Disposition, location.disposition)])
+        for tag in [txpachube.DataFields.Name, txpachube.DataFields.Latitude,
+                    txpachube.DataFields.Longitude, txpachube.DataFields.Elevation]:
+            value = getattr(location, tag)
+            if value:
+                _xmlElement(write, tag, value)
+        write('</location>')
+
+
+    def writeDatastream(self, datastream):
+        write = self.write
+        write('<data %s=%s>' % (str(txpachube.DataFields.Datastream_Id), _xmlAttribute(datastream.id)))
+        if datastream.tags:
+            for tag in datastream.tags:
+                _xmlElement(write, txpachube.DataFields.Tag, tag)
+        for tag in [txpachube.DataFields.Current_Value, txpachube.DataFields.Maximum_Value,
+                    txpachube.DataFields.Minimum_Value]:
+            value = getattr(datastream, tag)
+            if _isSet(value):
+                _xmlElement(write, tag, value)
+        if datastream.unit:
+            self.writeUnit(datastream.unit)
+        if datastream.updated:
+            _xmlElement(write, txpachube.DataFields.Updated, datastream.updated)
+        if datastream.datapoints:
+            write('<datapoints>')
+            for datapoint in datastream.datapoints:
+                self.writeDatapoint(datapoint)
+            write('</datapoints>')
+        write('</data>')
+
+
+    def writeEnvironment(self, environment):
+        write = self.write
+        self._writeStart(txpachube.DataFields.Environment, [(txpachube.DataFields.Creator, environment.creator),
+                                                            (txpachube.DataFields.Id, environment.id),
+                                                            (txpachube.DataFields.Updated, environment.updated)])
+        for tag in [txpachube.DataFields.Description, txpachube.DataFields.Feed,
+                    txpachube.DataFields.Icon, txpachube.DataFields.Private, txpachube.DataFields.Status]:
+            value = getattr(environment, tag)
+            if value:
+                _xmlElement(write, tag, value)
+        if environment.tags:
+            for tag in environment.tags:
+                _xmlElement(write, txpachube.DataFields.Tag, tag)
+        for tag in [txpachube.DataFields.Title, txpachube.DataFields.Version, txpachube.DataFields.Website]:
+            value = getattr(environment, tag)
+            if value:
+                _xmlElement(write, tag, value)
+        if environment.location:
+            self.writeLocation(environment.location)
+        if environment.datastreams:
+            for datastream in _datastreamValues(environment):
+                self.writeDatastream(datastream)
+        write('</environment>')
+
+
+    _writers = {txpachube.Datapoint : writeDatapoint,
+                txpachube.Unit : writeUnit,
+                txpachube.Location : writeLocation,
+                txpachube.Datastream : writeDatastream,
+                txpachube.Environment : writeEnvironment}
+
+
+
+Encoders = {txpachube.DataFormats.JSON : JsonEncoder,
+            txpachube.DataFormats.XML : XmlEncoder}
+
+
+
+def encode(structure, write, format=txpachube.DataFormats.JSON):
+    """
+    Write a data structure in the specified format.
+
+    @param structure: The data structure to write
+    @type structure: txpachube.DataStructure
+    @param write: A callable taking each string of output
+    @type write: callable
+    @param format: The format to encode the structure in [json|xml]
+    @type format: string
+    """
+    encoder = Encoders.get(format)
+    if encoder is None:
+        err_str = "Don't know how to encode %s using format %s" % (structure.__class__.__name__, format)
+        logging.error(err_str)
+        raise Exception(err_str)
+    encoder(write).encode(structure)
+
+
+
+class StructureBodyProducer(object):
+    """
+    A request body producer for a data structure. The structure is
+    encoded into a buffer when the producer is created, so the content
+    length is known, and the buffer is written to each request made with
+    the producer.
+    """
+    implements(IBodyProducer)
+
+    def __init__(self, structure, format=txpachube.DataFormats.JSON, buffer=None):
+        """
+        @param structure: The data structure to send
+        @type structure: txpachube.DataStructure
+        @param format: The format to encode the structure in [json|xml]
+        @type format: string
+        @param buffer: The buffer to encode into. It must not be reset while
+                       the producer is in use.
+        @type buffer: EncodeBuffer
+        """
+        self.buffer = buffer or EncodeBuffer()
+        self.buffer.reset()
+        encode(structure, self.buffer.write, format)
+        self.length = len(self.buffer)
+
+    def startProducing(self, consumer):
+        consumer.write(self.buffer.getvalue())
+        return defer.succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
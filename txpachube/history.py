@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Planning of downsampled datastream history queries.
+
+Pachube can downsample history on the server. Given an interval it
+returns one snapshot per interval instead of every datapoint stored,
+which for charting transfers far less data than reading raw history and
+downsampling it locally. Each interval can only be queried over a
+limited time range, as listed in the Client.read_datastream docstring.
+
+planQuery picks the coarsest interval that still gives at least the
+number of points wanted over a time range, and splits the range into the
+fewest windows that respect both the interval's maximum range and the
+maximum page size.
+"""
+
+import logging
+import math
+
+
+
+# The intervals, in seconds, supported by Pachube and the maximum time
+# range, in seconds, that can be read at each in one query.
+Intervals = [(0, 6 * 3600),
+             (30, 12 * 3600),
+             (60, 24 * 3600),
+             (300, 5 * 86400),
+             (900, 14 * 86400),
+             (3600, 31 * 86400),
+             (10800, 90 * 86400),
+             (21600, 180 * 86400),
+             (43200, 365 * 86400),
+             (86400, 365 * 86400)]
+
+Raw_Interval = 0
+Max_Per_Page = 1000
+
+
+
+class QueryPlan(object):
+    """
+    The interval and time windows chosen to read a range of history.
+    """
+
+    def __init__(self, start, end, interval, windows):
+        """
+        @param start: The start of the range in seconds since the epoch
+        @type start: float
+        @param end: The end of the range in seconds since the epoch
+        @type end: float
+        @param interval: The interval, in seconds, to request
+        @type interval: int
+        @param windows: The (start, end) tuples of each query
+        @type windows: list
+        """
+        self.start = start
+        self.end = end
+        self.interval = interval
+        self.windows = windows
+
+
+    def parameters(self, formatTimestamp):
+        """
+        Return the read_datastream parameters of each query.
+
+        @param formatTimestamp: A callable converting seconds since the epoch
+                                into a timestamp string.
+        @type formatTimestamp: callable
+
+        @rtype: list of dict
+        """
+        queries = []
+        for start, end in self.windows:
+            parameters = {'start' : formatTimestamp(start),
+                          'end' : formatTimestamp(end),
+                          'per_page' : Max_Per_Page}
+            if self.interval != Raw_Interval:
+                parameters['interval'] = self.interval
+                parameters['interval_type'] = 'discrete'
+            queries.append(parameters)
+        return queries
+
+
+    def __str__(self):
+        return "interval=%s, windows=%s" % (self.interval, len(self.windows))
+
+
+
+def planQuery(start, end, points):
+    """
+    Plan the queries needed to read at least a number of points over a
+    time range.
+
+    @param start: The start of the range in seconds since the epoch
+    @type start: float
+    @param end: The end of the range in seconds since the epoch
+    @type end: float
+    @param points: The number of points wanted
+    @type points: int
+
+    @rtype: QueryPlan
+    """
+    if end <= start:
+        err_str = "Invalid range, end %s is not after start %s" % (end, start)
+        logging.error(err_str)
+        raise Exception(err_str)
+    if points < 1:
+        err_str = "Invalid number of points %s" % points
+        logging.error(err_str)
+        raise Exception(err_str)
+
+    # The coarsest interval giving at least the requested number of points.
+    # Raw history is only used when even the finest interval is too coarse.
+    spacing = (end - start) / float(points)
+    interval, maxRange = Intervals[0]
+    for candidate, candidateRange in Intervals[1:]:
+        if candidate <= spacing:
+            interval, maxRange = candidate, candidateRange
+
+    window = maxRange
+    if interval != Raw_Interval:
+        # keep each window within one page of results
+        window = min(window, interval * Max_Per_Page)
+
+    count = int(math.ceil((end - start) / float(window)))
+    windows = []
+    for i in range(count):
+        windowStart = start + i * window
+        windows.append((windowStart, min(end, windowStart + window)))
+    return QueryPlan(start, end, interval, windows)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+"""
+Latency and size instrumentation for requests made by the txpachube Client.
+
+When a Client is given an Instrumentation object it records, for every
+request, the time taken to receive the response headers (which includes
+name lookup, connecting and the server's time to first byte), the time
+taken to download the response body, the time taken to decode the body
+into txpachube data structures and the total time of the call including
+any retries. The sizes of the request and response bodies are recorded
+too. Each measurement is tagged with the request method and endpoint
+family.
+
+Measurements are passed on to sinks. A HistogramSink keeps recent
+measurements in memory, a StatsdSink sends them to a statsd server and a
+LogSink writes them to the log. Any object with a record method taking
+the same arguments can be used as a sink.
+
+Clients without instrumentation do no measuring at all.
+"""
+
+import collections
+import logging
+import socket
+from twisted.internet import reactor
+
+
+
+# Metrics
+Headers_Time = 'headers_time'
+Body_Time = 'body_time'
+Decode_Time = 'decode_time'
+Total_Time = 'total_time'
+Request_Bytes = 'request_bytes'
+Response_Bytes = 'response_bytes'
+
+Time_Metrics = [Headers_Time, Body_Time, Decode_Time, Total_Time]
+
+
+
+class Instrumentation(object):
+    """
+    Passes measurements on to a set of sinks.
+    """
+
+    def __init__(self, sinks=None, clock=None):
+        """
+        @param sinks: The sinks measurements are passed to
+        @type sinks: list
+        """
+        self.sinks = list(sinks or [])
+        self.clock = clock or reactor
+
+
+    def addSink(self, sink):
+        """
+        Add a sink to pass measurements to.
+        """
+        self.sinks.append(sink)
+
+
+    def record(self, metric, value, method, endpoint):
+        """
+        Record a measurement.
+
+        @param metric: The name of the metric
+        @type metric: string
+        @param value: The measurement. Times are in seconds and sizes in bytes.
+        @type value: float
+        @param method: The request method
+        @type method: string
+        @param endpoint: The endpoint family
+        @type endpoint: string
+        """
+        for sink in self.sinks:
+            try:
+                sink.record(metric, value, method, endpoint)
+            except Exception, ex:
+                logging.error("Instrumentation sink %s failed: %s" % (sink, ex))
+
+
+    def timer(self, method, endpoint, bodyProducer=None):
+        """
+        Start timing one attempt at a request.
+
+        @param bodyProducer: The producer of the request body, if any
+        @type bodyProducer: twisted.web.iweb.IBodyProducer
+
+        @rtype: RequestTimer
+        """
+        size = 0
+        if bodyProducer is not None:
+            size = bodyProducer.length
+        self.record(Request_Bytes, size, method, endpoint)
+        return RequestTimer(self, method, endpoint)
+
+
+
+class RequestTimer(object):
+    """
+    Measures the phases of one attempt at a request. The headers and body
+    methods are added as callbacks to the request's deferred and pass
+    their result through unchanged.
+    """
+
+    def __init__(self, instrumentation, method, endpoint):
+        self.instrumentation = instrumentation
+        self.method = method
+        self.endpoint = endpoint
+        self.clock = instrumentation.clock
+        self.started = self.clock.seconds()
+        self.headersReceived = None
+
+
+    def headers(self, response):
+        """
+        Record the time taken to receive the response headers.
+        """
+        self.headersReceived = self.clock.seconds()
+        self.instrumentation.record(Headers_Time, self.headersReceived - self.started, self.method, self.endpoint)
+        return response
+
+
+    def body(self, result):
+        """
+        Record the time taken to receive the response body and its size.
+        """
+        response, responseBody = result
+        self.instrumentation.record(Body_Time, self.clock.seconds() - self.headersReceived, self.method, self.endpoint)
+        self.instrumentation.record(Response_Bytes, len(responseBody), self.method, self.endpoint)
+        return result
+
+
+
+class Histogram(object):
+    """
+    Summarises the most recent values of one measurement.
+    """
+
+    def __init__(self, max_samples=1000):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+
+    def percentile(self, percent):
+        """
+        Return the value below which the given percentage of the recent
+        samples fall, or None if there are no samples.
+        """
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = int(round(percent / 100.0 * (len(ordered) - 1)))
+        return ordered[index]
+
+
+    def summary(self):
+        """
+        @return: A dict holding the count and total of all values, and the
+                 minimum, maximum and percentiles of the recent values.
+        @rtype: dict
+        """
+        recent = self.samples or [None]
+        return {'count' : self.count,
+                'total' : self.total,
+                'min' : min(recent),
+                'max' : max(recent),
+                'p50' : self.percentile(50),
+                'p90' : self.percentile(90),
+                'p99' : self.percentile(99)}
+
+
+
+class HistogramSink(object):
+    """
+    Keeps a histogram in memory for each metric, method and endpoint.
+    """
+
+    def __init__(self, max_samples=1000):
+        """
+        @param max_samples: The number of recent values each histogram keeps
+        @type max_samples: int
+        """
+        self.max_samples = max_samples
+        self.histograms = dict()
+
+
+    def record(self, metric, value, method, endpoint):
+        key = (metric, method, endpoint)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.max_samples)
+        histogram.add(value)
+
+
+    def summary(self):
+        """
+        @return: A dict mapping (metric, method, endpoint) tuples to the
+                 summary of their histogram.
+        @rtype: dict
+        """
+        return dict([(key, histogram.summary()) for key, histogram in self.histograms.items()])
+
+
+    def clear(self):
+        self.histograms.clear()
+
+
+
+class StatsdSink(object):
+    """
+    Sends measurements to a statsd server over UDP. Times are sent as
+    timers in milliseconds and sizes as counters, named
+    prefix.metric.method.endpoint.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='txpachube'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(0)
+
+
+    def format(self, metric, value, method, endpoint):
+        """
+        Return the statsd line for a measurement.
+        """
+        name = "%s.%s.%s.%s" % (self.prefix, metric, method.lower(), endpoint)
+        if metric in Time_Metrics:
+            return "%s:%.3f|ms" % (name, value * 1000.0)
+        return "%s:%d|c" % (name, value)
+
+
+    def record(self, metric, value, method, endpoint):
+        try:
+            self.socket.sendto(self.format(metric, value, method, endpoint), self.address)
+        except socket.error, ex:
+            logging.debug("Unable to send measurement to statsd: %s" % ex)
+
+
+
+class LogSink(object):
+    """
+    Writes each measurement to the log.
+    """
+
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+
+    def record(self, metric, value, method, endpoint):
+        logging.log(self.level, "%s %s %s=%s" % (method, endpoint, metric, value))
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+Interning of repeated strings in decoded data structures.
+
+Decoding a list_feeds page creates a new string object for every
+occurrence of values that repeat across feeds: datastream ids such as
+"0" or "temperature", tags, unit labels, symbols and types, and status,
+version, privacy and location kind values. An InternTable replaces each
+of these with one shared string object, so a large decoded response
+holds one copy of each distinct value.
+
+The table is bounded. Once it is full, values it does not already hold
+are left as they are rather than added, so a stream of distinct values
+can not grow it without limit.
+
+    table = InternTable()
+    client = Client(api_key=key, intern_table=table)
+
+Builtin intern only accepts byte strings, while JSON decodes to unicode,
+so the table keeps its own dict of values. Equal byte and unicode
+strings share an entry.
+"""
+
+import txpachube
+
+
+
+class InternTable(object):
+    """
+    A bounded table of shared string values.
+    """
+
+    def __init__(self, size=100000):
+        """
+        @param size: The maximum number of distinct values held
+        @type size: int
+        """
+        self.size = size
+        self.values = dict()
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def intern(self, value):
+        """
+        Return the shared copy of a string value. Values that are not strings
+        are returned unchanged.
+
+        @param value: The value to intern
+        @type value: string
+        """
+        if not isinstance(value, basestring):
+            return value
+        interned = self.values.get(value)
+        if interned is not None:
+            return interned
+        if len(self.values) < self.size:
+            self.values[value] = value
+        return value
+
+
+    def internList(self, values):
+        """
+        Intern each value of a list in place.
+
+        @param values: The values to intern
+        @type values: list
+        """
+        if values:
+            intern = self.intern
+            for i, value in enumerate(values):
+                values[i] = intern(value)
+
+
+    def clear(self):
+        """
+        Discard all values held by the table.
+        """
+        self.values.clear()
+
+
+    def internUnit(self, unit):
+        unit.label = self.intern(unit.label)
+        unit.symbol = self.intern(unit.symbol)
+        unit.type = self.intern(unit.type)
+
+
+    def internLocation(self, location):
+        location.domain = self.intern(location.domain)
+        location.exposure = self.intern(location.exposure)
+        location.disposition = self.intern(location.disposition)
+
+
+    def internDatastream(self, datastream):
+        datastream.id = self.intern(datastream.id)
+        self.internList(datastream.tags)
+        if datastream.unit:
+            self.internUnit(datastream.unit)
+
+
+    def internEnvironment(self, environment):
+        environment.status = self.intern(environment.status)
+        environment.version = self.intern(environment.version)
+        environment.private = self.intern(environment.private)
+        self.internList(environment.tags)
+        if environment.location:
+            self.internLocation(environment.location)
+
+        datastreams = environment.datastreams
+        if isinstance(datastreams, dict):
+            for datastream_id, datastream in datastreams.items():
+                self.internDatastream(datastream)
+                if datastream_id is not datastream.id and datastream_id == datastream.id:
+                    # replace the key, which is the uninterned id
+                    del datastreams[datastream_id]
+                    datastreams[datastream.id] = datastream
+        else:
+            # fromXml stores the datastreams as a list
+            for datastream in datastreams:
+                self.internDatastream(datastream)
+
+
+    def internStructure(self, structure):
+        """
+        Intern the repeated values of a data structure, and of the structures
+        it contains, in place. Structures without such values are left
+        unchanged.
+
+        @param structure: The data structure
+        @type structure: txpachube.DataStructure
+
+        @return: The structure
+        @rtype: txpachube.DataStructure
+        """
+        if isinstance(structure, txpachube.Environment):
+            self.internEnvironment(structure)
+        elif isinstance(structure, txpachube.EnvironmentList):
+            for environment in structure.feeds:
+                self.internEnvironment(environment)
+        elif isinstance(structure, txpachube.Datastream):
+            self.internDatastream(structure)
+        return structure
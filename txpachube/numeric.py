@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+Opt-in typed numeric values for decoded data structures.
+
+Datastream current, maximum and minimum values and datapoint values are
+decoded as strings, so every consumer that analyses them converts them
+again. typeValues converts them, once, in place, into numbers that can
+be summed, compared and averaged directly.
+
+In the float mode integral values become Integer and other values Float.
+These are int and float subclasses that keep the text they were parsed
+from and return it from str and unicode, so encoding a typed structure
+writes exactly the values that were received. Arithmetic on them returns
+plain ints and floats. In the decimal mode values become Decimal, a
+decimal.Decimal subclass that keeps its text in the same way, as Decimal
+would otherwise write 1e3 as 1E+3.
+
+Values that are not numbers are left as strings.
+
+    environment = yield client.read_feed()
+    typeValues(environment)
+    total = sum([datastream.current_value for datastream in environment.datastreams.values()])
+
+A Client created with numeric_values set types every structure it decodes.
+"""
+
+import decimal
+import logging
+import txpachube
+
+
+
+Float_Values = 'float'
+Decimal_Values = 'decimal'
+Modes = [Float_Values, Decimal_Values]
+
+
+
+class Integer(int):
+    """ An int that keeps the text it was parsed from """
+
+    __slots__ = ('text',)
+
+    def __new__(cls, text):
+        value = int.__new__(cls, text)
+        value.text = text
+        return value
+
+    def __str__(self):
+        return str(self.text)
+
+    def __unicode__(self):
+        return unicode(self.text)
+
+    def __reduce__(self):
+        return (self.__class__, (self.text,))
+
+
+
+class Float(float):
+    """ A float that keeps the text it was parsed from """
+
+    __slots__ = ('text',)
+
+    def __new__(cls, text):
+        value = float.__new__(cls, text)
+        value.text = text
+        return value
+
+    def __str__(self):
+        return str(self.text)
+
+    def __unicode__(self):
+        return unicode(self.text)
+
+    def __reduce__(self):
+        return (self.__class__, (self.text,))
+
+
+
+class Decimal(decimal.Decimal):
+    """ A decimal.Decimal that keeps the text it was parsed from """
+
+    __slots__ = ('text',)
+
+    def __new__(cls, text):
+        value = decimal.Decimal.__new__(cls, text)
+        value.text = text
+        return value
+
+    def __str__(self):
+        return str(self.text)
+
+    def __unicode__(self):
+        return unicode(self.text)
+
+    def __reduce__(self):
+        return (self.__class__, (self.text,))
+
+
+
+def parseValue(value, mode=Float_Values):
+    """
+    Return a value as a number, or unchanged if it is not a number or has
+    already been parsed.
+
+    @param value: The value as decoded
+    @type value: string
+    @param mode: The kind of number to parse into [float|decimal]
+    @type mode: string
+
+    @rtype: Integer, Float, Decimal or string
+    """
+    if not isinstance(value, basestring):
+        return value
+    if mode == Decimal_Values:
+        try:
+            return Decimal(value)
+        except decimal.InvalidOperation:
+            return value
+    try:
+        return Integer(value)
+    except (ValueError, OverflowError):
+        # values too large for an int are kept as floats
+        pass
+    try:
+        return Float(value)
+    except ValueError:
+        return value
+
+
+def _typeDatastream(datastream, mode):
+    for attribute in [txpachube.DataFields.Current_Value,
+                      txpachube.DataFields.Maximum_Value,
+                      txpachube.DataFields.Minimum_Value]:
+        value = getattr(datastream, attribute)
+        if value is not None:
+            setattr(datastream, attribute, parseValue(value, mode))
+    for datapoint in datastream.datapoints:
+        if datapoint.value is not None:
+            datapoint.value = parseValue(datapoint.value, mode)
+
+
+def _typeEnvironment(environment, mode):
+    datastreams = environment.datastreams
+    if isinstance(datastreams, dict):
+        # fromXml stores the datastreams as a list
+        datastreams = datastreams.itervalues()
+    for datastream in datastreams:
+        _typeDatastream(datastream, mode)
+
+
+def typeValues(structure, mode=Float_Values):
+    """
+    Convert the numeric values of a data structure, and of the structures
+    it contains, to numbers in place. Structures without numeric values
+    are left unchanged.
+
+    @param structure: The data structure to convert
+    @type structure: txpachube.DataStructure
+    @param mode: The kind of number to parse into [float|decimal]
+    @type mode: string
+
+    @return: The structure
+    @rtype: txpachube.DataStructure
+    """
+    if mode not in Modes:
+        err_str = "Invalid numeric mode \'%s\' not in %s" % (mode, Modes)
+        logging.error(err_str)
+        raise Exception(err_str)
+
+    if isinstance(structure, txpachube.Environment):
+        _typeEnvironment(structure, mode)
+    elif isinstance(structure, txpachube.EnvironmentList):
+        for environment in structure.feeds:
+            _typeEnvironment(environment, mode)
+    elif isinstance(structure, txpachube.Datastream):
+        _typeDatastream(structure, mode)
+    elif isinstance(structure, txpachube.Datapoint):
+        if structure.value is not None:
+            structure.value = parseValue(structure.value, mode)
+    return structure
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Opt-in profiling of the txpachube data structures.
+
+A StructureProfiler wraps the encode, decode, toDict, fromDict, toXml and
+fromXml methods of every DataStructure class so the time spent in each
+can be attributed to the structure type. For each class and method it
+counts the calls and accumulates the time spent, and it counts the
+number of objects of each class created.
+
+Times are cumulative, so the time of Environment.fromDict includes the
+time spent in the Datastream.fromDict calls it makes.
+
+    profiler = StructureProfiler()
+    profiler.enable()
+    ...
+    print profiler.report()
+    profiler.disable()
+
+A report can also be logged on demand by sending the process a signal,
+see installSignalHandler.
+"""
+
+import logging
+import signal
+import threading
+import time
+import txpachube
+
+
+
+Profiled_Methods = ['encode', 'decode', 'toDict', 'fromDict', 'toXml', 'fromXml']
+
+
+
+def getStructureClasses():
+    """
+    Return the DataStructure class and all of its subclasses.
+    """
+    classes = [txpachube.DataStructure]
+    for cls in classes:
+        for subclass in cls.__subclasses__():
+            if subclass not in classes:
+                classes.append(subclass)
+    return classes
+
+
+
+class StructureProfiler(object):
+    """
+    Collects call counts, cumulative time and object counts for the
+    DataStructure classes while enabled.
+    """
+
+    def __init__(self, classes=None, timer=time.time):
+        """
+        @param classes: The classes to profile. Defaults to DataStructure and
+                        all of its subclasses at the time profiling is enabled.
+        @type classes: list
+        @param timer: A callable returning the current time in seconds
+        @type timer: callable
+        """
+        self.classes = classes
+        self.timer = timer
+        self.enabled = False
+        # reentrant, as the signal handler may run report in the main thread
+        # while it holds the lock recording a call
+        self.lock = threading.RLock()
+        # (class name, method name) -> [calls, cumulative time]
+        self.stats = dict()
+        # class name -> number of objects created
+        self.objects = dict()
+        # (class, attribute name, original function) tuples to restore
+        self._originals = []
+
+
+    def enable(self):
+        """
+        Start profiling by wrapping the methods of each class.
+        """
+        if self.enabled:
+            return
+        classes = self.classes or getStructureClasses()
+        for cls in classes:
+            for name in Profiled_Methods + ['__init__']:
+                # Only wrap methods a class defines itself. Inherited methods
+                # are wrapped on the class defining them and recorded against
+                # the class of the object they were called on.
+                function = cls.__dict__.get(name)
+                if function is None:
+                    continue
+                self._originals.append((cls, name, function))
+                if name == '__init__':
+                    setattr(cls, name, self._wrapInit(cls, function))
+                else:
+                    setattr(cls, name, self._wrapMethod(function))
+        self.enabled = True
+
+
+    def disable(self):
+        """
+        Stop profiling and restore the original methods. Collected
+        statistics are kept until reset is called.
+        """
+        for cls, name, function in reversed(self._originals):
+            setattr(cls, name, function)
+        self._originals = []
+        self.enabled = False
+
+
+    def reset(self):
+        """
+        Discard the collected statistics.
+        """
+        with self.lock:
+            self.stats.clear()
+            self.objects.clear()
+
+
+    def _wrapMethod(self, function):
+        profiler = self
+        name = function.__name__
+
+        def wrapper(obj, *args, **kwargs):
+            started = profiler.timer()
+            try:
+                return function(obj, *args, **kwargs)
+            finally:
+                elapsed = profiler.timer() - started
+                key = (obj.__class__.__name__, name)
+                with profiler.lock:
+                    stat = profiler.stats.get(key)
+                    if stat is None:
+                        stat = profiler.stats[key] = [0, 0.0]
+                    stat[0] += 1
+                    stat[1] += elapsed
+
+        wrapper.__name__ = name
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+
+    def _wrapInit(self, cls, function):
+        profiler = self
+
+        def wrapper(obj, *args, **kwargs):
+            function(obj, *args, **kwargs)
+            # count each object once, in the __init__ its class resolves to,
+            # rather than once for every __init__ up its hierarchy
+            owner = [c for c in obj.__class__.__mro__ if '__init__' in c.__dict__][0]
+            if owner is cls:
+                name = obj.__class__.__name__
+                with profiler.lock:
+                    profiler.objects[name] = profiler.objects.get(name, 0) + 1
+
+        wrapper.__name__ = '__init__'
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+
+
+    def report(self):
+        """
+        Return a report of the collected statistics, ordered by cumulative
+        time.
+
+        @rtype: string
+        """
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+            objects = sorted(self.objects.items())
+
+        lines = ["%-20s %-10s %10s %12s %12s" % ("structure", "method", "calls", "cumtime(s)", "percall(ms)")]
+        for (className, methodName), (calls, cumulative) in stats:
+            lines.append("%-20s %-10s %10d %12.6f %12.6f" % (className, methodName, calls, cumulative,
+                                                             cumulative * 1000.0 / calls))
+        lines.append("")
+        lines.append("%-20s %10s" % ("structure", "objects"))
+        for className, count in objects:
+            lines.append("%-20s %10d" % (className, count))
+        return "\n".join(lines)
+
+
+    def installSignalHandler(self, signum=None):
+        """
+        Log a report whenever the process receives a signal, SIGUSR1 by
+        default. This must be called from the main thread.
+
+        @param signum: The signal number to handle
+        @type signum: int
+        """
+        if signum is None:
+            signum = signal.SIGUSR1
+
+        def handler(signum, frame):
+            logging.info("txpachube structure profile:\n%s" % self.report())
+
+        signal.signal(signum, handler)
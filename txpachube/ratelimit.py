@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""
+Client side rate limiting of requests to Pachube.
+
+Pachube limits the rate at which each API key may make requests. Sending
+faster than this only results in 429 responses, so a RateLimiter holds
+requests back until they fit within the limit. Each API key has its own
+token buckets, one per method class, so reads and writes can be limited
+separately. Requests are delayed, never rejected.
+"""
+
+import collections
+import logging
+from twisted.internet import reactor, defer
+
+
+
+# Method classes. Methods are case insensitive so the lower case PAWS
+# methods map to the same classes as the HTTP methods.
+Read = 'read'
+Write = 'write'
+Method_Classes = {'get' : Read,
+                  'subscribe' : Read,
+                  'unsubscribe' : Read,
+                  'put' : Write,
+                  'post' : Write,
+                  'delete' : Write}
+
+
+
+class TokenBucket(object):
+    """
+    A token bucket that refills at a constant rate up to a burst capacity.
+    Each request takes one token and waits, in order of arrival, if the
+    bucket is empty.
+    """
+
+    def __init__(self, rate, burst, clock=None):
+        """
+        @param rate: The number of tokens added per second
+        @type rate: float
+        @param burst: The capacity of the bucket
+        @type burst: int
+        """
+        if rate <= 0:
+            err_str = "Invalid token bucket rate %s, the rate must be positive" % rate
+            logging.error(err_str)
+            raise Exception(err_str)
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock or reactor
+        self.tokens = float(burst)
+        self._updated = self.clock.seconds()
+        self._waiters = collections.deque()
+        self._call = None
+
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+    @property
+    def level(self):
+        """
+        The number of tokens currently available.
+        """
+        self._refill()
+        return self.tokens
+
+
+    @property
+    def waiting(self):
+        """
+        The number of requests waiting for a token.
+        """
+        return len(self._waiters)
+
+
+    def acquire(self):
+        """
+        Take a token from the bucket.
+
+        @return: A deferred that fires once a token has been taken. Cancelling
+                 the deferred gives up the place in the queue.
+        @rtype: defer.Deferred
+        """
+        self._refill()
+        if not self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return defer.succeed(None)
+        d = defer.Deferred(canceller=self._waiters.remove)
+        self._waiters.append(d)
+        self._schedule()
+        return d
+
+
+    def _schedule(self):
+        if self._call is None and self._waiters:
+            delay = max(0.0, (1 - self.tokens) / self.rate)
+            self._call = self.clock.callLater(delay, self._release)
+
+
+    def _release(self):
+        self._call = None
+        self._refill()
+        while self._waiters and self.tokens >= 1:
+            self.tokens -= 1
+            self._waiters.popleft().callback(None)
+        self._schedule()
+
+
+
+class RateLimiter(object):
+    """
+    Keeps separate token buckets for each API key and method class.
+    """
+
+    def __init__(self, limits=None, clock=None):
+        """
+        @param limits: A dict mapping a method class (Read or Write) to a tuple
+                       of the (rate, burst) to allow for each API key. Method
+                       classes not in the dict are not limited.
+        @type limits: dict
+        """
+        if limits is None:
+            limits = {Read : (2.0, 10),
+                      Write : (1.0, 5)}
+        self._checkLimits(limits)
+        self.limits = limits
+        self.clock = clock or reactor
+        self.buckets = dict()
+        # api key -> limits overriding the default limits for that key
+        self.keyLimits = dict()
+
+
+    def setLimits(self, api_key, limits):
+        """
+        Set the limits of one API key, for example a customer with a higher
+        request allowance. Buckets already created for the key are replaced.
+
+        @param limits: A dict mapping a method class to a tuple of the
+                       (rate, burst) to allow, as for the default limits.
+        @type limits: dict
+        """
+        self._checkLimits(limits)
+        self.keyLimits[api_key] = limits
+        for methodClass in (Read, Write):
+            self.buckets.pop((api_key, methodClass), None)
+
+
+    def _checkLimits(self, limits):
+        """
+        Reject limits with a rate that would never refill a bucket, rather
+        than fail the first request that creates the bucket.
+        """
+        for methodClass, (rate, burst) in limits.items():
+            if rate <= 0:
+                err_str = "Invalid %s rate limit %s, the rate must be positive" % (methodClass, rate)
+                logging.error(err_str)
+                raise Exception(err_str)
+
+
+    def getBucket(self, api_key, method):
+        """
+        Return the bucket for an API key and request method, or None if the
+        method is not limited.
+        """
+        methodClass = Method_Classes.get(method.lower(), Write)
+        key = (api_key, methodClass)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            limits = self.keyLimits.get(api_key, self.limits)
+            if methodClass not in limits:
+                return None
+            rate, burst = limits[methodClass]
+            bucket = self.buckets[key] = TokenBucket(rate, burst, clock=self.clock)
+        return bucket
+
+
+    def acquire(self, api_key, method):
+        """
+        Wait for permission to send a request.
+
+        @param api_key: The API key the request is made with
+        @type api_key: string
+        @param method: The request method
+        @type method: string
+
+        @return: A deferred that fires when the request may be sent
+        @rtype: defer.Deferred
+        """
+        bucket = self.getBucket(api_key, method)
+        if bucket is None:
+            return defer.succeed(None)
+        return bucket.acquire()
+
+
+    def levels(self):
+        """
+        Return the fill level of every bucket.
+
+        @return: A dict mapping (api_key, method class) tuples to the number
+                 of tokens available.
+        @rtype: dict
+        """
+        return dict([(key, bucket.level) for key, bucket in self.buckets.items()])
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+"""
+Retry policies for requests made by the txpachube Client.
+
+A RetryPolicy re-sends requests that failed for reasons that are likely
+to be transient: connection failures and the 429, 500, 502, 503 and 504
+response codes. Delays between attempts grow exponentially with random
+jitter, and a Retry-After header sent by Pachube is respected.
+
+A RetryBudget shared by all the requests made through a policy limits
+retries to a fraction of the recent request rate. When the service is
+failing badly the budget runs out and requests fail straight away,
+rather than every caller retrying and multiplying the load.
+
+Retry counts and the latency added by retrying are recorded per endpoint
+in the policy's stats.
+"""
+
+import collections
+import email.utils
+import logging
+import random
+from twisted.internet import reactor, defer, error, task
+from twisted.python import failure
+from twisted.web import _newclient
+
+
+
+class RetryBudget(object):
+    """
+    Limits the number of retries to a ratio of the requests made within a
+    sliding time window, plus a minimum number of retries per window.
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, window=10.0, clock=None):
+        """
+        @param ratio: The number of retries allowed per request made
+        @type ratio: float
+        @param min_retries: The number of retries allowed within the window
+                            regardless of the number of requests made.
+        @type min_retries: int
+        @param window: The length of the sliding window in seconds
+        @type window: float
+        """
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.clock = clock or reactor
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+
+
+    def _expire(self, now):
+        oldest = now - self.window
+        for times in (self._requests, self._retries):
+            while times and times[0] < oldest:
+                times.popleft()
+
+
+    def deposit(self):
+        """
+        Record that a request is being made.
+        """
+        self._requests.append(self.clock.seconds())
+
+
+    def withdraw(self):
+        """
+        Attempt to take a retry from the budget.
+
+        @return: True if the retry may go ahead
+        @rtype: boolean
+        """
+        now = self.clock.seconds()
+        self._expire(now)
+        if len(self._retries) >= self.min_retries + self.ratio * len(self._requests):
+            return False
+        self._retries.append(now)
+        return True
+
+
+
+class EndpointRetryStats(object):
+    """
+    Retry statistics for one endpoint.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        # requests that failed after using up their attempts
+        self.exhausted = 0
+        # retries refused because the retry budget was empty
+        self.budget_exceeded = 0
+        # seconds spent on failed attempts and the delays between attempts
+        self.added_latency = 0.0
+
+
+    def __str__(self):
+        return "requests=%s, retries=%s, exhausted=%s, budget_exceeded=%s, added_latency=%.3fs" % (self.requests,
+                                                                                                   self.retries,
+                                                                                                   self.exhausted,
+                                                                                                   self.budget_exceeded,
+                                                                                                   self.added_latency)
+
+
+
+class RetryPolicy(object):
+    """
+    Decides whether, and when, a failed request attempt is tried again.
+    """
+
+    Retryable_Codes = [429, 500, 502, 503, 504]
+
+    # Methods that can safely be sent more than once
+    Idempotent_Methods = ['GET', 'PUT', 'DELETE']
+
+    # Errors raised when the connection could not be made, so the
+    # request was never sent and can be retried whatever its method.
+    Connect_Errors = (error.ConnectError,
+                      error.DNSLookupError)
+
+    # Errors raised when the connection failed part way through a request
+    Transient_Errors = (error.ConnectionLost,
+                        error.ConnectionDone,
+                        error.TimeoutError,
+                        _newclient.ResponseNeverReceived,
+                        _newclient.RequestTransmissionFailed,
+                        _newclient.ResponseFailed)
+
+
+    def __init__(self, max_retries=3, base_delay=0.5, max_delay=30.0, multiplier=2.0,
+                 jitter=1.0, max_retry_after=120.0, budget=None, clock=None):
+        """
+        @param max_retries: The maximum number of times a request is retried
+        @type max_retries: int
+        @param base_delay: The delay, in seconds, before the first retry
+        @type base_delay: float
+        @param max_delay: The upper limit of the backoff delay in seconds
+        @type max_delay: float
+        @param multiplier: The factor the delay grows by after each attempt
+        @type multiplier: float
+        @param jitter: The fraction of each delay that is randomised. With 1.0
+                       the delay is chosen uniformly between zero and the
+                       backoff delay, with 0.0 the delays are fixed.
+        @type jitter: float
+        @param max_retry_after: The longest Retry-After delay that is honoured.
+                                Responses asking for a longer wait are not retried.
+        @type max_retry_after: float
+        @param budget: The retry budget shared by all requests using this policy.
+                       If not set, a RetryBudget with default settings is used.
+        @type budget: RetryBudget
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.clock = clock or reactor
+        self.budget = budget or RetryBudget(clock=self.clock)
+        self.stats = collections.defaultdict(EndpointRetryStats)
+
+
+    def backoff(self, attempt):
+        """
+        Return the delay before the retry following the numbered attempt.
+
+        @param attempt: The number of attempts made so far, starting at 1
+        @type attempt: int
+
+        @rtype: float
+        """
+        delay = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        return delay * (1.0 - self.jitter * random.random())
+
+
+    def getRetryAfter(self, response):
+        """
+        Return the delay requested by a Retry-After response header in
+        seconds, or None if there is no valid header.
+        """
+        values = response.headers.getRawHeaders('Retry-After')
+        if not values:
+            return None
+        value = values[0].strip()
+        if value.isdigit():
+            return float(value)
+        parsed = email.utils.parsedate_tz(value)
+        if parsed is None:
+            logging.warning("Ignoring invalid Retry-After header: %s" % value)
+            return None
+        return max(0.0, email.utils.mktime_tz(parsed) - self.clock.seconds())
+
+
+    def isRetryableFailure(self, method, reason):
+        """
+        Return True if an attempt that failed with an exception may be retried.
+        """
+        if reason.check(*RetryPolicy.Connect_Errors):
+            return True
+        if method in RetryPolicy.Idempotent_Methods:
+            return reason.check(*RetryPolicy.Transient_Errors) is not None
+        return False
+
+
+    def isRetryableResponse(self, method, response):
+        """
+        Return True if an attempt that received a response may be retried.
+        A 429 means the request was refused before it was processed, so it
+        is retried whatever the method.
+        """
+        if response.code == 429:
+            return True
+        return response.code in RetryPolicy.Retryable_Codes and method in RetryPolicy.Idempotent_Methods
+
+
+    @defer.inlineCallbacks
+    def call(self, endpoint, method, attempt, *args, **kwargs):
+        """
+        Make a request, retrying it according to this policy.
+
+        @param endpoint: The name the retry statistics are recorded under
+        @type endpoint: string
+        @param method: The HTTP method of the request
+        @type method: string
+        @param attempt: A callable that makes one attempt at the request and
+                        returns a deferred firing with a (response, responseBody)
+                        tuple.
+        @type attempt: callable
+
+        @return: A deferred that returns the result of the final attempt. If
+                 the final attempt failed with an exception the deferred errbacks.
+        @rtype: defer.Deferred
+        """
+        stats = self.stats[endpoint]
+        stats.requests += 1
+        self.budget.deposit()
+        started = self.clock.seconds()
+        attempts = 0
+
+        while True:
+            attempts += 1
+            attemptStarted = self.clock.seconds()
+            retryAfter = None
+            try:
+                outcome = yield attempt(*args, **kwargs)
+            except Exception:
+                outcome = failure.Failure()
+                if not self.isRetryableFailure(method, outcome):
+                    break
+                reason = outcome.getErrorMessage()
+            else:
+                response, responseBody = outcome
+                if not self.isRetryableResponse(method, response):
+                    break
+                reason = "%s %s" % (response.code, response.phrase)
+                retryAfter = self.getRetryAfter(response)
+
+            if attempts > self.max_retries:
+                stats.exhausted += 1
+                logging.error("Giving up on %s %s request after %s attempts: %s" % (method, endpoint, attempts, reason))
+                break
+
+            if retryAfter is not None and retryAfter > self.max_retry_after:
+                logging.error("Not retrying %s %s request, Retry-After of %ss is too long" % (method, endpoint, retryAfter))
+                break
+
+            if not self.budget.withdraw():
+                stats.budget_exceeded += 1
+                logging.error("Not retrying %s %s request, retry budget exceeded: %s" % (method, endpoint, reason))
+                break
+
+            delay = self.backoff(attempts)
+            if retryAfter is not None:
+                delay = max(delay, retryAfter)
+            stats.retries += 1
+            logging.warning("Retrying %s %s request in %.2fs after attempt %s failed: %s" % (method, endpoint, delay, attempts, reason))
+            yield task.deferLater(self.clock, delay, lambda: None)
+
+        if attempts > 1:
+            stats.added_latency += attemptStarted - started
+
+        if isinstance(outcome, failure.Failure):
+            outcome.raiseException()
+        defer.returnValue(outcome)
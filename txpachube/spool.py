@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+
+"""
+A write-ahead spool that makes buffered uploads to Pachube durable.
+
+Writes queued in memory are lost if the process dies or Pachube is down
+for longer than the process lives. A SpooledWriter records each write in
+a Spool on local disk before sending it with a Client, and only forgets
+it once Pachube has accepted it. When a SpooledWriter is created it
+queues any writes left in the spool by a previous run, so they are sent
+in their original order ahead of new writes once it is started or a new
+write is made.
+
+The spool is a directory of append-only segment files. Each record holds
+its length, a CRC32 checksum, a sequence number and the JSON encoded
+write. A record only partially written when the process died fails its
+checksum and is discarded, along with anything after it in the segment.
+The sequence number of the last acknowledged record is kept in a small
+cursor file, and segments holding only acknowledged records are deleted.
+
+Records are appended with a buffered write that is flushed to the
+operating system, so they survive the process dying. Pass sync=True to
+also fsync each record so they survive a power failure, at a large cost
+in throughput.
+"""
+
+import collections
+import json
+import logging
+import os
+import struct
+import zlib
+from twisted.internet import reactor, defer
+from twisted.web.iweb import IBodyProducer
+import txpachube
+import txpachube.encoder
+
+
+
+# length, crc32 and sequence number of a record
+Record_Header = struct.Struct('>IIQ')
+
+Segment_Suffix = '.spool'
+Cursor_File = 'cursor'
+
+
+
+def _toBytes(value):
+    """
+    Return a value decoded from a spool record with its strings encoded
+    back to utf-8 byte strings, as the Client builds urls and request
+    bodies from byte strings.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict([(_toBytes(k), _toBytes(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return [_toBytes(v) for v in value]
+    return value
+
+
+
+class Spool(object):
+    """
+    An append-only store of records, each identified by an increasing
+    sequence number.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, sync=False):
+        """
+        @param directory: The directory holding the spool. It is created if
+                          it does not exist.
+        @type directory: string
+        @param segment_size: The size, in bytes, at which a new segment is started
+        @type segment_size: int
+        @param sync: A flag instructing the spool to fsync every record
+        @type sync: boolean
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # The sequence number of the last acknowledged record
+        self.acknowledged = self._readCursor()
+        self.lastSequence = self.acknowledged
+
+        # Records not yet acknowledged, as (sequence, payload) tuples
+        self._pending = collections.deque()
+        # Sequences acknowledged out of order, ahead of the cursor
+        self._acked = set()
+        # (path, last sequence) of each segment, oldest first
+        self._segments = []
+        self._active = None
+        self._activeSize = 0
+
+        self._load()
+
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+
+    def _readCursor(self):
+        try:
+            with open(self._path(Cursor_File)) as f:
+                return int(f.read().strip() or 0)
+        except IOError:
+            return 0
+
+
+    def _writeCursor(self):
+        temp = self._path(Cursor_File + '.tmp')
+        with open(temp, 'w') as f:
+            f.write(str(self.acknowledged))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.rename(temp, self._path(Cursor_File))
+
+
+    def _load(self):
+        """
+        Read the existing segments, keeping the records not yet acknowledged.
+        """
+        names = sorted([n for n in os.listdir(self.directory) if n.endswith(Segment_Suffix)])
+        for name in names:
+            path = self._path(name)
+            lastSequence = None
+            with open(path, 'rb') as f:
+                data = f.read()
+            offset = 0
+            while offset + Record_Header.size <= len(data):
+                length, crc, sequence = Record_Header.unpack_from(data, offset)
+                start = offset + Record_Header.size
+                payload = data[start:start + length]
+                if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                if sequence > self.acknowledged:
+                    self._pending.append((sequence, payload))
+                lastSequence = sequence
+                self.lastSequence = max(self.lastSequence, sequence)
+                offset = start + length
+            if offset < len(data):
+                logging.warning("Discarding %s bytes of incomplete records from spool segment %s" % (len(data) - offset, path))
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+            self._segments.append((path, lastSequence))
+        self.compact()
+
+
+    def _roll(self):
+        """
+        Close the active segment and start a new one.
+        """
+        if self._active is not None:
+            self._active.close()
+        path = self._path("%020d%s" % (self.lastSequence + 1, Segment_Suffix))
+        self._active = open(path, 'ab')
+        self._activeSize = 0
+        self._segments.append((path, None))
+
+
+    def append(self, payload):
+        """
+        Append a record to the spool.
+
+        @param payload: The record
+        @type payload: string
+
+        @return: The sequence number of the record
+        @rtype: int
+        """
+        if self._active is None or self._activeSize >= self.segment_size:
+            self._roll()
+        self.lastSequence += 1
+        record = Record_Header.pack(len(payload), zlib.crc32(payload) & 0xffffffff, self.lastSequence) + payload
+        self._active.write(record)
+        self._active.flush()
+        if self.sync:
+            os.fsync(self._active.fileno())
+        self._activeSize += len(record)
+        path, last = self._segments[-1]
+        self._segments[-1] = (path, self.lastSequence)
+        self._pending.append((self.lastSequence, payload))
+        return self.lastSequence
+
+
+    def acknowledge(self, sequence):
+        """
+        Mark a record as no longer needed. The cursor only moves past
+        records once every earlier record has been acknowledged too.
+
+        @param sequence: The sequence number of the record
+        @type sequence: int
+        """
+        self._acked.add(sequence)
+        moved = False
+        while self._pending and self._pending[0][0] in self._acked:
+            self._acked.discard(self._pending.popleft()[0])
+            moved = True
+        if moved:
+            if self._pending:
+                self.acknowledged = self._pending[0][0] - 1
+            else:
+                self.acknowledged = self.lastSequence
+            self._writeCursor()
+            if len(self._segments) > 1 and self._segments[0][1] <= self.acknowledged:
+                self.compact()
+
+
+    def pending(self):
+        """
+        Return the records not yet acknowledged, oldest first.
+
+        @return: A list of (sequence, payload) tuples
+        @rtype: list
+        """
+        return list(self._pending)
+
+
+    def compact(self):
+        """
+        Delete the segments, other than the active one, that hold only
+        acknowledged records.
+        """
+        while self._segments:
+            path, lastSequence = self._segments[0]
+            if self._active is not None and path == self._active.name:
+                break
+            if lastSequence is not None and lastSequence > self.acknowledged:
+                break
+            os.remove(path)
+            self._segments.pop(0)
+
+
+    def close(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+
+
+class SpooledWriter(object):
+    """
+    Sends writes to Pachube through a Client, spooling each one to disk
+    first. Writes are sent one at a time in the order they were made.
+    """
+
+    # The Client methods whose calls can be spooled
+    Spooled_Methods = ['create_datapoints', 'update_feed', 'update_datastream']
+
+
+    def __init__(self, client, spool, retry_interval=5.0, max_attempts=None, clock=None):
+        """
+        @param client: The client used to send writes
+        @type client: txpachube.client.Client
+        @param spool: The spool writes are recorded in
+        @type spool: Spool
+        @param retry_interval: The time, in seconds, to wait before resending
+                               a write that failed.
+        @type retry_interval: float
+        @param max_attempts: The number of times a write is attempted before it
+                             is discarded. If not set, writes are retried until
+                             they succeed.
+        @type max_attempts: int
+        """
+        self.client = client
+        self.spool = spool
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self.clock = clock or reactor
+
+        # (sequence, method, kwargs, deferred) tuples waiting to be sent
+        self._queue = collections.deque()
+        self._sending = False
+        self._attempts = 0
+        self._retryCall = None
+
+        # queue the writes left in the spool by a previous run ahead of any
+        # new writes
+        for sequence, payload in self.spool.pending():
+            record = _toBytes(json.loads(payload))
+            self._queue.append((sequence, record['method'], record['kwargs'], None))
+        self._replayed = len(self._queue)
+
+
+    def start(self):
+        """
+        Start sending the writes left in the spool by a previous run.
+
+        @return: The number of writes replayed
+        @rtype: int
+        """
+        if self._replayed:
+            logging.info("Replaying %s spooled writes" % self._replayed)
+        self._sendNext()
+        return self._replayed
+
+
+    def stop(self):
+        if self._retryCall and self._retryCall.active():
+            self._retryCall.cancel()
+        self._retryCall = None
+        self.spool.close()
+
+
+    def create_datapoints(self, **kwargs):
+        """
+        Spool and send a Client.create_datapoints call.
+
+        @return: A deferred that fires with True once Pachube has accepted the
+                 write, or with False if it was discarded.
+        @rtype: defer.Deferred
+        """
+        return self.write('create_datapoints', **kwargs)
+
+
+    def update_feed(self, **kwargs):
+        """
+        Spool and send a Client.update_feed call.
+
+        @return: A deferred that fires with True once Pachube has accepted the
+                 write, or with False if it was discarded.
+        @rtype: defer.Deferred
+        """
+        return self.write('update_feed', **kwargs)
+
+
+    def update_datastream(self, **kwargs):
+        """
+        Spool and send a Client.update_datastream call.
+
+        @return: A deferred that fires with True once Pachube has accepted the
+                 write, or with False if it was discarded.
+        @rtype: defer.Deferred
+        """
+        return self.write('update_datastream', **kwargs)
+
+
+    def write(self, method, **kwargs):
+        """
+        Spool and send a call to one of the Spooled_Methods of the client.
+        Data given as a DataStructure or StructureBodyProducer is spooled
+        encoded. Other keyword arguments must be JSON serializable.
+        """
+        if method not in SpooledWriter.Spooled_Methods:
+            err_str = "Can't spool calls to %s" % method
+            logging.error(err_str)
+            raise Exception(err_str)
+        data = kwargs.get('data')
+        if isinstance(data, txpachube.DataStructure):
+            kwargs['data'] = data.encode(kwargs.get('format', txpachube.DataFormats.JSON))
+        elif isinstance(data, txpachube.encoder.StructureBodyProducer):
+            kwargs['data'] = data.buffer.getvalue()
+        elif IBodyProducer.providedBy(data):
+            err_str = "Can't spool %s data, only strings and data structures" % data.__class__.__name__
+            logging.error(err_str)
+            raise Exception(err_str)
+        try:
+            payload = json.dumps({'method' : method, 'kwargs' : kwargs})
+        except (TypeError, ValueError), ex:
+            err_str = "Can't spool %s call: %s" % (method, ex)
+            logging.error(err_str)
+            raise Exception(err_str)
+        sequence = self.spool.append(payload)
+        d = defer.Deferred()
+        self._queue.append((sequence, method, kwargs, d))
+        self._sendNext()
+        return d
+
+
+    @property
+    def queued(self):
+        """
+        The number of writes waiting to be accepted by Pachube.
+        """
+        return len(self._queue)
+
+
+    def _sendNext(self):
+        if self._sending or self._retryCall or not self._queue:
+            return
+        self._sending = True
+        self._attempts += 1
+        sequence, method, kwargs, d = self._queue[0]
+        result = defer.maybeDeferred(getattr(self.client, method), **kwargs)
+        result.addCallbacks(self._sent, self._failed)
+
+
+    def _sent(self, success):
+        if not success:
+            self._failed(None)
+            return
+        self._complete(True)
+
+
+    def _failed(self, reason):
+        self._sending = False
+        sequence, method, kwargs, d = self._queue[0]
+        if reason is None:
+            reason = "write not accepted"
+        else:
+            reason = reason.getErrorMessage()
+        if self.max_attempts and self._attempts >= self.max_attempts:
+            logging.error("Discarding spooled %s write %s after %s attempts: %s" % (method, sequence, self._attempts, reason))
+            self._complete(False)
+            return
+        logging.warning("Spooled %s write %s failed, retrying in %ss: %s" % (method, sequence, self.retry_interval, reason))
+        self._retryCall = self.clock.callLater(self.retry_interval, self._retry)
+
+
+    def _retry(self):
+        self._retryCall = None
+        self._sendNext()
+
+
+    def _complete(self, accepted):
+        self._sending = False
+        self._attempts = 0
+        sequence, method, kwargs, d = self._queue.popleft()
+        self.spool.acknowledge(sequence)
+        if d is not None:
+            d.callback(accepted)
+        self._sendNext()
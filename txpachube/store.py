@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+
+"""
+A local time-series store mirroring the datastreams a client has seen.
+
+Applications that chart or analyse history tend to read the same ranges
+of datapoints from Pachube again and again, often ranges whose values
+have already arrived through a PAWS subscription. A TimeSeriesStore
+keeps the datapoints seen through subscription updates and raw history
+reads, and records which time ranges of each datastream it holds
+completely. Client.read_datastream_history answers a query from the
+store when the range is covered and only fetches the gaps from Pachube.
+
+Each datastream's datapoints are kept in append-only segments. Recent
+datapoints collect in an uncompressed head, which is sealed into a zlib
+compressed segment once it fills. Segments are indexed by their start
+time so a query only decompresses the segments overlapping its range.
+
+A range is only considered covered when the store knows it saw every
+datapoint in it: a raw history read that was not truncated, or the time
+between consecutive updates of a subscription that stayed connected.
+"""
+
+import bisect
+import calendar
+import json
+import logging
+import re
+import time
+import zlib
+import txpachube
+
+
+
+_timestampPattern = re.compile(r'^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(\.\d+)?(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parseTimestamp(at):
+    """
+    Convert a Pachube timestamp into seconds since the epoch.
+
+    @param at: A timestamp, e.g. 2010-07-02T10:21:57.101496Z
+    @type at: string
+
+    @rtype: float
+    """
+    match = _timestampPattern.match(at.strip())
+    if match is None:
+        err_str = "Invalid timestamp \'%s\'" % at
+        logging.error(err_str)
+        raise Exception(err_str)
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour), int(minute), int(second)))
+    if fraction:
+        seconds += float(fraction)
+    if zone and zone != 'Z':
+        sign = -1 if zone[0] == '-' else 1
+        zone = zone[1:].replace(':', '')
+        seconds -= sign * (int(zone[:2]) * 3600 + int(zone[2:]) * 60)
+    return seconds
+
+
+def formatTimestamp(seconds):
+    """
+    Convert seconds since the epoch into a Pachube timestamp in UTC.
+
+    @rtype: string
+    """
+    whole = int(seconds)
+    micro = int(round((seconds - whole) * 1000000))
+    if micro == 1000000:
+        whole, micro = whole + 1, 0
+    return "%s.%06dZ" % (time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(whole)), micro)
+
+
+
+class Segment(object):
+    """
+    A sealed, compressed block of datapoints ordered by time.
+    """
+
+    def __init__(self, points):
+        """
+        @param points: The (time, value) tuples to hold, ordered by time
+        @type points: list
+        """
+        self.start = points[0][0]
+        self.end = points[-1][0]
+        self.count = len(points)
+        self.data = zlib.compress(json.dumps(points))
+
+
+    def points(self):
+        return [tuple(point) for point in json.loads(zlib.decompress(self.data))]
+
+
+
+class Series(object):
+    """
+    The stored datapoints of one datastream and the time ranges they
+    cover completely.
+    """
+
+    def __init__(self, segment_size=1000):
+        """
+        @param segment_size: The number of datapoints held in the head before
+                             it is sealed into a compressed segment.
+        @type segment_size: int
+        """
+        self.segment_size = segment_size
+        # Sealed segments and their start times, ordered by start time
+        self._segments = []
+        self._starts = []
+        # Recent (time, value) tuples in time order
+        self._head = []
+        # Covered [start, end] ranges, ordered and not overlapping
+        self.covered = []
+        # The time of the last subscription update while the subscription
+        # has been continuously connected.
+        self.live = None
+
+
+    def _seal(self, points):
+        segment = Segment(points)
+        index = bisect.bisect_right(self._starts, segment.start)
+        self._starts.insert(index, segment.start)
+        self._segments.insert(index, segment)
+
+
+    def append(self, points):
+        """
+        Add datapoints to the series.
+
+        @param points: (time, value) tuples ordered by time
+        @type points: list
+        """
+        if self._head and points and points[0][0] == self._head[-1][0]:
+            # the newest datapoint held, received again
+            points = points[1:]
+        if not points:
+            return
+        if self._head and points[0][0] <= self._head[-1][0]:
+            # Older than the head, such as history fetched to fill a gap,
+            # so keep it in a segment of its own.
+            self._seal(points)
+            return
+        self._head.extend(points)
+        if len(self._head) >= self.segment_size:
+            self._seal(self._head)
+            self._head = []
+
+
+    def cover(self, start, end):
+        """
+        Record that every datapoint between start and end is held.
+        """
+        if end < start:
+            return
+        merged = []
+        for s, e in self.covered:
+            if e < start or s > end:
+                merged.append((s, e))
+            else:
+                start, end = min(s, start), max(e, end)
+        merged.append((start, end))
+        merged.sort()
+        self.covered = merged
+
+
+    def gaps(self, start, end):
+        """
+        Return the parts of a time range that are not covered.
+
+        @return: A list of (start, end) tuples
+        @rtype: list
+        """
+        gaps = []
+        for s, e in self.covered:
+            if e < start:
+                continue
+            if s > end:
+                break
+            if s > start:
+                gaps.append((start, s))
+            start = max(start, e)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+
+    def query(self, start, end):
+        """
+        Return the stored datapoints within a time range.
+
+        @return: (time, value) tuples ordered by time
+        @rtype: list
+        """
+        points = []
+        # segments starting after the end of the range can be skipped
+        for segment in self._segments[:bisect.bisect_right(self._starts, end)]:
+            if segment.end >= start:
+                points.extend([p for p in segment.points() if start <= p[0] <= end])
+        points.extend([p for p in self._head if start <= p[0] <= end])
+        points.sort()
+        result = []
+        for point in points:
+            if not result or result[-1][0] != point[0]:
+                result.append(point)
+        return result
+
+
+
+class TimeSeriesStore(object):
+    """
+    Holds a Series for each datastream, keyed by feed and datastream
+    identifier.
+    """
+
+    def __init__(self, segment_size=1000):
+        self.segment_size = segment_size
+        self.series = dict()
+
+
+    def getSeries(self, feed_id, datastream_id):
+        key = (str(feed_id), str(datastream_id))
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = Series(self.segment_size)
+        return series
+
+
+    def recordUpdate(self, feed_id, datastream):
+        """
+        Record the current value of a datastream received in a subscription
+        update. The range since the previous update is covered as long as
+        the subscription has stayed connected.
+
+        @param datastream: The datastream as found in the update message body
+        @type datastream: dict
+        """
+        at = datastream.get(txpachube.DataFields.At)
+        value = datastream.get(txpachube.DataFields.Current_Value)
+        if not at or value is None:
+            return
+        t = parseTimestamp(at)
+        series = self.getSeries(feed_id, datastream[txpachube.DataFields.Id])
+        if series.live is not None and t <= series.live:
+            # an update already recorded, or one older than it
+            return
+        if series.live is not None:
+            series.cover(series.live, t)
+        series.live = t
+        series.append([(t, unicode(value))])
+
+
+    def recordHistory(self, feed_id, datastream_id, datapoints, start=None, end=None):
+        """
+        Record datapoints read from the datastream history. If start and end
+        are given the range between them is covered.
+
+        @param datapoints: The datapoints read
+        @type datapoints: list of txpachube.Datapoint
+        @param start: The start of the range read, in seconds since the epoch
+        @type start: float
+        @param end: The end of the range read, in seconds since the epoch
+        @type end: float
+        """
+        series = self.getSeries(feed_id, datastream_id)
+        points = sorted([(parseTimestamp(dp.at), unicode(dp.value)) for dp in datapoints if dp.at])
+        series.append(points)
+        if start is not None and end is not None:
+            series.cover(start, end)
+
+
+    def interrupt(self):
+        """
+        Break the coverage provided by subscriptions, for instance because
+        the PAWS connection was lost and updates may have been missed.
+        """
+        for series in self.series.values():
+            series.live = None
+
+
+    def gaps(self, feed_id, datastream_id, start, end):
+        """
+        Return the parts of a time range of a datastream not held by the store.
+
+        @return: A list of (start, end) tuples in seconds since the epoch
+        @rtype: list
+        """
+        return self.getSeries(feed_id, datastream_id).gaps(start, end)
+
+
+    def query(self, feed_id, datastream_id, start, end):
+        """
+        Return the stored datapoints of a datastream within a time range.
+
+        @return: A list of txpachube.Datapoint objects ordered by time
+        @rtype: list
+        """
+        points = self.getSeries(feed_id, datastream_id).query(start, end)
+        return [txpachube.Datapoint(at=formatTimestamp(t), value=value) for t, value in points]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""
+Pull based consumption of PAWS subscription updates.
+
+A subscription normally pushes each update into a handler callable. A
+SubscriptionStream is a handler that queues the updates instead, so a
+consumer can pull them one at a time in its own control flow, waiting on
+a deferred for the next one:
+
+    token, stream = yield pawsClient.subscribe_stream(resource)
+    while True:
+        try:
+            update = yield stream.get()
+        except StreamClosed:
+            break
+        ...
+
+The stream holds at most size updates. When the consumer falls behind
+the oldest waiting update is discarded and counted in dropped, so a slow
+consumer sees the most recent updates rather than growing the queue
+without bound.
+
+Updates may be pushed from a dispatcher thread; they are moved to the
+reactor thread before being queued, so get must be called from the
+reactor thread.
+"""
+
+import collections
+import logging
+from twisted.internet import defer
+from twisted.python import threadable
+
+
+
+class StreamClosed(Exception):
+    """
+    Raised by SubscriptionStream.get once the stream has been closed and
+    every queued update has been consumed.
+    """
+
+
+
+class SubscriptionStream(object):
+    """
+    Queues the updates of a subscription for a consumer to pull.
+    """
+
+    def __init__(self, size=1000, reactor=None):
+        """
+        @param size: The number of updates held before the oldest is discarded
+        @type size: int
+        @param reactor: The reactor updates are passed to when they are pushed
+                        from another thread.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.size = size
+        self.token = None
+        self.closed = False
+        # The number of updates discarded because the queue was full
+        self.dropped = 0
+        self._updates = collections.deque()
+        self._waiters = collections.deque()
+
+
+    def __call__(self, update):
+        """
+        Receive an update from the subscription.
+        """
+        # updates arrive in a dispatcher thread once the reactor is running
+        if threadable.ioThread is None or threadable.isInIOThread():
+            self.put(update)
+        else:
+            self.reactor.callFromThread(self.put, update)
+
+
+    def put(self, update):
+        if self.closed:
+            return
+        if self._waiters:
+            self._waiters.popleft().callback(update)
+            return
+        if len(self._updates) >= self.size:
+            self._updates.popleft()
+            self.dropped += 1
+        self._updates.append(update)
+
+
+    def get(self):
+        """
+        Return the next update.
+
+        @return: A deferred that fires with the next update, or fails with
+                 StreamClosed once the stream is closed and empty. Cancelling
+                 it gives up the wait without losing an update.
+        @rtype: defer.Deferred
+        """
+        if self._updates:
+            return defer.succeed(self._updates.popleft())
+        if self.closed:
+            return defer.fail(StreamClosed("Subscription stream %s is closed" % self.token))
+        d = defer.Deferred(canceller=self._waiters.remove)
+        self._waiters.append(d)
+        return d
+
+
+    @property
+    def pending(self):
+        """
+        The number of updates waiting to be consumed.
+        """
+        return len(self._updates)
+
+
+    def close(self):
+        """
+        Stop accepting updates. Updates already queued can still be consumed,
+        after which get fails with StreamClosed.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        logging.debug("Subscription stream %s closed, %s updates pending", self.token, len(self._updates))
+        while self._waiters:
+            self._waiters.popleft().errback(StreamClosed("Subscription stream %s is closed" % self.token))
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+"""
+Incremental synchronisation of datastream history.
+
+Keeping a local copy of datastream history current by re-reading wide
+time windows transfers the same datapoints over and over. An
+IncrementalSync instead keeps a high-water mark for each datastream, the
+time of the newest datapoint it has read, and each run only reads the
+datapoints from it on. Datapoints are told apart by their timestamp, so
+the datapoint at the watermark is not passed to the handler again.
+
+History is read with Client.read_datastream using the start and
+find_previous parameters, in windows no longer than the maximum range of
+a raw history query and continuing from the last datapoint when a page
+is full. The datapoints read are passed to a handler and the watermark
+is checkpointed after every page, so an interrupted run resumes where it
+stopped. Many datastreams are synchronised concurrently.
+
+The watermark is the time of the newest datapoint read rather than the
+time a run ended, so a datapoint stored after a run, with a timestamp
+earlier than the end of that run, is still found by the next one. A lag
+keeps each run from reading the most recent seconds of history at all.
+"""
+
+import json
+import logging
+import os
+from twisted.internet import reactor, defer
+import txpachube.client
+from txpachube.store import parseTimestamp, formatTimestamp
+
+
+
+class Checkpoint(object):
+    """
+    Holds the watermark of each datastream, optionally saved to a file.
+    """
+
+    def __init__(self, path=None):
+        """
+        @param path: The file the watermarks are saved in. If not set the
+                     watermarks are only kept in memory.
+        @type path: string
+        """
+        self.path = path
+        self.watermarks = dict()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.watermarks = json.load(f)
+
+
+    def _key(self, feed_id, datastream_id):
+        return "%s/%s" % (feed_id, datastream_id)
+
+
+    def get(self, feed_id, datastream_id):
+        """
+        Return the watermark timestamp of a datastream, or None if it has
+        not been synchronised before.
+        """
+        return self.watermarks.get(self._key(feed_id, datastream_id))
+
+
+    def set(self, feed_id, datastream_id, watermark):
+        self.watermarks[self._key(feed_id, datastream_id)] = watermark
+
+
+    def save(self):
+        """
+        Write the watermarks to the checkpoint file, replacing it atomically.
+        """
+        if not self.path:
+            return
+        temp = self.path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.watermarks, f, sort_keys=True, indent=2)
+        os.rename(temp, self.path)
+
+
+
+class SyncResult(object):
+    """
+    Summarises one run of an IncrementalSync.
+    """
+
+    def __init__(self):
+        # "feed_id/datastream_id" -> number of new datapoints read
+        self.synced = dict()
+        # "feed_id/datastream_id" -> error message
+        self.failed = dict()
+        self.requests = 0
+
+
+    def __str__(self):
+        return "synced=%s datapoints from %s datastreams, requests=%s, failed=%s" % (sum(self.synced.values()),
+                                                                                      len(self.synced),
+                                                                                      self.requests,
+                                                                                      len(self.failed))
+
+
+
+class IncrementalSync(object):
+    """
+    Reads the datapoints of a set of datastreams that are newer than
+    their watermarks.
+    """
+
+    def __init__(self, client, datastreams, checkpoint=None, handler=None, concurrency=4,
+                 initial_start=None, lag=0, clock=None):
+        """
+        @param client: The client used to read history
+        @type client: txpachube.client.Client
+        @param datastreams: The (feed_id, datastream_id) tuples to synchronise
+        @type datastreams: list
+        @param checkpoint: Holds the watermarks. Defaults to an in-memory Checkpoint.
+        @type checkpoint: Checkpoint
+        @param handler: An optional callable that is passed the feed_id,
+                        datastream_id and list of new txpachube.Datapoint objects
+                        read by each request. If it returns a deferred the
+                        watermark is only advanced once it fires.
+        @type handler: callable
+        @param concurrency: The number of datastreams synchronised at once
+        @type concurrency: int
+        @param initial_start: The timestamp datastreams without a watermark are
+                              synchronised from. Defaults to the maximum range of
+                              one raw history query before the current time.
+        @type initial_start: string
+        @param lag: The number of seconds before the current time up to which
+                    history is read. Datapoints newer than that are left for
+                    a later run.
+        @type lag: float
+        """
+        self.client = client
+        self.datastreams = list(datastreams)
+        self.checkpoint = checkpoint or Checkpoint()
+        self.handler = handler
+        self.concurrency = concurrency
+        self.initial_start = initial_start
+        self.lag = lag
+        self.clock = clock or reactor
+
+
+    def run(self):
+        """
+        Synchronise every datastream once.
+
+        @return: A deferred that returns a SyncResult once all datastreams
+                 have been synchronised or have failed.
+        @rtype: defer.Deferred
+        """
+        result = SyncResult()
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        runs = []
+        for feed_id, datastream_id in self.datastreams:
+            d = semaphore.run(self.syncDatastream, feed_id, datastream_id, result)
+            d.addErrback(self._syncFailed, feed_id, datastream_id, result)
+            runs.append(d)
+        d = defer.gatherResults(runs)
+        d.addCallback(lambda _: result)
+        return d
+
+
+    def _syncFailed(self, reason, feed_id, datastream_id, result):
+        key = "%s/%s" % (feed_id, datastream_id)
+        result.failed[key] = reason.getErrorMessage()
+        logging.error("Sync of datastream %s failed: %s" % (key, reason.getErrorMessage()))
+
+
+    @defer.inlineCallbacks
+    def syncDatastream(self, feed_id, datastream_id, result=None):
+        """
+        Read the datapoints of one datastream newer than its watermark.
+
+        @return: A deferred that returns the number of new datapoints read
+        @rtype: defer.Deferred
+        """
+        if result is None:
+            result = SyncResult()
+        key = "%s/%s" % (feed_id, datastream_id)
+        end = self.clock.seconds() - self.lag
+        watermark = self.checkpoint.get(feed_id, datastream_id)
+        # the times of the datapoints read at the current read position
+        seen = set()
+        if watermark is None:
+            watermark = self.initial_start or formatTimestamp(end - txpachube.client.Raw_History_Window)
+        else:
+            # the datapoint at the watermark was read by a previous run
+            seen.add(parseTimestamp(watermark))
+        # the timestamp reading continues from
+        start = watermark
+        count = 0
+
+        while parseTimestamp(start) < end:
+            windowStart = parseTimestamp(start)
+            windowEnd = min(end, windowStart + txpachube.client.Raw_History_Window)
+            parameters = {'start' : start,
+                          'end' : formatTimestamp(windowEnd),
+                          'find_previous' : 'true',
+                          'per_page' : txpachube.client.Max_Per_Page}
+            datastream = yield self.client.read_datastream(feed_id=feed_id, datastream_id=datastream_id,
+                                                           parameters=parameters)
+            result.requests += 1
+            datapoints = datastream.datapoints if datastream else []
+            # find_previous returns the datapoint before the start too, and
+            # the datapoints at the start may have been read already
+            newer = [dp for dp in datapoints if dp.at and parseTimestamp(dp.at) >= windowStart and
+                     parseTimestamp(dp.at) not in seen]
+
+            if newer and self.handler:
+                yield defer.maybeDeferred(self.handler, feed_id, datastream_id, newer)
+            count += len(newer)
+
+            times = [parseTimestamp(dp.at) for dp in newer]
+            if newer:
+                watermark = newer[times.index(max(times))].at
+                self.checkpoint.set(feed_id, datastream_id, watermark)
+                self.checkpoint.save()
+            if len(datapoints) >= txpachube.client.Max_Per_Page and newer:
+                # the page was full, continue from the last datapoint read
+                start = watermark
+            else:
+                start = formatTimestamp(windowEnd)
+            position = parseTimestamp(start)
+            seen = set([t for t in seen.union(times) if t >= position])
+
+        result.synced[key] = count
+        defer.returnValue(count)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""
+Routing of requests for many API keys through a single Client.
+
+An application managing the feeds of many customers, each with its own
+API key, would otherwise create a Client, and so an Agent and its
+connections, per customer. A TenantClient shares one Client, and
+optionally one persistent connection pool, between every key.
+
+The API key of each call is looked up from its feed_id by a resolver, a
+callable that is passed the feed_id and returns the API key, or a
+deferred returning it. KeyResolver is a simple dict based resolver.
+
+Calls are rate limited per API key, using the limits of a RateLimiter
+which can be set individually for each key, and are then queued per key
+in a FairScheduler. The scheduler limits the number of requests in
+progress and takes calls from the queues of the keys in turn, so one
+busy key can not hold up the others.
+"""
+
+import collections
+import logging
+from twisted.internet import reactor, defer
+from twisted.python import failure
+import txpachube.client
+import txpachube.ratelimit
+
+try:
+    from twisted.web.client import HTTPConnectionPool
+except ImportError:
+    # twisted before 12.1 has no connection pool
+    HTTPConnectionPool = None
+
+
+
+# The request method used by each kind of Client call
+Method_Prefixes = {'list' : 'GET',
+                   'read' : 'GET',
+                   'create' : 'POST',
+                   'update' : 'PUT',
+                   'delete' : 'DELETE'}
+
+# Client calls that read history in several windows, making a request for
+# each. A call takes a single rate limit token, so these would let a key
+# exceed its limit.
+Multiple_Request_Methods = ['read_datastream_history', 'read_datastream_downsampled']
+
+# The Client calls that can be made through a TenantClient and their
+# request methods.
+Tenant_Methods = dict([(name, Method_Prefixes[name.split('_')[0]]) for name in dir(txpachube.client.Client)
+                       if name.split('_')[0] in Method_Prefixes and name not in Multiple_Request_Methods])
+
+
+
+class KeyResolver(object):
+    """
+    Maps feed identifiers to the API keys used to access them.
+    """
+
+    def __init__(self, keys=None, default=None):
+        """
+        @param keys: The initial feed_id to api key mapping
+        @type keys: dict
+        @param default: The api key used for feeds not in the mapping. If not
+                        set, calls for unknown feeds fail.
+        @type default: string
+        """
+        self.keys = dict([(str(feed_id), api_key) for feed_id, api_key in (keys or {}).items()])
+        self.default = default
+
+
+    def add(self, feed_id, api_key):
+        self.keys[str(feed_id)] = api_key
+
+
+    def remove(self, feed_id):
+        self.keys.pop(str(feed_id), None)
+
+
+    def __call__(self, feed_id):
+        return self.keys.get(str(feed_id), self.default)
+
+
+
+class FairScheduler(object):
+    """
+    Runs calls queued per key, with a limit on the number of calls in
+    progress, taking the next call from each waiting key in turn.
+    """
+
+    def __init__(self, concurrency=10):
+        """
+        @param concurrency: The number of calls allowed in progress at once
+        @type concurrency: int
+        """
+        self.concurrency = concurrency
+        self.active = 0
+        # key -> deque of [deferred, running deferred, function, args, kwargs]
+        self._queues = dict()
+        # the keys with queued calls, in the order they are served
+        self._ready = collections.deque()
+
+
+    def run(self, key, f, *args, **kwargs):
+        """
+        Queue a call for a key.
+
+        @param key: The key the call is queued under, normally an api key
+        @param f: The function to call. It may return a deferred.
+        @type f: callable
+
+        @return: A deferred that fires with the result of the call. Cancelling
+                 it removes a queued call, or cancels one in progress.
+        @rtype: defer.Deferred
+        """
+        entry = [None, None, f, args, kwargs]
+        d = defer.Deferred(canceller=lambda _: self._cancel(key, entry))
+        entry[0] = d
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self._ready.append(key)
+        queue.append(entry)
+        self._next()
+        return d
+
+
+    def queued(self, key=None):
+        """
+        Return the number of calls waiting for a key, or for all keys if
+        no key is given.
+        """
+        if key is None:
+            return sum([len(queue) for queue in self._queues.values()])
+        return len(self._queues.get(key, ()))
+
+
+    def _cancel(self, key, entry):
+        running = entry[1]
+        if running is not None:
+            running.cancel()
+            return
+        queue = self._queues.get(key)
+        if queue and entry in queue:
+            queue.remove(entry)
+            if not queue:
+                del self._queues[key]
+                self._ready.remove(key)
+
+
+    def _next(self):
+        while self.active < self.concurrency and self._ready:
+            key = self._ready.popleft()
+            queue = self._queues[key]
+            entry = queue.popleft()
+            if queue:
+                # go to the back of the line behind the other keys
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+            d, running, f, args, kwargs = entry
+            self.active += 1
+            running = entry[1] = defer.maybeDeferred(f, *args, **kwargs)
+            running.addBoth(self._done, d)
+
+
+    def _done(self, result, d):
+        self.active -= 1
+        if not d.called:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        self._next()
+
+
+
+class TenantClient(object):
+    """
+    Makes Client calls on behalf of many API keys, looking up the key of
+    each call from its feed_id.
+
+    Every Client call whose name starts with list, read, create, update or
+    delete, other than the Multiple_Request_Methods, is available as a
+    method taking the same keyword arguments, e.g.
+    tenants.read_feed(feed_id=1234). The api_key argument can be
+    given to override the resolver, and must be given for calls without a
+    feed_id, such as the trigger, user and key calls.
+    """
+
+    def __init__(self, resolver, client=None, rate_limiter=None, concurrency=10, clock=None):
+        """
+        @param resolver: A callable passed a feed_id that returns the api key
+                         to use, or a deferred returning it.
+        @type resolver: callable
+        @param client: The client used to make requests. If not set a Client
+                       is created with a persistent connection pool, when the
+                       installed twisted provides one.
+        @type client: txpachube.client.Client
+        @param rate_limiter: The per api key rate limits. Defaults to a
+                             RateLimiter with the default limits.
+        @type rate_limiter: txpachube.ratelimit.RateLimiter
+        @param concurrency: The number of requests in progress at once across
+                            all api keys.
+        @type concurrency: int
+        """
+        self.resolver = resolver
+        self.clock = clock or reactor
+        if client is None:
+            pool = None
+            if HTTPConnectionPool is not None:
+                pool = HTTPConnectionPool(reactor)
+                pool.maxPersistentPerHost = concurrency
+            client = txpachube.client.Client(pool=pool)
+        self.client = client
+        if rate_limiter is None:
+            rate_limiter = txpachube.ratelimit.RateLimiter(clock=self.clock)
+        self.rate_limiter = rate_limiter
+        self.scheduler = FairScheduler(concurrency)
+
+
+    @defer.inlineCallbacks
+    def call(self, method, **kwargs):
+        """
+        Make a Client call on behalf of the api key owning the feed.
+
+        @param method: The name of the Client method to call
+        @type method: string
+
+        @return: A deferred that returns the result of the Client call
+        @rtype: defer.Deferred
+        """
+        if method not in Tenant_Methods:
+            err_str = "Unsupported tenant call %s" % method
+            logging.error(err_str)
+            raise Exception(err_str)
+
+        api_key = kwargs.pop('api_key', None)
+        if api_key is None:
+            feed_id = kwargs.get('feed_id')
+            if feed_id is None:
+                err_str = "No api_key or feed_id given for %s call" % method
+                logging.error(err_str)
+                raise Exception(err_str)
+            api_key = yield defer.maybeDeferred(self.resolver, feed_id)
+            if api_key is None:
+                err_str = "No api key found for feed %s" % feed_id
+                logging.error(err_str)
+                raise Exception(err_str)
+
+        # Wait for the key's rate limit before joining the queue, so a key
+        # that is being held back does not occupy a place in progress.
+        yield self.rate_limiter.acquire(api_key, Tenant_Methods[method])
+        result = yield self.scheduler.run(api_key, getattr(self.client, method), api_key=api_key, **kwargs)
+        defer.returnValue(result)
+
+
+    def __getattr__(self, name):
+        if name in Tenant_Methods:
+            return lambda **kwargs: self.call(name, **kwargs)
+        raise AttributeError(name)
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""
+Multi-process ingestion of many feeds.
+
+Decoding and encoding data structures is CPU bound and runs on the one
+reactor thread, so a single process can only use one core. A Supervisor
+shards a list of feeds across a number of worker processes, each running
+its own reactor and Client, and runs a job for every feed in them.
+
+A job is a function, named by its dotted path so workers can import it,
+that is passed a Client and a feed_id and returns a deferred:
+
+    def readFeed(client, feed_id):
+        return client.read_feed(feed_id=feed_id)
+
+    supervisor = Supervisor(feeds, 'mypackage.jobs.readFeed', workers=4,
+                            api_key=API_KEY, interval=60.0)
+    supervisor.start()
+
+Workers are started with spawnProcess and talk to the supervisor with
+JSON messages, one per line, over their stdin and stdout. Pachube rate
+limits apply per API key across all processes, so every request a
+worker makes first asks the supervisor for permission, and the
+supervisor grants it from a single RateLimiter. Workers report the jobs
+they complete and fail, and the supervisor logs the aggregate throughput.
+
+Each feed is always assigned to the same worker, by a hash of its
+identifier. A worker that exits is restarted and given its feeds again.
+"""
+
+import json
+import logging
+import os
+import sys
+import zlib
+from twisted.internet import defer, protocol, task
+from twisted.protocols import basic
+from twisted.python import reflect
+import txpachube.client
+import txpachube.ratelimit
+
+
+
+# Message types
+Acquire = 'acquire'
+Grant = 'grant'
+Stats = 'stats'
+Assign = 'assign'
+Stop = 'stop'
+
+# The environment variable the api key is passed to workers in, so it
+# does not appear in the process list.
+Api_Key_Variable = 'TXPACHUBE_API_KEY'
+
+
+def shard(feed_id, workers):
+    """
+    Return the index of the worker a feed is assigned to.
+
+    @rtype: int
+    """
+    return (zlib.crc32(str(feed_id)) & 0xffffffff) % workers
+
+
+
+class RemoteRateLimiter(object):
+    """
+    A rate limiter for a worker process that asks the supervisor for
+    permission to send each request.
+    """
+
+    def __init__(self, send):
+        """
+        @param send: A callable that sends a message to the supervisor
+        @type send: callable
+        """
+        self.send = send
+        self._nextId = 0
+        # request id -> deferred waiting for a grant
+        self._waiting = dict()
+
+
+    def acquire(self, api_key, method):
+        """
+        Wait for permission to send a request.
+
+        @return: A deferred that fires when the supervisor grants the request
+        @rtype: defer.Deferred
+        """
+        self._nextId += 1
+        requestId = self._nextId
+        d = defer.Deferred(canceller=lambda _: self._waiting.pop(requestId, None))
+        self._waiting[requestId] = d
+        self.send({'type' : Acquire, 'id' : requestId, 'api_key' : api_key, 'method' : method})
+        return d
+
+
+    def granted(self, requestId):
+        d = self._waiting.pop(requestId, None)
+        if d is not None:
+            d.callback(None)
+
+
+
+class Worker(object):
+    """
+    Runs the job for each feed assigned to a worker process and reports
+    the results to the supervisor.
+    """
+
+    def __init__(self, job, send, api_key=None, interval=None, concurrency=10, report_interval=5.0,
+                 clock=None):
+        """
+        @param job: A callable passed a Client and a feed_id that returns a deferred
+        @type job: callable
+        @param send: A callable that sends a message to the supervisor
+        @type send: callable
+        @param interval: The time, in seconds, between the starts of runs over
+                         the assigned feeds. If not set the feeds are run once.
+        @type interval: float
+        @param concurrency: The number of jobs run at once
+        @type concurrency: int
+        @param report_interval: The time, in seconds, between reports to the
+                                supervisor.
+        @type report_interval: float
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.job = job
+        self.send = send
+        self.interval = interval
+        self.concurrency = concurrency
+        self.clock = clock
+        self.rate_limiter = RemoteRateLimiter(send)
+        self.client = txpachube.client.Client(api_key=api_key, rate_limiter=self.rate_limiter)
+        self.feeds = []
+        self.completed = 0
+        self.failed = 0
+        self._running = False
+        self._call = None
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.clock = clock
+        self._reporter.start(report_interval, now=False)
+
+
+    def messageReceived(self, message):
+        kind = message.get('type')
+        if kind == Grant:
+            self.rate_limiter.granted(message['id'])
+        elif kind == Assign:
+            self.feeds = message['feeds']
+            if not self._running:
+                self.run()
+        elif kind == Stop:
+            self.stop()
+        else:
+            logging.warning("Worker received unknown message: %s" % message)
+
+
+    def run(self):
+        """
+        Run the job once for each assigned feed.
+
+        @return: A deferred that fires once every job has finished
+        @rtype: defer.Deferred
+        """
+        self._call = None
+        self._running = True
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        jobs = [semaphore.run(self.job, self.client, feed_id).addCallbacks(self._jobDone, self._jobFailed,
+                                                                            errbackArgs=(feed_id,))
+                for feed_id in self.feeds]
+        d = defer.gatherResults(jobs)
+        d.addCallback(self._runDone)
+        return d
+
+
+    def _jobDone(self, result):
+        self.completed += 1
+
+
+    def _jobFailed(self, reason, feed_id):
+        self.failed += 1
+        logging.error("Job for feed %s failed: %s" % (feed_id, reason.getErrorMessage()))
+
+
+    def _runDone(self, _):
+        self._running = False
+        if self.interval:
+            self._call = self.clock.callLater(self.interval, self.run)
+
+
+    def report(self):
+        """
+        Send the number of jobs completed and failed since the last report.
+        """
+        if self.completed or self.failed:
+            self.send({'type' : Stats, 'completed' : self.completed, 'failed' : self.failed})
+            self.completed = 0
+            self.failed = 0
+
+
+    def stop(self):
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+        if self._reporter.running:
+            self._reporter.stop()
+        self.report()
+
+
+
+class WorkerProtocol(basic.LineReceiver):
+    """
+    The worker end of the channel to the supervisor, over stdin and stdout.
+    """
+
+    delimiter = '\n'
+
+    def __init__(self, factory):
+        """
+        @param factory: A callable passed the send function of the protocol
+                        that returns the Worker.
+        @type factory: callable
+        """
+        self.factory = factory
+        self.worker = None
+
+
+    def connectionMade(self):
+        self.worker = self.factory(self.sendMessage)
+
+
+    def sendMessage(self, message):
+        self.sendLine(json.dumps(message))
+
+
+    def lineReceived(self, line):
+        message = json.loads(line)
+        self.worker.messageReceived(message)
+        if message.get('type') == Stop:
+            self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        # the supervisor has gone away
+        if self.worker:
+            self.worker.stop()
+        from twisted.internet import reactor
+        if reactor.running:
+            reactor.stop()
+
+
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    The supervisor end of the channel to one worker process.
+    """
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self._buffer = ''
+
+
+    def connectionMade(self):
+        self.supervisor.workerStarted(self)
+
+
+    def send(self, message):
+        self.transport.write(json.dumps(message) + '\n')
+
+
+    def outReceived(self, data):
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            if line:
+                self.supervisor.messageReceived(self, json.loads(line))
+
+
+    def errReceived(self, data):
+        for line in data.splitlines():
+            logging.warning("worker %s: %s" % (self.index, line))
+
+
+    def processEnded(self, reason):
+        self.supervisor.workerExited(self, reason)
+
+
+
+class Supervisor(object):
+    """
+    Shards feeds across worker processes, rate limits their requests and
+    aggregates their throughput.
+    """
+
+    def __init__(self, feeds, job, workers=2, api_key=None, interval=None, concurrency=10,
+                 rate_limiter=None, report_interval=10.0, restart=True, python=None, reactor=None):
+        """
+        @param feeds: The feed identifiers to run the job for
+        @type feeds: list
+        @param job: The dotted name of the job function, which must be
+                    importable in the worker processes.
+        @type job: string
+        @param workers: The number of worker processes
+        @type workers: int
+        @param api_key: The api key the workers' clients use
+        @type api_key: string
+        @param interval: The time, in seconds, between runs of the job for each
+                         feed. If not set the job is run once per feed.
+        @type interval: float
+        @param concurrency: The number of jobs each worker runs at once
+        @type concurrency: int
+        @param rate_limiter: The limiter every worker request is granted by.
+                             Defaults to a RateLimiter with the default limits.
+        @type rate_limiter: txpachube.ratelimit.RateLimiter
+        @param report_interval: The time, in seconds, between logs of the
+                                aggregate throughput.
+        @type report_interval: float
+        @param restart: A flag instructing the supervisor to restart workers
+                        that exit.
+        @type restart: boolean
+        @param python: The python executable workers are run with. Defaults
+                       to the one running the supervisor.
+        @type python: string
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.feeds = list(feeds)
+        self.job = job
+        self.workers = workers
+        self.api_key = api_key
+        self.interval = interval
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter or txpachube.ratelimit.RateLimiter(clock=reactor)
+        self.report_interval = report_interval
+        self.restart = restart
+        self.python = python or sys.executable
+        self.stopping = False
+
+        self.completed = 0
+        self.failed = 0
+        self.started = None
+        # worker index -> WorkerProcessProtocol
+        self.processes = dict()
+        self._reporter = None
+
+
+    def assignments(self):
+        """
+        Return the feeds assigned to each worker.
+
+        @return: A list holding the list of feeds of each worker
+        @rtype: list
+        """
+        shards = [[] for i in range(self.workers)]
+        for feed_id in self.feeds:
+            shards[shard(feed_id, self.workers)].append(feed_id)
+        return shards
+
+
+    def start(self):
+        """
+        Start the worker processes.
+        """
+        self.started = self.reactor.seconds()
+        for index in range(self.workers):
+            self._spawn(index)
+        self._reporter = task.LoopingCall(self.report)
+        self._reporter.clock = self.reactor
+        self._reporter.start(self.report_interval, now=False)
+
+
+    def _spawn(self, index):
+        args = [self.python, '-m', 'txpachube.workers', '--job', self.job,
+                '--concurrency', str(self.concurrency)]
+        if self.interval:
+            args.extend(['--interval', str(self.interval)])
+        env = dict(os.environ)
+        if self.api_key:
+            env[Api_Key_Variable] = self.api_key
+        processProtocol = WorkerProcessProtocol(self, index)
+        self.processes[index] = processProtocol
+        self.reactor.spawnProcess(processProtocol, self.python, args, env=env)
+
+
+    def workerStarted(self, processProtocol):
+        feeds = self.assignments()[processProtocol.index]
+        logging.info("Started worker %s with %s feeds" % (processProtocol.index, len(feeds)))
+        processProtocol.send({'type' : Assign, 'feeds' : feeds})
+
+
+    def workerExited(self, processProtocol, reason):
+        index = processProtocol.index
+        if self.processes.get(index) is processProtocol:
+            del self.processes[index]
+        if self.stopping:
+            return
+        logging.error("Worker %s exited: %s" % (index, reason.getErrorMessage()))
+        if self.restart:
+            self._spawn(index)
+
+
+    def messageReceived(self, processProtocol, message):
+        kind = message.get('type')
+        if kind == Acquire:
+            d = self.rate_limiter.acquire(message.get('api_key'), message.get('method', 'GET'))
+            d.addCallback(lambda _: processProtocol.send({'type' : Grant, 'id' : message['id']}))
+        elif kind == Stats:
+            self.completed += message.get('completed', 0)
+            self.failed += message.get('failed', 0)
+        else:
+            logging.warning("Supervisor received unknown message from worker %s: %s" % (processProtocol.index,
+                                                                                       message))
+
+
+    def throughput(self):
+        """
+        Return the average number of jobs completed per second since the
+        supervisor started.
+
+        @rtype: float
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = self.reactor.seconds() - self.started
+        if elapsed <= 0:
+            return 0.0
+        return self.completed / elapsed
+
+
+    def report(self):
+        logging.info("workers=%s, completed=%s, failed=%s, throughput=%.2f jobs/s" % (len(self.processes),
+                                                                                      self.completed,
+                                                                                      self.failed,
+                                                                                      self.throughput()))
+
+
+    def stop(self):
+        """
+        Ask the worker processes to stop.
+        """
+        self.stopping = True
+        if self._reporter and self._reporter.running:
+            self._reporter.stop()
+        for processProtocol in self.processes.values():
+            processProtocol.send({'type' : Stop})
+            processProtocol.transport.closeStdin()
+
+
+
+def main(argv=None):
+    """
+    Run a worker process. This is started by a Supervisor.
+    """
+    import optparse
+    from twisted.internet import reactor, stdio
+
+    parser = optparse.OptionParser()
+    parser.add_option('--job', help="The dotted name of the job function")
+    parser.add_option('--interval', type='float', default=None)
+    parser.add_option('--concurrency', type='int', default=10)
+    options, args = parser.parse_args(argv)
+
+    # stdout carries messages to the supervisor, so log to stderr
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    job = reflect.namedAny(options.job)
+    api_key = os.environ.get(Api_Key_Variable)
+
+    def makeWorker(send):
+        return Worker(job, send, api_key=api_key, interval=options.interval,
+                      concurrency=options.concurrency)
+
+    stdio.StandardIO(WorkerProtocol(makeWorker))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()